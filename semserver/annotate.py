@@ -1,6 +1,12 @@
 from __future__ import unicode_literals, print_function
 
+import collections
+import json
+import logging
+import multiprocessing
 import re
+import signal
+import traceback
 
 import rdflib
 from rdflib.namespace import NamespaceManager, XSD
@@ -8,21 +14,87 @@ import ztreamy.events
 import ztreamy.server
 import ztreamy.rdfevents
 
+from . import rdftext
+from . import utils
+
 
 class GenericAnnotator(object):
 
-    def __init__(self):
+    def __init__(self, merge_batches=False, output_format='n3'):
+        """Creates a new annotator.
+
+        If `merge_batches` is True, `annotate_events` merges the
+        annotated events of each batch into just one event
+        per application id (see `merge_annotated`).
+
+        `output_format` is the serialization of the annotated events,
+        one of the keys of `rdftext.output_formats`.
+
+        """
+        if not output_format in rdftext.output_formats:
+            raise ValueError('Unknown output format: ' + output_format)
         self.ns = {}
+        self.prefixes = {}
         self.uri_ref_cache = {}
         self.namespace_manager = NamespaceManager(rdflib.Graph())
         self.annotation_dispatcher = {}
+        self.merge_batches = merge_batches
+        self.output_format = output_format
+        self.source_id = ztreamy.random_id()
+        self._serializer = None
+
+    @property
+    def serializer(self):
+        if self._serializer is None:
+            prefixes = dict(self.prefixes)
+            prefixes['xsd'] = rdftext.NS_XSD
+            self._serializer = \
+                rdftext.output_formats[self.output_format](prefixes)
+        return self._serializer
+
+    def worker_options(self):
+        """Constructor arguments of an equivalent worker annotator.
+
+        Workers do not merge batches: their results are merged
+        by the process that collects them.
+
+        """
+        return {'output_format': self.output_format}
 
     def annotate_events(self, events):
         annotated = []
         for event in events:
             annotated.extend(self.annotate_event(event))
+        if self.merge_batches:
+            annotated = self.merge_annotated(annotated)
         return annotated
 
+    def merge_annotated(self, events):
+        """Merges the annotated events with the same application id
+        and event type.
+
+        Each group of events is replaced by just one event, placed
+        where the first event of the group was, whose body contains
+        all their statements under a shared set of namespace
+        declarations. Events not created by this annotator are
+        kept as they are.
+
+        """
+        groups = collections.OrderedDict()
+        merged = []
+        for event in events:
+            if self._is_mergeable(event):
+                key = (event.application_id, event.event_type,
+                       event.__class__)
+                if key not in groups:
+                    groups[key] = []
+                    merged.append(groups[key])
+                groups[key].append(event)
+            else:
+                merged.append(event)
+        return [self._merge_events(item) if isinstance(item, list) else item \
+                for item in merged]
+
     def annotate_event(self, event):
         """Annotates the event and returns a resulting list of events.
 
@@ -41,6 +113,7 @@ class GenericAnnotator(object):
         self.ns[key] = rdflib.Namespace(uri_prefix)
         if prefix:
             self.namespace_manager.bind(prefix, self.ns[key])
+            self.prefixes[prefix] = uri_prefix
 
     def _create_graph(self):
         return rdflib.Graph(namespace_manager=self.namespace_manager)
@@ -64,15 +137,83 @@ class GenericAnnotator(object):
             self._create_uri_ref(key, suffix)
 
     def _create_event(self, event, graph):
-        return ztreamy.events.Event.create( \
-            event.source_id,
-            'text/n3',
-            graph,
-            application_id=event.application_id,
-            aggregator_id=event.aggregator_id,
-            event_type=event.event_type,
-            timestamp=event.timestamp,
-            extra_headers={'X-Derived-From': event.event_id})
+        if self.output_format == 'ntriples':
+            return self._create_derived_event(event,
+                                              graph.serialize(format='nt'),
+                                              class_=RDFTextEvent)
+        else:
+            return self._create_derived_event(event, graph)
+
+    def _create_text_event(self, event, nodes):
+        """Creates an event from a list of `rdftext.Node` objects."""
+        bnode_prefix = 'b' + _re_non_alphanumeric.sub('', event.event_id)
+        return self._create_derived_event( \
+                        event,
+                        self.serializer.serialize(nodes,
+                                                  bnode_prefix=bnode_prefix),
+                        class_=RDFTextEvent)
+
+    def _create_derived_event(self, event, body, class_=None):
+        return self._create_annotated_event(event.source_id, body, class_,
+                                 application_id=event.application_id,
+                                 aggregator_id=event.aggregator_id,
+                                 event_type=event.event_type,
+                                 timestamp=event.timestamp,
+                                 extra_headers={'X-Derived-From': \
+                                                    event.event_id})
+
+    def _create_annotated_event(self, source_id, body, class_, **kwargs):
+        syntax = rdftext.output_formats[self.output_format].media_type
+        if class_ is None:
+            return ztreamy.events.Event.create(source_id, syntax, body,
+                                               **kwargs)
+        else:
+            return class_(source_id, syntax, body, **kwargs)
+
+    def _is_mergeable(self, event):
+        return (isinstance(event, (ztreamy.rdfevents.RDFEvent, RDFTextEvent))
+                and 'X-Derived-From' in event.extra_headers)
+
+    def _merge_events(self, events):
+        if len(events) == 1:
+            return events[0]
+        elif isinstance(events[0], RDFTextEvent):
+            body = self.serializer.merge([event.body for event in events])
+            return self._create_merged_event(events, body,
+                                             class_=RDFTextEvent)
+        else:
+            graph = self._create_graph()
+            for event in events:
+                graph += event.body
+            return self._create_merged_event(events, graph)
+
+    def _create_merged_event(self, events, body, class_=None):
+        """Creates the event that replaces a group of merged events.
+
+        The source id is kept if it is the same in all the events.
+        Otherwise, the source id of the annotator is used.
+        The X-Derived-From header lists the ids of all the
+        original events.
+
+        """
+        source_ids = set(event.source_id for event in events)
+        if len(source_ids) == 1:
+            source_id = events[0].source_id
+        else:
+            source_id = self.source_id
+        derived_from = ','.join(event.extra_headers['X-Derived-From'] \
+                                for event in events)
+        return self._create_annotated_event(source_id, body, class_,
+                                 application_id=events[0].application_id,
+                                 aggregator_id=events[-1].aggregator_id,
+                                 event_type=events[0].event_type,
+                                 timestamp=events[-1].timestamp,
+                                 extra_headers={'X-Derived-From': \
+                                                    derived_from})
+
+
+DriverRule = collections.namedtuple('DriverRule',
+                                    ('class_', 'value_property', 'convert'))
 
 
 class HermesAnnotator(GenericAnnotator):
@@ -84,8 +225,37 @@ class HermesAnnotator(GenericAnnotator):
     application_id_heart_rate = 'Hermes-Citizen-Fitbit-HeartRate'
     application_id_sleep = 'Hermes-Citizen-Fitbit-Sleep'
 
-    def __init__(self):
-        super(HermesAnnotator, self).__init__()
+    # Class, property of the value and conversion of the value
+    # for each type of SmartDriver event
+    driver_rules = {
+        'Average Speed Section': \
+                DriverRule('Speed', 'average_speed', None),
+        'Standard Deviation of Vehicle Speed Section': \
+                DriverRule('Speed', 'deviation_speed', None),
+        'Inefficient Speed Section': \
+                DriverRule('Speed', 'inefficient_speed', None),
+        'Heart Rate Section': \
+                DriverRule('Heart_Rate', 'normal_bpm', None),
+        'Standard Deviation Heart Rate Section': \
+                DriverRule('Heart_Rate', 'deviation_bpm', None),
+        'High Heart Rate': \
+                DriverRule('Heart_Rate', 'unexpected_bpm', None),
+        'Stops Section': \
+                DriverRule('Stopping', 'stops', int),
+        'Positive Kinetic Energy': \
+                DriverRule('Agressiveness', 'positive_kinetic_energy', None),
+        'High Acceleration': \
+                DriverRule('Acceleration', 'acceleration', None),
+        'High Deceleration': \
+                DriverRule('Acceleration', 'acceleration', None),
+    }
+
+    # Maximum number of interned user URIs
+    max_user_uris = 10000
+
+    def __init__(self, merge_batches=False, output_format='n3'):
+        super(HermesAnnotator, self).__init__(merge_batches=merge_batches,
+                                              output_format=output_format)
         self.register_ns('', HermesAnnotator.ns_hermes, prefix='hermes')
         self.register_ns('geo', HermesAnnotator.ns_geo, prefix='geo')
         self._create_uri_refs([
@@ -146,100 +316,88 @@ class HermesAnnotator(GenericAnnotator):
                                              self.annotate_event_heart_rate,
             HermesAnnotator.application_id_sleep: self.annotate_event_sleep,
         })
-        self.classes_driver = {
-            'Average Speed Section': 'Speed',
-            'Standard Deviation of Vehicle Speed Section': 'Speed',
-            'Inefficient Speed Section': 'Speed',
-            'Heart Rate Section': 'Heart_Rate',
-            'Standard Deviation Heart Rate Section': 'Heart_Rate',
-            'High Heart Rate': 'Heart_Rate',
-            'Stops Section': 'Stopping',
-            'Positive Kinetic Energy': 'Agressiveness',
-            'High Acceleration': 'Acceleration',
-            'High Deceleration': 'Acceleration',
-        }
+        self.classes_driver = dict((top_key, rule.class_) \
+                                   for top_key, rule \
+                                   in self.driver_rules.items())
+        self.driver_emitters = dict((top_key, self._compile_driver_rule(rule)) \
+                                    for top_key, rule \
+                                    in self.driver_rules.items())
+        self.user_uris = utils.LatestValueBuffer( \
+                                        generations=1,
+                                        max_entries=self.max_user_uris)
 
     def annotate_event_driver(self, event):
         if (not isinstance(event, ztreamy.events.JSONEvent)
-            or len(event.body.keys()) != 1
-            or list(event.body.keys())[0] not in self.classes_driver):
+            or len(event.body) != 1):
+            return [event]
+        top_key = next(iter(event.body))
+        emitter = self.driver_emitters.get(top_key)
+        if emitter is None:
             return [event]
-        top_key = list(event.body.keys())[0]
-        data = event.body[top_key]
         graph = self._create_graph()
-        observation = self._uri_ref('Id-Observation', event.event_id)
-        graph.add((observation,
-                   rdflib.RDF.type,
-                   self._uri_ref('', self.classes_driver[top_key])))
-        graph.add((observation,
-                   self._uri_ref('', 'happens_at_timestamp'),
-                   rdflib.Literal(event.timestamp,
-                                  datatype=XSD.timestamp)))
-        graph.add((observation,
-                   self._uri_ref('', 'has_driver'),
-                   self._uri_ref('Id-User', event.source_id)))
-        graph.add((observation,
-                   self._uri_ref('', 'orientation'),
-                   rdflib.Literal(data['orientation'])))
-        location = rdflib.BNode()
-        graph.add((observation,
-                   self._uri_ref('', 'has_location'),
-                   location))
-        graph.add((location,
-                   rdflib.RDF.type,
-                   self._uri_ref('geo', 'SpatialThing')))
-        graph.add((location,
-                   self._uri_ref('geo', 'lat'),
-                   rdflib.Literal(data['latitude'])))
-        graph.add((location,
-                   self._uri_ref('geo', 'long'),
-                   rdflib.Literal(data['longitude'])))
-        if 'distancia' in data:
-            graph.add((observation,
-                       self._uri_ref('', 'completed_distance'),
-                       rdflib.Literal(data['distancia'], normalize=False,
-                                      datatype=XSD.double)))
-        if top_key == 'Average Speed Section':
-            graph.add((observation,
-                       self._uri_ref('', 'average_speed'),
-                       rdflib.Literal(data['value'])))
-        elif top_key == 'Standard Deviation of Vehicle Speed Section':
-            graph.add((observation,
-                       self._uri_ref('', 'deviation_speed'),
-                       rdflib.Literal(data['value'])))
-        elif top_key == 'Inefficient Speed Section':
-            graph.add((observation,
-                       self._uri_ref('', 'inefficient_speed'),
-                       rdflib.Literal(data['value'])))
-        elif top_key == 'Heart Rate Section':
-            graph.add((observation,
-                       self._uri_ref('', 'normal_bpm'),
-                       rdflib.Literal(data['value'])))
-        elif top_key == 'High Heart Rate':
-            graph.add((observation,
-                       self._uri_ref('', 'unexpected_bpm'),
-                       rdflib.Literal(data['value'])))
-        elif top_key == 'Standard Deviation Heart Rate Section':
-            graph.add((observation,
-                       self._uri_ref('', 'deviation_bpm'),
-                       rdflib.Literal(data['value'])))
-        elif top_key == 'Stops Section':
-            graph.add((observation,
-                       self._uri_ref('', 'stops'),
-                       rdflib.Literal(int(data['value']))))
-        elif top_key == 'Positive Kinetic Energy':
-            graph.add((observation,
-                       self._uri_ref('', 'positive_kinetic_energy'),
-                       rdflib.Literal(data['value'])))
-        elif (top_key == 'High Acceleration'
-            or top_key == 'High Deceleration'):
-            graph.add((observation,
-                       self._uri_ref('', 'acceleration'),
-                       rdflib.Literal(data['value'])))
-        else:
-            raise ValueError('Unhandled key: ' + top_key)
+        emitter(graph,
+                rdflib.URIRef(self.ns_hermes + 'Id-Observation-'
+                              + event.event_id),
+                self._user_uri(event.source_id),
+                event.timestamp,
+                event.body[top_key])
         return [self._create_event(event, graph)]
 
+    def _compile_driver_rule(self, rule):
+        """Returns a function that adds the triples of a driver event.
+
+        All the terms that do not depend on the event are resolved
+        here, so that the function just adds triples to the graph.
+
+        """
+        type_ = rdflib.RDF.type
+        class_ = self._uri_ref('', rule.class_)
+        happens_at_timestamp = self._uri_ref('', 'happens_at_timestamp')
+        has_driver = self._uri_ref('', 'has_driver')
+        orientation = self._uri_ref('', 'orientation')
+        has_location = self._uri_ref('', 'has_location')
+        spatial_thing = self._uri_ref('geo', 'SpatialThing')
+        lat = self._uri_ref('geo', 'lat')
+        long_ = self._uri_ref('geo', 'long')
+        completed_distance = self._uri_ref('', 'completed_distance')
+        value_property = self._uri_ref('', rule.value_property)
+        convert = rule.convert
+        Literal = rdflib.Literal
+        BNode = rdflib.BNode
+        xsd_timestamp = XSD.timestamp
+        xsd_double = XSD.double
+
+        def emit(graph, observation, user, timestamp, data):
+            add = graph.add
+            add((observation, type_, class_))
+            add((observation, happens_at_timestamp,
+                 Literal(timestamp, datatype=xsd_timestamp)))
+            add((observation, has_driver, user))
+            add((observation, orientation, Literal(data['orientation'])))
+            location = BNode()
+            add((observation, has_location, location))
+            add((location, type_, spatial_thing))
+            add((location, lat, Literal(data['latitude'])))
+            add((location, long_, Literal(data['longitude'])))
+            if 'distancia' in data:
+                add((observation, completed_distance,
+                     Literal(data['distancia'], normalize=False,
+                             datatype=xsd_double)))
+            if convert is None:
+                add((observation, value_property, Literal(data['value'])))
+            else:
+                add((observation, value_property,
+                     Literal(convert(data['value']))))
+        return emit
+
+    def _user_uri(self, user_id):
+        try:
+            return self.user_uris[user_id]
+        except KeyError:
+            uri = rdflib.URIRef(self.ns_hermes + 'Id-User-' + user_id)
+            self.user_uris[user_id] = uri
+            return uri
+
     def annotate_event_steps(self, event):
         if (not isinstance(event, ztreamy.events.JSONEvent)
             or len(event.body.keys()) != 1):
@@ -255,7 +413,7 @@ class HermesAnnotator(GenericAnnotator):
                            self._uri_ref('', 'Stepping')))
                 graph.add((observation,
                            self._uri_ref('', 'has_pedestrian'),
-                           self._uri_ref('Id-User', event.source_id)))
+                           self._user_uri(event.source_id)))
                 graph.add((observation,
                            self._uri_ref('', 'stepping_date'),
                            rdflib.Literal(_to_xsd_date(data['dateTime']),
@@ -297,7 +455,7 @@ class HermesAnnotator(GenericAnnotator):
                            self._uri_ref('', 'Heart_Frequency')))
                 graph.add((observation,
                            self._uri_ref('', 'has_pedestrian'),
-                           self._uri_ref('Id-User', event.source_id)))
+                           self._user_uri(event.source_id)))
                 graph.add((observation,
                            self._uri_ref('', 'heart_date'),
                            rdflib.Literal(_to_xsd_date(data['dateTime']),
@@ -339,7 +497,7 @@ class HermesAnnotator(GenericAnnotator):
                            self._uri_ref('', 'Sleep')))
                 graph.add((observation,
                            self._uri_ref('', 'has_user'),
-                           self._uri_ref('Id-User', event.source_id)))
+                           self._user_uri(event.source_id)))
                 graph.add((observation,
                            self._uri_ref('', 'awakenings'),
                            rdflib.Literal(data['awakenings'])))
@@ -369,6 +527,219 @@ class HermesAnnotator(GenericAnnotator):
             return [self._create_event(event, graph)]
 
 
+class HermesTemplateAnnotator(HermesAnnotator):
+    """Annotator that writes its output without building rdflib graphs.
+
+    It produces the same RDF graphs as `HermesAnnotator`, but
+    describes them with `rdftext.Node` objects that are written
+    directly by the serializer of the output format, which is much
+    faster. Events whose identifiers cannot be written as IRIs
+    are annotated through the rdflib-based methods of the parent
+    class.
+
+    """
+    def __init__(self, merge_batches=False, output_format='n3'):
+        super(HermesTemplateAnnotator, self).__init__( \
+                                                merge_batches=merge_batches,
+                                                output_format=output_format)
+        self.user_iris = utils.LatestValueBuffer( \
+                                        generations=1,
+                                        max_entries=self.max_user_uris)
+
+    def annotate_event_driver(self, event):
+        if (not isinstance(event, ztreamy.events.JSONEvent)
+            or len(event.body) != 1):
+            return [event]
+        top_key = next(iter(event.body))
+        rule = self.driver_rules.get(top_key)
+        if rule is None:
+            return [event]
+        try:
+            observation, user = self._event_iris(event)
+        except ValueError:
+            return super(HermesTemplateAnnotator, self)\
+                        .annotate_event_driver(event)
+        data = event.body[top_key]
+        properties = [
+            (rdftext.TYPE, 'hermes:' + rule.class_),
+            ('hermes:happens_at_timestamp',
+             rdftext.Typed(event.timestamp, 'xsd:timestamp')),
+            ('hermes:has_driver', user),
+            ('hermes:orientation', data['orientation']),
+            ('hermes:has_location', rdftext.Node(None, [
+                (rdftext.TYPE, 'geo:SpatialThing'),
+                ('geo:lat', data['latitude']),
+                ('geo:long', data['longitude']),
+            ])),
+        ]
+        if 'distancia' in data:
+            properties.append(('hermes:completed_distance',
+                               rdftext.Typed(unicode(data['distancia']),
+                                             'xsd:double')))
+        if rule.convert is None:
+            value = data['value']
+        else:
+            value = rule.convert(data['value'])
+        properties.append(('hermes:' + rule.value_property, value))
+        return [self._create_text_event(event,
+                                [rdftext.Node(observation, properties)])]
+
+    def annotate_event_steps(self, event):
+        if (not isinstance(event, ztreamy.events.JSONEvent)
+            or len(event.body.keys()) != 1):
+            return [event]
+        try:
+            observation, user = self._event_iris(event)
+        except ValueError:
+            return super(HermesTemplateAnnotator, self)\
+                        .annotate_event_steps(event)
+        try:
+            nodes = []
+            for i, data in enumerate(event.body['dataset']):
+                properties = [
+                    (rdftext.TYPE, 'hermes:Stepping'),
+                    ('hermes:has_pedestrian', user),
+                ]
+                for steps_data in data['stepsList']:
+                    properties.append(('hermes:has_step_set',
+                        rdftext.Node(None, [
+                            (rdftext.TYPE, 'hermes:Step_Set'),
+                            ('hermes:stepping_time',
+                             rdftext.Typed(steps_data['timeLog'], 'xsd:time')),
+                            ('hermes:steps', steps_data['steps']),
+                        ])))
+                properties.append(('hermes:stepping_date',
+                        rdftext.Typed(_to_xsd_date(data['dateTime']),
+                                      'xsd:date')))
+                nodes.append(rdftext.Node(self._observation_iri(observation,
+                                                                i),
+                                          properties))
+        except KeyError:
+            return [event]
+        else:
+            return [self._create_text_event(event, nodes)]
+
+    def annotate_event_heart_rate(self, event):
+        if (not isinstance(event, ztreamy.events.JSONEvent)
+            or len(event.body.keys()) != 1):
+            return [event]
+        try:
+            observation, user = self._event_iris(event)
+        except ValueError:
+            return super(HermesTemplateAnnotator, self)\
+                        .annotate_event_heart_rate(event)
+        try:
+            nodes = []
+            for i, data in enumerate(event.body['dataset']):
+                properties = [
+                    (rdftext.TYPE, 'hermes:Heart_Frequency'),
+                    ('hermes:has_pedestrian', user),
+                ]
+                for heart_data in data['heartRateList']:
+                    properties.append(('hermes:has_heart_set',
+                        rdftext.Node(None, [
+                            (rdftext.TYPE, 'hermes:Heart_Set'),
+                            ('hermes:heart_time',
+                             rdftext.Typed(heart_data['timeLog'], 'xsd:time')),
+                            ('hermes:bpm', heart_data['heartRate']),
+                        ])))
+                properties.append(('hermes:heart_date',
+                        rdftext.Typed(_to_xsd_date(data['dateTime']),
+                                      'xsd:date')))
+                nodes.append(rdftext.Node(self._observation_iri(observation,
+                                                                i),
+                                          properties))
+        except KeyError:
+            return [event]
+        else:
+            return [self._create_text_event(event, nodes)]
+
+    def annotate_event_sleep(self, event):
+        if (not isinstance(event, ztreamy.events.JSONEvent)
+            or len(event.body.keys()) != 1):
+            return [event]
+        try:
+            observation, user = self._event_iris(event)
+        except ValueError:
+            return super(HermesTemplateAnnotator, self)\
+                        .annotate_event_sleep(event)
+        try:
+            nodes = []
+            for i, data in enumerate(event.body['dataset']):
+                nodes.append(rdftext.Node( \
+                    self._observation_iri(observation, i), [
+                    (rdftext.TYPE, 'hermes:Sleep'),
+                    ('hermes:has_user', user),
+                    ('hermes:awakenings', data['awakenings']),
+                    ('hermes:minutes_asleep', data['minutesAsleep']),
+                    ('hermes:minutes_in_bed', data['minutesInBed']),
+                    ('hermes:sleeping_date',
+                     rdftext.Typed(_to_xsd_date(data['dateTime']),
+                                   'xsd:date')),
+                    ('hermes:sleeping_start_time',
+                     rdftext.Typed(data['startTime'], 'xsd:time')),
+                    ('hermes:sleeping_end_time',
+                     rdftext.Typed(data['endTime'], 'xsd:time')),
+                ]))
+        except KeyError:
+            return [event]
+        else:
+            return [self._create_text_event(event, nodes)]
+
+    def _event_iris(self, event):
+        """Returns the observation and user IRIs of an event.
+
+        Raises ValueError if they cannot be written as IRIs.
+
+        """
+        observation = HermesAnnotator.ns_hermes \
+                      + 'Id-Observation-' + event.event_id
+        # Check that it is valid
+        rdftext.iri(observation)
+        return observation, self._user_iri(event.source_id)
+
+    def _user_iri(self, user_id):
+        try:
+            return self.user_iris[user_id]
+        except KeyError:
+            user = HermesAnnotator.ns_hermes + 'Id-User-' + user_id
+            rdftext.iri(user)
+            user = rdftext.IRI(user)
+            self.user_iris[user_id] = user
+            return user
+
+    @staticmethod
+    def _observation_iri(observation, index):
+        return '{}-{}'.format(observation, index)
+
+
+class RDFTextEvent(ztreamy.events.Event):
+    """RDF event whose body is already serialized.
+
+    The body is a UTF-8 encoded str in the syntax of the event
+    (N3, N-Triples or JSON-LD). It is parsed with rdflib only when
+    a JSON-LD representation is requested from other syntaxes.
+
+    """
+    rdflib_formats = {
+        'text/n3': 'n3',
+        'application/n-triples': 'nt',
+    }
+
+    def serialize_body(self):
+        return self.body
+
+    def syntax_as_json(self):
+        return ztreamy.json_ld_media_type
+
+    def body_as_json(self):
+        if self.syntax == ztreamy.json_ld_media_type:
+            return json.loads(self.body)
+        graph = rdflib.Graph()
+        graph.parse(data=self.body, format=self.rdflib_formats[self.syntax])
+        return json.loads(graph.serialize(format='json-ld'))
+
+
 class AnnotatedStream(ztreamy.server.Stream):
     def __init__(self, path, annotator, **kwargs):
         kwargs['event_adapter'] = annotator.annotate_events
@@ -377,11 +748,128 @@ class AnnotatedStream(ztreamy.server.Stream):
 
 
 class AnnotatedRelayStream(ztreamy.server.RelayStream):
-    def __init__(self, path, streams, annotator, **kwargs):
-        kwargs['event_adapter'] = annotator.annotate_events
+    def __init__(self, path, streams, annotator, num_workers=0,
+                 max_pending_batches=None, **kwargs):
+        """Creates a relay stream that annotates the events it relays.
+
+        If `num_workers` is greater than zero, batches of events are
+        annotated by a pool of worker processes instead of in
+        the IOLoop. Each worker creates its own annotator by calling
+        the class of `annotator` with its `worker_options`. Annotated
+        batches are relayed in the same order they were received.
+        If the annotator merges batches, merging is done in this
+        process when the batch comes back from its worker.
+        If a worker fails to annotate a batch, its events are annotated
+        one at a time in this process, and only the events that fail
+        again are discarded.
+
+        At most `max_pending_batches` batches (by default, twice
+        the number of workers) are annotated at the same time.
+        When that limit is reached, the IOLoop waits for the oldest
+        batch before accepting more events from the source streams.
+
+        """
+        if num_workers > 0:
+            kwargs['event_adapter'] = None
+            self.pool = multiprocessing.Pool( \
+                                    processes=num_workers,
+                                    initializer=_init_annotation_worker,
+                                    initargs=(annotator.__class__,
+                                              annotator.worker_options()))
+            self.max_pending_batches = max_pending_batches or 2 * num_workers
+        else:
+            kwargs['event_adapter'] = annotator.annotate_events
+            self.pool = None
+        self.annotator = annotator
+        self.pending_batches = collections.deque()
         kwargs['parse_event_body'] = True
         super(AnnotatedRelayStream, self).__init__(path, streams, **kwargs)
 
+    def stop(self):
+        if self.pool is not None:
+            while self.pending_batches:
+                self.pending_batches[0][1].wait()
+                self._dispatch_annotated()
+            self.pool.terminate()
+        super(AnnotatedRelayStream, self).stop()
+
+    def dispatch_events(self, evs):
+        if self.pool is None:
+            return super(AnnotatedRelayStream, self).dispatch_events(evs)
+        accepted_events = []
+        for e in evs:
+            if (not self.event_buffer.is_duplicate(e)
+                and not self.dispatcher.is_duplicate(e)):
+                e.aggregator_id.append(self.source_id)
+                accepted_events.append(e)
+        if accepted_events:
+            if len(self.pending_batches) >= self.max_pending_batches:
+                self.pending_batches[0][1].wait()
+                self._dispatch_annotated()
+            self.pending_batches.append((accepted_events,
+                                         self.pool.apply_async( \
+                                            _annotate_in_worker,
+                                            (accepted_events, ),
+                                            callback=self._batch_annotated)))
+        return accepted_events
+
+    def _batch_annotated(self, evs):
+        # Called from a thread of the pool
+        self.ioloop.add_callback(self._dispatch_annotated)
+
+    def _dispatch_annotated(self):
+        # Dispatch the batches that are ready, preserving their order
+        while self.pending_batches and self.pending_batches[0][1].ready():
+            evs = self._annotated_batch(*self.pending_batches.popleft())
+            if self.annotator.merge_batches:
+                evs = self.annotator.merge_annotated(evs)
+            self.dispatcher.dispatch_immediate(evs)
+            if self.buffering_time is None:
+                self.dispatcher.dispatch(evs)
+            else:
+                self.event_buffer.add_events(evs)
+
+    def _annotated_batch(self, evs, result):
+        try:
+            annotated = result.get()
+        except Exception:
+            annotated = _AnnotationFailure(traceback.format_exc())
+        if isinstance(annotated, _AnnotationFailure):
+            logging.error('Error while annotating a batch in a worker; '
+                          'annotating its events one at a time:\n{}'\
+                          .format(annotated.message))
+            annotated = []
+            for event in evs:
+                try:
+                    annotated.extend(self.annotator.annotate_event(event))
+                except Exception:
+                    logging.exception('Discard event {}: annotation error'\
+                                      .format(event.event_id))
+        return annotated
+
+
+class _AnnotationFailure(object):
+    """Returned by a worker that could not annotate a batch."""
+    def __init__(self, message):
+        self.message = message
+
+
+_worker_annotator = None
+
+def _init_annotation_worker(annotator_class, options):
+    global _worker_annotator
+    # Let the parent process handle Ctrl-C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _worker_annotator = annotator_class(**options)
+
+def _annotate_in_worker(evs):
+    try:
+        return _worker_annotator.annotate_events(evs)
+    except Exception:
+        # Exceptions are not raised through the pool,
+        # because its callback is called only on success
+        return _AnnotationFailure(traceback.format_exc())
+
 
 def _to_xsd_date(date):
     """Converts a date DD/MM/YYYY to xsd:date (YYYY-MM-DD)."""
@@ -391,3 +879,4 @@ def _to_xsd_date(date):
         raise ValueError('Wrong date format')
 
 _re_hermes_date = re.compile(r'^(\d\d)/(\d\d)/(\d\d\d\d)$')
+_re_non_alphanumeric = re.compile(r'[^A-Za-z0-9]')
@@ -13,9 +13,30 @@ def main():
                            type=float)
     tornado.options.define('preload', default=None,
                            help='preload events from file')
+    tornado.options.define('rdflib_annotator', default=False,
+                           help='build annotations with rdflib graphs '
+                                'instead of N3 templates',
+                           type=bool)
+    tornado.options.define('output_format', default='n3',
+                           help='serialization of the annotated events '
+                                '(n3, ntriples or json-ld)')
+    tornado.options.define('merge_batches', default=False,
+                           help='merge the annotations of each batch '
+                                'into one event',
+                           type=bool)
+    tornado.options.define('workers', default=0,
+                           help='number of annotation worker processes '
+                                '(0 annotates in the main process)',
+                           type=int)
+    tornado.options.define('max_pending', default=None,
+                           help='maximum number of batches being annotated '
+                                'by the workers (default: 2 * workers)',
+                           type=int)
     tornado.options.parse_command_line()
     port = tornado.options.options.port
     preload_file = tornado.options.options.preload
+    num_workers = tornado.options.options.workers
+    max_pending = tornado.options.options.max_pending
     if (tornado.options.options.buffer is not None
         and tornado.options.options.buffer > 0):
         buffering_time = tornado.options.options.buffer * 1000
@@ -23,11 +44,21 @@ def main():
         buffering_time = None
     src_stream_uri = 'http://localhost:9100/collector/priority'
     server = ztreamy.StreamServer(port)
-    annotator = annotate.HermesAnnotator()
+    merge_batches = tornado.options.options.merge_batches
+    output_format = tornado.options.options.output_format
+    if tornado.options.options.rdflib_annotator:
+        annotator = annotate.HermesAnnotator(merge_batches=merge_batches,
+                                             output_format=output_format)
+    else:
+        annotator = annotate.HermesTemplateAnnotator( \
+                                            merge_batches=merge_batches,
+                                            output_format=output_format)
     annotated_stream = annotate.AnnotatedRelayStream( \
                                             'annotated',
                                             [src_stream_uri],
                                             annotator,
+                                            num_workers=num_workers,
+                                            max_pending_batches=max_pending,
                                             buffering_time=buffering_time)
     if preload_file:
         with open(preload_file, 'rb') as f:
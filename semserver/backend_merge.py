@@ -0,0 +1,94 @@
+"""Merges the streams of sharded backends into a single backend stream.
+
+In sharded mode, each frontend routes the events of a source to one
+of several backend processes, depending on the hash of the source id
+(see `collector.backend_shard`). This relay subscribes to the stream
+of every backend and serves them as a single `/backend` stream
+(and its event type streams), so that consumers like the dbfeed
+or the client don't need to know about the shards:
+
+    python -m semserver.backend_server -p 9111 --label backend-1
+    python -m semserver.backend_server -p 9112 --label backend-2
+    python -m semserver.frontend_server -k http://localhost:9111/backend/ \\
+                                        -k http://localhost:9112/backend/
+    python -m semserver.backend_merge -p 9109 \\
+                                      http://localhost:9111/backend/compressed \\
+                                      http://localhost:9112/backend/compressed
+
+The order of the events of each source is kept, because all of them
+go through the same backend.
+
+"""
+from __future__ import unicode_literals, print_function
+
+import argparse
+import datetime
+
+import ztreamy
+
+from . import utils
+from . import backend_server
+from . import subscriptions
+
+
+class MergedBackendStream(ztreamy.RelayStream):
+    def __init__(self, backend_streams, buffering_time, label='backend-merge',
+                 recent_events_bytes=None, **kwargs):
+        super(MergedBackendStream, self).__init__('backend',
+                                backend_streams,
+                                label=label,
+                                num_recent_events=2**16,
+                                buffering_time=buffering_time,
+                                retrieve_missing_events=True,
+                                **kwargs)
+        utils.use_compact_recent_events(self, recent_events_bytes)
+        self.dispatcher = subscriptions.FilteringDispatcher(self.dispatcher,
+                                                            self)
+        self.stats_tracker = utils.StatsTracker(self)
+        self._schedule_next_stats_period()
+
+    def _periodic_stats(self):
+        utils.log_stats_value(self.label, self.stats_tracker.compute_cycle())
+        self._schedule_next_stats_period()
+
+    def _schedule_next_stats_period(self):
+        self.ioloop.add_timeout(datetime.timedelta( \
+                                        seconds=60 - self.ioloop.time() % 60),
+                                self._periodic_stats)
+
+
+def _read_cmd_arguments():
+    parser = argparse.ArgumentParser( \
+                    description='Merge the streams of sharded backends.')
+    utils.add_server_options(parser, 9109, stream=True)
+    parser.add_argument('backends', nargs='+',
+                        help='backend stream URLs')
+    args = parser.parse_args()
+    return args
+
+def main():
+    args = _read_cmd_arguments()
+    if args.buffer > 0:
+        buffering_time = args.buffer * 1000
+    else:
+        buffering_time = None
+    utils.configure_logging('backend-merge-{}'.format(args.port),
+                            level=args.log_level,
+                            disable_stderr=args.disable_stderr)
+    server = ztreamy.StreamServer(args.port)
+    stream = MergedBackendStream(args.backends, buffering_time,
+                                 recent_events_bytes=args.recent_events_bytes)
+    type_relays = backend_server.create_type_relays(stream, buffering_time)
+    server.add_stream(stream)
+    for relay_stream in type_relays.relays.values():
+        server.add_stream(relay_stream)
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -10,26 +10,43 @@ import ztreamy.client
 
 from . import utils
 from . import collector
+from . import subscriptions
 
 
 class BackendStream(ztreamy.Stream):
-    def __init__(self, buffering_time, disable_persistence=False):
+    def __init__(self, buffering_time, disable_persistence=False,
+                 label='backend', recent_events_bytes=None,
+                 event_log_options=None,
+                 dedup_window=utils.DEFAULT_DEDUP_WINDOW,
+                 dedup_max_events=utils.DEFAULT_DEDUP_MAX_EVENTS):
         super(BackendStream, self).__init__('backend',
-                                label='backend',
+                                label=label,
                                 num_recent_events=2**16,
-                                persist_events=not disable_persistence,
                                 parse_event_body=False,
                                 buffering_time=buffering_time,
                                 allow_publish=True)
+        utils.use_compact_recent_events(self, recent_events_bytes)
+        if not disable_persistence:
+            self.event_log = utils.use_event_log(self, 2**16,
+                                                 **(event_log_options or {}))
+        else:
+            self.event_log = None
+        self.dispatcher = subscriptions.FilteringDispatcher(self.dispatcher,
+                                                            self)
         self.timers = [
             ## tornado.ioloop.PeriodicCallback(self._periodic_stats,
             ##                                 60000,
             ##                                 io_loop=self.ioloop),
         ]
+        self.duplicate_filter = utils.DuplicateFilter.create( \
+                                                        dedup_window,
+                                                        dedup_max_events,
+                                                        ioloop=self.ioloop)
+        if self.duplicate_filter is not None:
+            self.timers.append(self.duplicate_filter.timer)
         self.stats_tracker = utils.StatsTracker(self)
         self._schedule_next_stats_period()
 
-
     def start(self):
         super(BackendStream, self).start()
         for timer in self.timers:
@@ -39,6 +56,15 @@ class BackendStream(ztreamy.Stream):
         super(BackendStream, self).stop()
         for timer in self.timers:
             timer.stop()
+        if self.event_log is not None:
+            self.event_log.close()
+
+    def dispatch_events(self, evs):
+        # Apps retry the publications that time out, which may
+        # publish the same event more than once
+        if self.duplicate_filter is not None:
+            evs = self.duplicate_filter.filter_events(evs)
+        return super(BackendStream, self).dispatch_events(evs)
 
     def _roll_latest_locations(self):
         logging.debug('Roll latest locations buffer')
@@ -47,6 +73,8 @@ class BackendStream(ztreamy.Stream):
     def _periodic_stats(self):
         stats = self.stats_tracker.compute_cycle()
         utils.log_stats_value(self.label, stats)
+        if self.duplicate_filter is not None:
+            self.duplicate_filter.log_stats(self.label)
         self._schedule_next_stats_period()
 
     def _schedule_next_stats_period(self):
@@ -58,28 +86,42 @@ class BackendStream(ztreamy.Stream):
 def _read_cmd_arguments():
     parser = argparse.ArgumentParser( \
                     description='Run the HERMES backend stream server.')
-    parser.add_argument('--disable-persistence', dest='disable_persistence',
-                        action='store_true')
-    utils.add_server_options(parser, 9109, stream=True)
+    parser.add_argument('--label', dest='label', default='backend',
+                        help=('Stream label (must be different for each '
+                              'sharded backend)'))
+    utils.add_server_options(parser, 9109, stream=True, persistent=True,
+                             dedup=True)
     args = parser.parse_args()
     return args
 
 
-def _create_stream_server(port, buffering_time, disable_persistence=False):
+def create_type_relays(stream, buffering_time):
+    return collector.EventTypeRelays(stream,
+                                     'SmartDriver',
+                                     ['Vehicle Location',
+                                      'High Speed',
+                                      'High Acceleration',
+                                      'High Deceleration',
+                                      'High Heart Rate',
+                                      'Data Section',
+                                      'Context Data',
+                                     ],
+                                     buffering_time)
+
+def _create_stream_server(port, buffering_time, disable_persistence=False,
+                          label='backend', recent_events_bytes=None,
+                          event_log_options=None,
+                          dedup_window=utils.DEFAULT_DEDUP_WINDOW,
+                          dedup_max_events=utils.DEFAULT_DEDUP_MAX_EVENTS):
     server = ztreamy.StreamServer(port)
     backend_stream = BackendStream(buffering_time,
-                                   disable_persistence=disable_persistence)
-    type_relays = collector.EventTypeRelays(backend_stream,
-                                            'SmartDriver',
-                                            ['Vehicle Location',
-                                            'High Speed',
-                                            'High Acceleration',
-                                            'High Deceleration',
-                                            'High Heart Rate',
-                                            'Data Section',
-                                            'Context Data',
-                                            ],
-                                            buffering_time)
+                                   disable_persistence=disable_persistence,
+                                   label=label,
+                                   recent_events_bytes=recent_events_bytes,
+                                   event_log_options=event_log_options,
+                                   dedup_window=dedup_window,
+                                   dedup_max_events=dedup_max_events)
+    type_relays = create_type_relays(backend_stream, buffering_time)
     server.add_stream(backend_stream)
     for stream in type_relays.relays.values():
         server.add_stream(stream)
@@ -91,13 +133,18 @@ def main():
         buffering_time = args.buffer * 1000
     else:
         buffering_time = None
-    utils.configure_logging('backend-{}'.format(args.port),
+    utils.configure_logging('{}-{}'.format(args.label, args.port),
                             level=args.log_level,
                             disable_stderr=args.disable_stderr)
     server = _create_stream_server( \
                                 args.port,
                                 buffering_time,
-                                disable_persistence=args.disable_persistence)
+                                disable_persistence=args.disable_persistence,
+                                label=args.label,
+                                recent_events_bytes=args.recent_events_bytes,
+                                event_log_options=utils.event_log_options(args),
+                                dedup_window=args.dedup_window,
+                                dedup_max_events=args.dedup_max_events)
     try:
         server.start()
     except KeyboardInterrupt:
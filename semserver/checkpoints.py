@@ -0,0 +1,131 @@
+"""Durable resume points for the consumers of remote streams.
+
+A checkpoint is the id of the last event a consumer has processed
+from a source stream. Checkpoints are stored in a local directory,
+one file per stream URL, and replaced atomically. When the consumer
+is restarted, it asks each stream for the events after its checkpoint
+(the `last-seen` argument of ztreamy), which streams with persistence
+serve from their event log (see `persistence.EventLog`).
+
+Unlike the status files of ztreamy clients, which record the last
+event received, a checkpoint can be saved once the events have been
+processed, so that a restart neither loses nor re-processes them.
+
+"""
+from __future__ import unicode_literals
+
+import base64
+import os
+import os.path
+
+import tornado.ioloop
+import ztreamy.client
+
+
+class CheckpointStore(object):
+    def __init__(self, directory, fsync=True):
+        """Opens the checkpoints stored in `directory`.
+
+        The directory is created if it doesn't exist. If `fsync`
+        is True, checkpoints are synced to disk when saved.
+
+        """
+        self.directory = directory
+        self.fsync = fsync
+        self.saved = {}
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get(self, url):
+        """Returns the checkpoint of a stream, or None."""
+        if url not in self.saved:
+            try:
+                with open(self._path(url)) as file_:
+                    self.saved[url] = file_.read().strip() or None
+            except IOError:
+                self.saved[url] = None
+        return self.saved[url]
+
+    def save(self, positions):
+        """Saves a dictionary that maps stream URLs to event ids."""
+        changed = False
+        for url, event_id in positions.items():
+            if event_id is not None and self.get(url) != event_id:
+                self._write(url, event_id)
+                self.saved[url] = event_id
+                changed = True
+        if changed and self.fsync:
+            # Make the renames durable
+            fd = os.open(self.directory, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def _write(self, url, event_id):
+        path = self._path(url)
+        with open(path + '.tmp', 'w') as file_:
+            file_.write(event_id)
+            if self.fsync:
+                file_.flush()
+                os.fsync(file_.fileno())
+        os.rename(path + '.tmp', path)
+
+    def _path(self, url):
+        return os.path.join(self.directory,
+                            base64.urlsafe_b64encode(url.encode('utf-8')))
+
+
+class CheckpointedClient(ztreamy.client.Client):
+    """Client for remote streams that resumes from a `CheckpointStore`.
+
+    Each stream is asked for the events after its checkpoint when the
+    client starts. If `auto_save` is True, checkpoints are saved after
+    the event callback returns. Otherwise, the consumer saves the
+    `positions()` it has processed.
+
+    """
+    def __init__(self, stream_urls, event_callback, checkpoints,
+                 auto_save=False, error_callback=None,
+                 source_finish_callback=None, ioloop=None,
+                 parse_event_body=True, separate_events=True,
+                 disable_compression=False):
+        # The constructor of the parent class is not called because
+        # it would create clients that use ztreamy's status files
+        self.clients = [_CheckpointedStreamingClient( \
+                            url, checkpoints, auto_save,
+                            event_callback=event_callback,
+                            error_callback=error_callback,
+                            source_finish_callback=source_finish_callback,
+                            connection_close_callback=\
+                                                self._client_close_callback,
+                            ioloop=ioloop,
+                            parse_event_body=parse_event_body,
+                            separate_events=separate_events,
+                            disable_compression=disable_compression) \
+                        for url in stream_urls]
+        self.ioloop = ioloop or tornado.ioloop.IOLoop.instance()
+        self._closed = False
+        self._looping = False
+        self.active_clients = []
+        self.connection_close_callback = None
+
+    def positions(self):
+        """Returns the id of the last event received from each stream."""
+        return dict((client.url, client.last_event_id) \
+                    for client in self.clients)
+
+
+class _CheckpointedStreamingClient(ztreamy.client.AsyncStreamingClient):
+    def __init__(self, url, checkpoints, auto_save, **kwargs):
+        super(_CheckpointedStreamingClient, self).__init__(url, **kwargs)
+        self.checkpoints = checkpoints
+        self.auto_save = auto_save
+        # Without a status file, ztreamy keeps the last event id
+        # received in this attribute, and reconnects from it
+        self.last_event_id = checkpoints.get(url)
+
+    def _process_received_data(self, data):
+        super(_CheckpointedStreamingClient, self)._process_received_data(data)
+        if self.auto_save:
+            self.checkpoints.save({self.url: self.last_event_id})
@@ -5,6 +5,8 @@ import tornado.options
 
 import ztreamy.client
 
+from . import checkpoints
+
 
 class EventHandler(object):
     def __init__(self, filename):
@@ -58,14 +60,25 @@ def main():
     stream_urls = options.stream_urls
     filename = tornado.options.options.filename
     handler = EventHandler(filename)
-    client = ztreamy.client.Client( \
-                stream_urls,
-                separate_events=False,
-                event_callback=handler.handle_events,
-                error_callback=handler.handle_error,
-                disable_compression=disable_compression,
-                label=client_label,
-                retrieve_missing_events=retrieve_missing_events)
+    if retrieve_missing_events:
+        # Resume after the last event written to the file
+        client = checkpoints.CheckpointedClient( \
+                    stream_urls,
+                    handler.handle_events,
+                    checkpoints.CheckpointStore( \
+                                '{}-checkpoints'.format(client_label)),
+                    auto_save=True,
+                    separate_events=False,
+                    error_callback=handler.handle_error,
+                    disable_compression=disable_compression)
+    else:
+        client = ztreamy.client.Client( \
+                    stream_urls,
+                    separate_events=False,
+                    event_callback=handler.handle_events,
+                    error_callback=handler.handle_error,
+                    disable_compression=disable_compression,
+                    label=client_label)
     try:
         client.start(loop=True)
     except KeyboardInterrupt:
@@ -1,26 +1,40 @@
 from __future__ import unicode_literals, print_function
 
 import argparse
+import collections
 import json
 import logging
 import datetime
+import os.path
+import time
+import zlib
 
 import tornado.web
 import tornado.gen
 import tornado.httpclient
 import tornado.httputil
+import tornado.websocket
 import ztreamy
+import ztreamy.events
 import ztreamy.server
 import ztreamy.client
 
 from . import utils
 from . import feedback
 from . import locations
+from . import rawevents
+from . import eventsbuffer
+from . import spill
+from . import subscriptions
+from . import lanes
 
 
 DEFAULT_ROAD_INFO_URL = ('http://cronos.lbd.org.es'
                          '/hermes/api/smartdriver/network/link')
 DEFAULT_SCORE_INFO_URL = 'http://localhost:9101/driver_scores'
+DEFAULT_SCORES_CACHE_TTL = 5.0
+BACKEND_RELAY_QUEUE_SIZE = 10000
+MAX_PARSED_BODY_SIZE = 16384
 
 
 class CollectorStream(ztreamy.Stream):
@@ -36,6 +50,14 @@ class CollectorStream(ztreamy.Stream):
                  backend_stream=None,
                  score_info_url=DEFAULT_SCORE_INFO_URL,
                  road_info_url=DEFAULT_SCORE_INFO_URL,
+                 scores_cache_ttl=DEFAULT_SCORES_CACHE_TTL,
+                 binary_scores=False,
+                 raw_bodies=False,
+                 relay_queue_size=BACKEND_RELAY_QUEUE_SIZE,
+                 spill_dir=None,
+                 recent_events_bytes=None,
+                 priority_lanes=None,
+                 max_parsed_body_size=MAX_PARSED_BODY_SIZE,
                  log_event_time=None):
         super(CollectorStream, self).__init__('collector',
                                 label=label,
@@ -46,11 +68,18 @@ class CollectorStream(ztreamy.Stream):
                                 allow_publish=True,
                                 custom_publish_handler=PublishRequestHandler,
                                 ioloop=ioloop)
+        if disable_persistence:
+            utils.use_compact_recent_events(self, recent_events_bytes)
+        self.dispatcher = subscriptions.FilteringDispatcher(self.dispatcher,
+                                                            self)
         self.latest_locations = LatestLocationsBuffer(self.THRESHOLD_DISTANCE)
         self.timers = [
             tornado.ioloop.PeriodicCallback(self._roll_latest_locations,
                                             self.ROLL_LOCATIONS_PERIOD,
                                             io_loop=self.ioloop),
+            tornado.ioloop.PeriodicCallback(self._purge_scores_cache,
+                                            self.ROLL_LOCATIONS_PERIOD,
+                                            io_loop=self.ioloop),
             ## tornado.ioloop.PeriodicCallback(self._periodic_stats,
             ##                                 60000,
             ##                                 io_loop=self.ioloop),
@@ -59,35 +88,134 @@ class CollectorStream(ztreamy.Stream):
         self.disable_road_info = disable_road_info
         self.score_info_url = score_info_url
         self.road_info_url = road_info_url
+        self.binary_scores = binary_scores
+        self.raw_bodies = raw_bodies
+        self.max_parsed_body_size = max_parsed_body_size
+        if priority_lanes:
+            self.lanes = lanes.PriorityLanes(self, priority_lanes)
+            self.deferred_events = self.lanes.bulk_events
+        else:
+            self.lanes = None
+            self.deferred_events = frozenset()
+        if scores_cache_ttl:
+            self.scores_cache = ScoresCache(scores_cache_ttl)
+        else:
+            self.scores_cache = None
         self.stats_tracker = utils.StatsTracker(self)
         self.events_tracker = utils.EventsTracker.create(log_event_time, self)
         if backend_stream:
-            self.backend_relay = BackendStreamRelay(self, backend_stream, 0.1,
-                                                    ioloop=self.ioloop)
+            if not spill_dir:
+                raise ValueError('A spill directory is needed for relaying '
+                                 'events to the backend stream')
+            self.backend_relay = BackendStreamRelay( \
+                                    self, backend_stream, 0.1, spill_dir,
+                                    max_queued_events=relay_queue_size,
+                                    ioloop=self.ioloop)
         else:
             self.backend_relay = None
         self._schedule_next_stats_period()
 
     def start(self):
         super(CollectorStream, self).start()
+        if self.lanes is not None:
+            self.lanes.start()
         if self.backend_relay is not None:
             self.backend_relay.start()
         for timer in self.timers:
             timer.start()
 
     def stop(self):
+        if self.lanes is not None:
+            self.lanes.stop()
         if self.backend_relay is not None:
             self.backend_relay.stop()
         for timer in self.timers:
             timer.stop()
         super(CollectorStream, self).stop()
 
+    def create_deserializer(self):
+        """Returns a deserializer for the events published to the stream.
+
+        Unparsed JSON bodies are checked when the events are relayed
+        to the backend, which would reject the whole relayed chunk
+        because of a malformed body.
+
+        """
+        check_json = self.backend_relay is not None
+        if self.raw_bodies:
+            return rawevents.RawBodyDeserializer( \
+                                    PublishRequestHandler.PARSED_EVENTS,
+                                    check_json=check_json)
+        elif self.deferred_events or self.max_parsed_body_size:
+            # Parse the bodies of bulk events and large bodies
+            # only if a client needs them
+            return rawevents.DeferredBodyDeserializer( \
+                            self.deferred_events,
+                            max_body_size=self.max_parsed_body_size,
+                            parsed_events=PublishRequestHandler.PARSED_EVENTS,
+                            check_json=check_json)
+        else:
+            return ztreamy.events.Deserializer()
+
+    def dispatch_events(self, evs):
+        if self.lanes is None:
+            return super(CollectorStream, self).dispatch_events(evs)
+        accepted, rest = self.lanes.dispatch_events(evs)
+        if rest:
+            accepted.extend(self._dispatch_buffered(rest))
+            # Keep the order in which the events were published
+            accepted_ids = set(id(event) for event in accepted)
+            accepted = [event for event in evs if id(event) in accepted_ids]
+        # Priority and local clients (e.g. the backend relay) receive
+        # the whole batch at once, in publication order
+        self.dispatcher.dispatch_immediate(accepted)
+        return accepted
+
+    def _dispatch_buffered(self, evs):
+        """Dispatches the events with the buffering of the stream.
+
+        Like `ztreamy.server.Stream.dispatch_events`, except that
+        the events are not dispatched to the priority and local clients.
+
+        """
+        accepted_events = []
+        for e in evs:
+            if (not self.event_buffer.is_duplicate(e)
+                and not self.dispatcher.is_duplicate(e)):
+                e.aggregator_id.append(self.source_id)
+                accepted_events.append(e)
+        if self.buffering_time is None:
+            self.dispatcher.dispatch(accepted_events)
+        else:
+            self.event_buffer.add_events(accepted_events)
+        return accepted_events
+
     def _roll_latest_locations(self):
         logging.debug('Roll latest locations buffer')
         self.latest_locations.roll()
 
+    def _purge_scores_cache(self):
+        if self.scores_cache is not None:
+            self.scores_cache.purge()
+
     def _periodic_stats(self):
         utils.log_stats_value(self.label, self.stats_tracker.compute_cycle())
+        utils.log_buffer_stats(self.label + ' latest locations',
+                               self.latest_locations)
+        if self.backend_relay is not None:
+            self.backend_relay.log_stats(self.label + ' backend relay')
+        if self.lanes is not None:
+            self.lanes.log_stats(self.label)
+        if self.scores_cache is not None:
+            hits, misses = self.scores_cache.reset_counters()
+            if hits + misses > 0:
+                ratio = float(hits) / (hits + misses)
+            else:
+                ratio = 0.0
+            logging.info('{}: scores cache {} h / {} m / {:.03f} ratio '
+                         '/ {} cells'\
+                         .format(self.label, hits, misses, ratio,
+                                 len(self.scores_cache)))
         self.events_tracker.log()
         self._schedule_next_stats_period()
 
@@ -98,56 +226,181 @@ class CollectorStream(ztreamy.Stream):
 
 
 class BackendStreamRelay(ztreamy.LocalClient):
-    def __init__(self, stream, backend_stream_url, buffering_time,
-                 ioloop=None):
+    """Relays the events of a stream to the backend stream.
+
+    `backend_stream_urls` is either a URL or a list of URLs
+    of sharded backend streams. In the latter case, events are
+    routed by their source id (see `backend_shard`).
+
+    The publisher of each backend receives new events only while
+    it has less than `MAX_PUBLISHER_EVENTS` pending events. The rest
+    of them wait in a buffer that keeps up to `max_queued_events`
+    in memory and spills to `spill_dir` when the backend is slow
+    or down. Events still pending when the relay is stopped are also
+    written there, and sent when the next relay for the same
+    directory starts.
+
+    """
+    MAX_PUBLISHER_EVENTS = 1000
+    FEED_PERIOD = 100 # milliseconds
+
+    def __init__(self, stream, backend_stream_urls, buffering_time, spill_dir,
+                 max_queued_events=BACKEND_RELAY_QUEUE_SIZE, ioloop=None):
         super(BackendStreamRelay, self).__init__(stream,
                                                  self.process_events,
                                                  separate_events=False)
-        self.publisher = ztreamy.client.ContinuousEventPublisher( \
-                                    backend_stream_url,
-                                    buffering_time=buffering_time,
+        if isinstance(backend_stream_urls, basestring):
+            backend_stream_urls = [backend_stream_urls]
+        spill_dir = os.path.abspath(spill_dir)
+        logging.info('Backend relay spill directory: {}'.format(spill_dir))
+        self.shards = []
+        for i, url in enumerate(backend_stream_urls):
+            if len(backend_stream_urls) > 1:
+                shard_spill_dir = os.path.join(spill_dir, 'shard-{}'.format(i))
+            else:
+                shard_spill_dir = spill_dir
+            self.shards.append(_BackendShard(url, buffering_time,
+                                             shard_spill_dir,
+                                             max_queued_events, ioloop))
+        self.feed_timer = tornado.ioloop.PeriodicCallback( \
+                                    self._feed_publishers,
+                                    self.FEED_PERIOD,
                                     io_loop=ioloop)
-        logging.info('Connected to backend stream {}'
-                     .format(backend_stream_url))
 
     def process_events(self, events):
-        self.publisher.publish_events(events)
+        if len(self.shards) == 1:
+            self.shards[0].queue.append(events)
+        else:
+            shard_events = [[] for _ in self.shards]
+            for event in events:
+                shard_events[backend_shard(event.source_id,
+                                           len(self.shards))].append(event)
+            for shard, evs in zip(self.shards, shard_events):
+                if evs:
+                    shard.queue.append(evs)
+        self._feed_publishers()
 
     def start(self):
         super(BackendStreamRelay, self).start()
-        self.publisher.start()
+        for shard in self.shards:
+            shard.publisher.start()
+        self.feed_timer.start()
 
     def stop(self):
         super(BackendStreamRelay, self).stop()
+        self.feed_timer.stop()
+        for shard in self.shards:
+            shard.stop()
+
+    def log_stats(self, label):
+        for i, shard in enumerate(self.shards):
+            if len(self.shards) > 1:
+                shard.log_stats('{} {}'.format(label, i))
+            else:
+                shard.log_stats(label)
+
+    def _feed_publishers(self):
+        for shard in self.shards:
+            shard.feed_publisher(self.MAX_PUBLISHER_EVENTS)
+
+
+class _BackendShard(object):
+    def __init__(self, backend_stream_url, buffering_time, spill_dir,
+                 max_queued_events, ioloop):
+        self.publisher = ztreamy.client.ContinuousEventPublisher( \
+                                    backend_stream_url,
+                                    buffering_time=buffering_time,
+                                    io_loop=ioloop)
+        self.queue = spill.SpillBuffer(spill_dir,
+                                       max_events=max_queued_events)
+        logging.info('Connected to backend stream {}'
+                     .format(backend_stream_url))
+
+    def feed_publisher(self, max_pending_events):
+        room = max_pending_events - len(self.publisher.pending_events)
+        while room > 0:
+            evs = self.queue.pop(room)
+            if not evs:
+                break
+            self.publisher.publish_events(evs)
+            room -= len(evs)
+
+    def stop(self):
         self.publisher.stop()
+        self.queue.close(head_events=self.publisher.pending_events)
+        self.publisher.pending_events = []
+
+    def log_stats(self, label):
+        logging.info('{}: {} queued / {} pending / {} bytes spilled / '
+                     '{} bytes on disk'\
+                     .format(label, len(self.queue),
+                             len(self.publisher.pending_events),
+                             self.queue.spilled_bytes, self.queue.disk_bytes))
+        self.queue.spilled_bytes = 0
+
+
+def backend_shard(source_id, num_shards):
+    """Returns the index of the backend shard for a source id.
+
+    The hash is stable across processes, so that every frontend
+    sends the events of a source to the same backend.
+
+    """
+    return (zlib.crc32(source_id.encode('utf-8')) & 0xffffffff) % num_shards
 
 
 class EventTypeRelays(ztreamy.LocalClient):
+    """Relays the events of each event type to its own stream.
+
+    The events are serialized once and their serialization is shared
+    by the main stream, the relay streams and their clients.
+
+    """
     def __init__(self, stream, application_id, event_types, buffering_time,
                  ioloop=None):
-        super(EventTypeRelays, self).__init__(stream, self.process_event)
+        super(EventTypeRelays, self).__init__(stream, self.process_events,
+                                              separate_events=False)
         self.application_id = application_id
         self.relays = {}
         for event_type in event_types:
             path = stream.path + '/type/' + event_type.replace(' ', '')
-            self.relays[event_type] = ztreamy.Stream( \
+            self.relays[event_type] = _EventTypeStream( \
                                             path,
                                             buffering_time=buffering_time,
                                             allow_publish=False,
                                             ioloop=ioloop)
 
-    def process_event(self, event):
-        if (event.application_id == self.application_id
-            and event.event_type in self.relays):
-            self.relays[event.event_type].dispatch_event(event)
+    def process_events(self, evs):
+        batches = collections.defaultdict(list)
+        for event in evs:
+            if (event.application_id == self.application_id
+                and event.event_type in self.relays):
+                eventsbuffer.cache_serialization(event)
+                batches[event.event_type].append(event)
+        for event_type, batch in batches.items():
+            self.relays[event_type].dispatch_events(batch)
 
     def start(self):
         super(EventTypeRelays, self).start()
 
 
+class _EventTypeStream(ztreamy.Stream):
+    def dispatch_events(self, evs):
+        # The events were already accepted by the main stream.
+        # They are shared with it, so they must not be modified here.
+        self.dispatcher.dispatch_immediate(evs)
+        if self.buffering_time is None:
+            self.dispatcher.dispatch(evs)
+        else:
+            self.event_buffer.add_events(evs)
+        return evs
+
+
 class PublishRequestHandler(ztreamy.server.EventPublishHandlerAsync):
     TIMEOUT = 5.0
     DISTANCE_THR = 10.0
+    # Events whose body is always parsed, because the handler reads it
+    PARSED_EVENTS = [('SmartDriver', 'Vehicle Location')]
 
     def __init__(self, application, request, **kwargs):
         super(PublishRequestHandler, self).__init__(application,
@@ -155,8 +408,8 @@ class PublishRequestHandler(ztreamy.server.EventPublishHandlerAsync):
                                                     **kwargs)
         if not self.stream.disable_feedback:
             self.set_response_timeout(self.TIMEOUT)
-            self.feedback = feedback.DriverFeedback()
-            self.previous_location = None
+            self.lookup = FeedbackLookup(self.stream, timeout=self.TIMEOUT)
+            self.feedback = self.lookup.feedback
 
     @tornado.web.asynchronous
     def get(self):
@@ -167,21 +420,24 @@ class PublishRequestHandler(ztreamy.server.EventPublishHandlerAsync):
         if self.stream.running:
             events = self.get_and_dispatch_events(finish_request=False)
             self.stream.events_tracker.track_events(events)
-            if (not self.stream.disable_feedback
-                and events
-                and events[0].application_id == 'SmartDriver'
-                and events[0].event_type == 'Vehicle Location'):
-                location = locations.Location( \
-                                    events[0].body['Location']['latitude'],
-                                    events[0].body['Location']['longitude'])
-                score = events[0].body['Location']['score']
-                user_id = events[0].source_id
-                self._request_info(user_id, location, score)
+            location_event, previous_events = feedback_events(events)
+            if not self.stream.disable_feedback and location_event:
+                self._request_info(location_event, previous_events)
             else:
                 self.finish()
         else:
             raise tornado.web.HTTPError(503, 'The stream is stopped')
 
+    def retrieve_events_post(self):
+        try:
+            content_type = self.req_content_type()
+        except ValueError:
+            raise tornado.web.HTTPError(400, 'Bad content type')
+        if content_type != ztreamy.event_media_type:
+            return super(PublishRequestHandler, self).retrieve_events_post()
+        deserializer = self.stream.create_deserializer()
+        return deserializer.deserialize(self.request.body, complete=True)
+
     def on_response_timeout(self):
         # Respond anyway
         if not self.finished:
@@ -202,16 +458,170 @@ class PublishRequestHandler(ztreamy.server.EventPublishHandlerAsync):
             self.finish()
 
     @tornado.gen.coroutine
-    def _request_info(self, user_id, location, score):
+    def _request_info(self, event, previous_events):
+        yield self.lookup.run(event, previous_events=previous_events)
+        self.respond()
+
+
+class WebSocketPublishHandler(tornado.websocket.WebSocketHandler):
+    """Receives events from a driver through a WebSocket connection.
+
+    Each message from the client is a batch of events, serialized
+    in the ztreamy format (binary messages) or in JSON (text messages).
+    For each batch with Vehicle Location events, the feedback for the
+    newest one (see `feedback_events`) is pushed to the client as
+    a JSON text message, unless it is the same as the last one pushed.
+    Feedback whose lookup is overtaken by a newer location of the
+    connection is not pushed.
+
+    Feedback is only pushed in reply to a batch with locations.
+    The scores and road info are looked up for a location and
+    change only when the driver moves (an unchanged location gets
+    USE_PREVIOUS from the collector and the score service), so there
+    is nothing new to push between two locations of the driver.
+
+    """
+    def initialize(self, stream):
+        # The `stream` attribute is used by tornado for the connection
+        self.event_stream = stream
+        self.lookup = None
+        self.last_feedback = None
+
+    def get_compression_options(self):
+        # Enable the per-message deflate extension
+        return {}
+
+    def on_message(self, message):
+        if not self.event_stream.running:
+            self.close(1001, 'The stream is stopped')
+            return
+        try:
+            if isinstance(message, unicode):
+                evs = ztreamy.events.JSONDeserializer().deserialize( \
+                                            message.encode('utf-8'),
+                                            complete=True)
+            else:
+                evs = self.event_stream.create_deserializer().deserialize( \
+                                            message, complete=True)
+        except Exception as e:
+            logging.warning('Bad WebSocket message: {}'.format(e))
+            self.close(1007, 'Bad events')
+            return
+        events = self.event_stream.dispatch_events(evs)
+        self.event_stream.events_tracker.track_events(events)
+        location_event, previous_events = feedback_events(events)
+        if not self.event_stream.disable_feedback and location_event:
+            self._push_feedback(location_event, previous_events)
+
+    def on_close(self):
+        self.lookup = None
+
+    @tornado.gen.coroutine
+    def _push_feedback(self, event, previous_events):
+        lookup = FeedbackLookup(self.event_stream)
+        self.lookup = lookup
+        try:
+            yield tornado.gen.with_timeout( \
+                        datetime.timedelta(seconds=FeedbackLookup.TIMEOUT),
+                        lookup.run(event, previous_events=previous_events),
+                        io_loop=self.event_stream.ioloop)
+        except tornado.gen.TimeoutError:
+            lookup.feedback.timeout()
+            logging.warning('WebSocket feedback timeout: {}/{}'\
+                            .format(lookup.feedback.scores.status,
+                                    lookup.feedback.road_info.status))
+        if lookup is self.lookup:
+            data = utils.serialize_object_json(lookup.feedback)
+            if data != self.last_feedback:
+                try:
+                    self.write_message(data)
+                except tornado.websocket.WebSocketClosedError:
+                    pass
+                else:
+                    self.last_feedback = data
+
+
+def websocket_handlers(stream):
+    """Returns the handlers of the WebSocket endpoints of a stream."""
+    return [tornado.web.URLSpec(stream.path + r'/publish-ws',
+                                WebSocketPublishHandler,
+                                kwargs={'stream': stream})]
+
+def feedback_events(events):
+    """Returns the Vehicle Location events of a batch.
+
+    Returns a tuple with the newest location event, for which the
+    driver expects feedback, and a list with the older location
+    events of the same driver, oldest first. Events are ordered
+    by timestamp and then by their position in the batch. If the batch
+    has no location event, returns (None, []).
+
+    """
+    location_events = sorted([(_event_time(event), i, event) \
+                              for i, event in enumerate(events) \
+                              if event.application_id == 'SmartDriver'
+                              and event.event_type == 'Vehicle Location'])
+    if not location_events:
+        return None, []
+    newest = location_events[-1][2]
+    return newest, [event for _, _, event in location_events[:-1] \
+                    if event.source_id == newest.source_id]
+
+def _event_time(event):
+    try:
+        return ztreamy.parse_timestamp(event.timestamp)
+    except ztreamy.ZtreamyException:
+        return 0
+
+
+class FeedbackLookup(object):
+    """Collects the feedback for a new location of a driver.
+
+    The scores of the drivers around and the road info are requested
+    from their services (or the scores cache), and loaded into the
+    `feedback` attribute (a `feedback.DriverFeedback` object).
+
+    """
+    TIMEOUT = 5.0
+
+    def __init__(self, stream, timeout=TIMEOUT):
+        self.stream = stream
+        self.timeout = timeout
+        self.feedback = feedback.DriverFeedback()
+        self.previous_location = None
+
+    @tornado.gen.coroutine
+    def run(self, event, previous_events=()):
+        """Looks up the feedback for a Vehicle Location event.
+
+        The locations of `previous_events`, older location events
+        of the same driver, are sent to the score service in the
+        same request, so that they also reach the score index.
+
+        """
+        location, score = _location_and_score(event)
+        previous_locations = _valid_locations(previous_events)
+        user_id = event.source_id
+        previous = self.stream.latest_locations.get(user_id)
         if self.stream.latest_locations.check(user_id, location):
-            yield self._request_scores(user_id, location, score)
+            if (self.stream.scores_cache is not None
+                and self.stream.scores_cache.load(location, user_id,
+                                                  self.feedback.scores)):
+                self.previous_location = previous
+                self._insert_score(user_id, location, score,
+                                   previous_locations)
+            else:
+                yield self._request_scores(user_id, location, score,
+                                           previous_locations)
             if self.previous_location is not None:
                 yield self._request_road_info(location, self.previous_location)
             else:
                 self.feedback.road_info.no_data(self.feedback.scores.status)
         else:
             self.feedback.no_data(feedback.Status.USE_PREVIOUS)
-        self.respond()
+            if previous_locations:
+                self._insert_score(user_id, location, score,
+                                   previous_locations)
 
     @tornado.gen.coroutine
     def _request_road_info(self, current_location, previous_location):
@@ -229,7 +639,7 @@ class PublishRequestHandler(ztreamy.server.EventPublishHandlerAsync):
         logging.debug(url)
         client = tornado.httpclient.AsyncHTTPClient()
         request = tornado.httpclient.HTTPRequest(url,
-                                                 request_timeout=self.TIMEOUT)
+                                                 request_timeout=self.timeout)
         try:
             response = yield client.fetch(request)
             if response.code == 200:
@@ -247,7 +657,7 @@ class PublishRequestHandler(ztreamy.server.EventPublishHandlerAsync):
             self.feedback.road_info.no_data(feedback.Status.SERVICE_ERROR)
 
     @tornado.gen.coroutine
-    def _request_scores(self, user_id, location, score):
+    def _request_scores(self, user_id, location, score, previous_locations):
         ## feedback.fake_scores(self.feedback, base=location)
         params = {
             'user': user_id,
@@ -255,28 +665,35 @@ class PublishRequestHandler(ztreamy.server.EventPublishHandlerAsync):
             'longitude': location.long,
             'score': score,
         }
+        if self.stream.scores_cache is not None:
+            # The cache needs the user hashes of the scores
+            params['hashes'] = 1
         url = tornado.httputil.url_concat(self.stream.score_info_url, params)
         logging.debug(url)
         client = tornado.httpclient.AsyncHTTPClient()
-        request = tornado.httpclient.HTTPRequest(url,
-                                                 request_timeout=self.TIMEOUT)
+        if self.stream.binary_scores:
+            headers = {'Accept': feedback.SCORES_BINARY_MEDIA_TYPE}
+        else:
+            headers = {}
+        request = self._score_request(url, previous_locations, headers)
         try:
             response = yield client.fetch(request)
             if response.code == 200:
-                lines = response.body.split('\r\n')
-                if lines:
-                    if lines[0].startswith('#+'):
-                        self.previous_location = \
-                                        locations.Location.parse(lines[0][2:])
-                        self.feedback.scores.load_from_lines(lines[1:])
-                        logging.debug('Received {} scores'\
-                                    .format(len(self.feedback.scores.scores)))
-                    else:
-                        self.feedback.scores.no_data( \
-                                                feedback.Status.USE_PREVIOUS)
-                        if lines[0].startswith('#i'):
-                            self.previous_location = \
-                                        locations.Location.parse(lines[0][2:])
+                media_type = response.headers.get('Content-Type', '')
+                reply = feedback.ScoresReply.parse( \
+                                    response.body,
+                                    media_type=media_type.split(';')[0])
+                if reply.reply_type == feedback.ScoresReply.SCORES:
+                    self.previous_location = reply.previous
+                    self.feedback.scores.load_scores(reply.scores)
+                    if self.stream.scores_cache is not None:
+                        self.stream.scores_cache.store(location, reply.scores)
+                    logging.debug('Received {} scores'\
+                                  .format(len(reply.scores)))
+                else:
+                    self.feedback.scores.no_data(feedback.Status.USE_PREVIOUS)
+                    if reply.previous is not None:
+                        self.previous_location = reply.previous
             else:
                 logging.warning('Error status code in scores request: {}'\
                                 .format(response.code))
@@ -285,6 +702,127 @@ class PublishRequestHandler(ztreamy.server.EventPublishHandlerAsync):
         if self.feedback.scores.status is None:
             self.feedback.scores.no_data(feedback.Status.SERVICE_ERROR)
 
+    def _insert_score(self, user_id, location, score, previous_locations):
+        """Sends the location and score of the user without a lookup.
+
+        The request is not waited for.
+
+        """
+        params = {
+            'user': user_id,
+            'latitude': location.lat,
+            'longitude': location.long,
+            'score': score,
+            'lookup': 0,
+        }
+        url = tornado.httputil.url_concat(self.stream.score_info_url, params)
+        client = tornado.httpclient.AsyncHTTPClient()
+        request = self._score_request(url, previous_locations, {})
+        client.fetch(request, callback=_check_insert_score_response)
+
+    def _score_request(self, url, previous_locations, headers):
+        if previous_locations:
+            # The older locations go in the body (one bulk request)
+            headers['Content-Type'] = feedback.SCORES_TEXT_MEDIA_TYPE
+            return tornado.httpclient.HTTPRequest( \
+                            url,
+                            method='POST',
+                            headers=headers,
+                            body=feedback.serialize_locations( \
+                                                    previous_locations),
+                            request_timeout=self.timeout)
+        else:
+            return tornado.httpclient.HTTPRequest(url,
+                                                  headers=headers,
+                                                  request_timeout=self.timeout)
+
+
+def _location_and_score(event):
+    return (locations.Location(event.body['Location']['latitude'],
+                               event.body['Location']['longitude']),
+            event.body['Location']['score'])
+
+def _valid_locations(events):
+    """Returns the (location, score) pairs of the valid events.
+
+    Malformed events are skipped with a warning, so that they don't
+    prevent the feedback for the newest location of the batch.
+
+    """
+    valid_locations = []
+    for event in events:
+        try:
+            data = event.body['Location']
+            valid_locations.append( \
+                        (locations.Location(float(data['latitude']),
+                                            float(data['longitude'])),
+                         float(data['score'])))
+        except (KeyError, TypeError, ValueError):
+            logging.warning('Skip malformed location event {}'\
+                            .format(event.event_id))
+    return valid_locations
+
+
+class ScoresCache(object):
+    """Short-lived cache of the scores returned by the score service.
+
+    Entries are keyed by geocell (a map tile at a fixed zoom level),
+    so that drivers in the same area share the same list of scores.
+    The score of the driver that loads an entry is left out by its
+    user hash (see `feedback.user_hash`), as the score service does.
+    The hashes are requested from the score service with the `hashes`
+    query argument.
+
+    A driver served from the cache gets the scores with an OK status
+    each time the collector sees a new location (see
+    `LatestLocationsBuffer`), instead of only after moving the long
+    distance of the score service, and the previous location sent
+    to the road info service is the one kept by the collector.
+
+    """
+    def __init__(self, ttl, zoom=17):
+        self.ttl = ttl
+        self.zoom = zoom
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, location, user_id, close_scores):
+        """Loads the cached scores into a CloseScores object.
+
+        Returns True if there was a fresh entry for the location.
+        The score of `user_id` is not loaded.
+
+        """
+        entry = self.entries.get(location.tile(self.zoom))
+        if entry is not None and time.time() - entry[0] < self.ttl:
+            close_scores.status_ok()
+            user_hash = feedback.user_hash(user_id)
+            for score in entry[1]:
+                if score.user_hash != user_hash:
+                    close_scores.add_score(score)
+            self.hits += 1
+            return True
+        else:
+            self.misses += 1
+            return False
+
+    def store(self, location, scores):
+        self.entries[location.tile(self.zoom)] = (time.time(), list(scores))
+
+    def purge(self):
+        limit = time.time() - self.ttl
+        self.entries = {k: v for k, v in self.entries.items() if v[0] >= limit}
+
+    def reset_counters(self):
+        counters = self.hits, self.misses
+        self.hits = 0
+        self.misses = 0
+        return counters
+
+    def __len__(self):
+        return len(self.entries)
+
 
 class LatestLocationsBuffer(utils.LatestValueBuffer):
     def __init__(self, threshold_distance):
@@ -311,6 +849,12 @@ class LatestLocationsBuffer(utils.LatestValueBuffer):
         return answer
 
 
+def _check_insert_score_response(response):
+    if response.error:
+        logging.warning('Error in score insert request: {}'\
+                        .format(response.error))
+
+
 def read_cmd_arguments(default_port=9100, is_frontend_server=False):
     if is_frontend_server:
         default_backend_stream = 'http://localhost:9109/backend/'
@@ -325,20 +869,73 @@ def read_cmd_arguments(default_port=9100, is_frontend_server=False):
     parser.add_argument('--disable-road-info', dest='disable_road_info',
                         action='store_true')
     parser.add_argument('-k', '--backend-stream', dest='backend_stream',
-                        default=default_backend_stream,
-                        help='Backend stream URL')
+                        action='append',
+                        help=('Backend stream URL (repeat it for sharded '
+                              'backends, in the same order in every frontend)'))
     parser.add_argument('-i', '--score-info-url', dest='score_info_url',
                         default=DEFAULT_SCORE_INFO_URL,
                         help='Scores info service URL')
     parser.add_argument('-r', '--road-info-url', dest='road_info_url',
                         default=DEFAULT_ROAD_INFO_URL,
                         help='Road info service URL')
+    parser.add_argument('--scores-cache-ttl', type=float,
+                        dest='scores_cache_ttl',
+                        default=DEFAULT_SCORES_CACHE_TTL,
+                        help=('Time to live in seconds of cached scores '
+                              '(0 disables the cache)'))
+    parser.add_argument('--binary-scores', dest='binary_scores',
+                        action='store_true',
+                        help=('Ask the scores info service for replies '
+                              'in the compact binary format'))
+    parser.add_argument('--relay-queue-size', type=int,
+                        dest='relay_queue_size',
+                        default=BACKEND_RELAY_QUEUE_SIZE,
+                        help=('Events kept in memory while the backend '
+                              'stream is slow or down'))
+    parser.add_argument('--spill-dir', dest='spill_dir', default=None,
+                        help=('Directory for the events that do not fit '
+                              'in memory (required with a backend stream)'))
+    parser.add_argument('--parse-all-bodies', dest='parse_all_bodies',
+                        action='store_true',
+                        help=('Parse the body of every published event, '
+                              'instead of relaying it unchanged '
+                              'to the backend stream'))
+    parser.add_argument('--lane', dest='lanes', action='append',
+                        type=lanes.parse_lane,
+                        help=('Priority lane as '
+                              '"name:seconds:batch_size:app_id[/event_type],'
+                              '..." (repeat it for more lanes)'))
+    parser.add_argument('--bulk-lane', dest='bulk_lanes', action='append',
+                        type=lanes.parse_bulk_lane,
+                        help=('Lane whose event bodies are not parsed '
+                              'at publication, with the format of --lane'))
+    parser.add_argument('--disable-lanes', dest='disable_lanes',
+                        action='store_true',
+                        help='Buffer every event with the stream buffer time')
+    parser.add_argument('--max-parsed-body-size', type=int,
+                        dest='max_parsed_body_size',
+                        default=MAX_PARSED_BODY_SIZE,
+                        help=('Bodies longer than this number of bytes are '
+                              'parsed only if a client needs them '
+                              '(0 for no limit)'))
     parser.add_argument('-l', '--log-event-time', dest='log_event_time',
                         default=None,
                         help=('Log event arrival time ("all", '
                               '"0", "00", "000", etc.'))
     utils.add_server_options(parser, default_port, stream=True)
     args = parser.parse_args()
+    if args.backend_stream is None and default_backend_stream is not None:
+        args.backend_stream = [default_backend_stream]
+    if args.backend_stream and args.spill_dir is None:
+        # A default relative to the working directory could leave
+        # spilled events behind when the server is restarted elsewhere
+        parser.error('--spill-dir is required with a backend stream')
+    if args.disable_lanes:
+        args.lanes = None
+    elif args.lanes or args.bulk_lanes:
+        args.lanes = (args.lanes or []) + (args.bulk_lanes or [])
+    else:
+        args.lanes = lanes.DEFAULT_LANES
     return args
 
 
@@ -348,6 +945,14 @@ def _create_stream_server(port, buffering_time, disable_feedback=False,
                           backend_stream=None,
                           score_info_url=DEFAULT_SCORE_INFO_URL,
                           road_info_url=DEFAULT_ROAD_INFO_URL,
+                          scores_cache_ttl=DEFAULT_SCORES_CACHE_TTL,
+                          binary_scores=False,
+                          parse_all_bodies=False,
+                          relay_queue_size=BACKEND_RELAY_QUEUE_SIZE,
+                          spill_dir=None,
+                          recent_events_bytes=None,
+                          priority_lanes=None,
+                          max_parsed_body_size=MAX_PARSED_BODY_SIZE,
                           log_event_time=None):
     server = ztreamy.StreamServer(port)
     collector_stream = CollectorStream(buffering_time,
@@ -357,6 +962,16 @@ def _create_stream_server(port, buffering_time, disable_feedback=False,
                                        backend_stream=backend_stream,
                                        score_info_url=score_info_url,
                                        road_info_url=road_info_url,
+                                       scores_cache_ttl=scores_cache_ttl,
+                                       binary_scores=binary_scores,
+                                       raw_bodies=(backend_stream is not None
+                                                   and not parse_all_bodies),
+                                       relay_queue_size=relay_queue_size,
+                                       spill_dir=spill_dir,
+                                       recent_events_bytes=recent_events_bytes,
+                                       priority_lanes=priority_lanes,
+                                       max_parsed_body_size=\
+                                                    max_parsed_body_size,
                                        log_event_time=log_event_time)
     if not backend_stream:
         type_relays = EventTypeRelays(collector_stream,
@@ -373,6 +988,7 @@ def _create_stream_server(port, buffering_time, disable_feedback=False,
     else:
         type_relays = None
     server.add_stream(collector_stream)
+    server.add_handlers('.*$', websocket_handlers(collector_stream))
     if type_relays:
         for stream in type_relays.relays.values():
             server.add_stream(stream)
@@ -395,6 +1011,14 @@ def main():
                                 backend_stream=args.backend_stream,
                                 score_info_url=args.score_info_url,
                                 road_info_url=args.road_info_url,
+                                scores_cache_ttl=args.scores_cache_ttl,
+                                binary_scores=args.binary_scores,
+                                parse_all_bodies=args.parse_all_bodies,
+                                relay_queue_size=args.relay_queue_size,
+                                spill_dir=args.spill_dir,
+                                recent_events_bytes=args.recent_events_bytes,
+                                priority_lanes=args.lanes,
+                                max_parsed_body_size=args.max_parsed_body_size,
                                 log_event_time=args.log_event_time)
     ztreamy.client.configure_max_clients(1000)
     try:
@@ -8,20 +8,76 @@ import ztreamy.client
 import ztreamy.tools.utils
 
 from . import utils
+from . import subscriptions
+from . import checkpoints
+
+
+# Events discarded by the dbfeed
+excluded_events = [('SmartDriver', 'Vehicle Location')]
 
 
 class DBFeedStream(ztreamy.RelayStream):
-    def __init__(self, path, streams, log_event_time=None, **kwargs):
+    def __init__(self, path, streams, log_event_time=None,
+                 recent_events_bytes=None, event_log_options=None,
+                 dedup_window=utils.DEFAULT_DEDUP_WINDOW,
+                 dedup_max_events=utils.DEFAULT_DEDUP_MAX_EVENTS,
+                 checkpoint_dir=None, **kwargs):
+        """Creates the dbfeed stream.
+
+        The recent events are logged to disk with `event_log_options`
+        (see `persistence.EventLog`) unless it is None. Events whose
+        id has been relayed in the last `dedup_window` seconds are
+        discarded, which also covers the events retrieved again
+        after reconnecting to the collectors.
+
+        With `retrieve_missing_events`, the position in each collector
+        stream is checkpointed in `checkpoint_dir` (by default
+        `<label>-checkpoints`) once its events have been dispatched
+        and logged, and the stream resumes from there when restarted.
+
+        """
         self.events_tracker = utils.EventsTracker.create(log_event_time, self)
-        super(DBFeedStream, self).__init__(
-                                path, streams,
-                                filter_=TrackingFilter(self.events_tracker),
-                                **kwargs)
+        retrieve_missing_events = kwargs.pop('retrieve_missing_events', False)
+        label = kwargs.pop('label', None)
+        filter_ = TrackingFilter(self.events_tracker)
+        # The label is set afterwards, because the client of the parent
+        # class would create ztreamy status files for it
+        super(DBFeedStream, self).__init__(path, streams, filter_=filter_,
+                                           **kwargs)
+        self.label = label
+        if retrieve_missing_events:
+            self.checkpoints = checkpoints.CheckpointStore( \
+                        checkpoint_dir or '{}-checkpoints'.format(self.label))
+            self.client = checkpoints.CheckpointedClient( \
+                        streams,
+                        filter_.filter_events,
+                        self.checkpoints,
+                        error_callback=self._handle_error,
+                        source_finish_callback=self._handle_source_finish,
+                        ioloop=self.ioloop,
+                        parse_event_body=kwargs.get('parse_event_body', False),
+                        separate_events=False)
+        else:
+            self.checkpoints = None
+        utils.use_compact_recent_events(self, recent_events_bytes)
+        if event_log_options is not None:
+            self.event_log = utils.use_event_log( \
+                                    self,
+                                    kwargs.get('num_recent_events', 2048),
+                                    **event_log_options)
+        else:
+            self.event_log = None
         self.timers = [
             ## tornado.ioloop.PeriodicCallback(self._periodic_stats,
             ##                                 60000,
             ##                                 io_loop=self.ioloop),
         ]
+        self.duplicate_filter = utils.DuplicateFilter.create( \
+                                                        dedup_window,
+                                                        dedup_max_events,
+                                                        ioloop=self.ioloop)
+        if self.duplicate_filter is not None:
+            self.timers.append(self.duplicate_filter.timer)
         self.stats_tracker = utils.StatsTracker(self)
         self._schedule_next_stats_period()
 
@@ -34,9 +90,39 @@ class DBFeedStream(ztreamy.RelayStream):
         super(DBFeedStream, self).stop()
         for timer in self.timers:
             timer.stop()
+        if self.event_log is not None:
+            self.event_log.close()
+
+    def dispatch_events(self, evs):
+        if self.duplicate_filter is not None:
+            evs = self.duplicate_filter.filter_events(evs)
+        accepted = super(DBFeedStream, self).dispatch_events(evs)
+        if self.checkpoints is not None and not self.buffering_time:
+            # The client updates its position after this call returns
+            self.ioloop.add_callback(self._save_checkpoints)
+        return accepted
+
+    def _dump_buffer(self):
+        if self.checkpoints is not None:
+            # Every event received so far is dispatched in this cycle
+            positions = self.client.positions()
+            super(DBFeedStream, self)._dump_buffer()
+            self._save_checkpoints(positions)
+        else:
+            super(DBFeedStream, self)._dump_buffer()
+
+    def _save_checkpoints(self, positions=None):
+        if positions is None:
+            positions = self.client.positions()
+        if self.event_log is not None:
+            self.event_log.after_commit(self.checkpoints.save, positions)
+        else:
+            self.checkpoints.save(positions)
 
     def _periodic_stats(self):
         utils.log_stats_value(self.label, self.stats_tracker.compute_cycle())
+        if self.duplicate_filter is not None:
+            self.duplicate_filter.log_stats(self.label)
         self.events_tracker.log()
         self._schedule_next_stats_period()
 
@@ -55,8 +141,8 @@ class TrackingFilter(ztreamy.Filter):
         self.events_tracker = events_tracker
 
     def filter_event(self, event):
-        if (event.application_id != 'SmartDriver'
-            or event.event_type != 'Vehicle Location'):
+        # Also needed when the server does not support filters
+        if (event.application_id, event.event_type) not in excluded_events:
             self.callback(event)
             self.events_tracker.track_event(event)
 
@@ -64,13 +150,20 @@ class TrackingFilter(ztreamy.Filter):
 def _read_cmd_arguments():
     parser = argparse.ArgumentParser( \
                     description='Run the HERMES dbfeed server.')
-    utils.add_server_options(parser, 9102, stream=True)
-    parser.add_argument('--disable-persistence', dest='disable_persistence',
-                        action='store_true')
+    utils.add_server_options(parser, 9102, stream=True, persistent=True,
+                             dedup=True)
     parser.add_argument('-l', '--log-event-time', dest='log_event_time',
                         default=None,
                         help=('Log event arrival time ("all", '
                               '"0", "00", "000", etc.'))
+    parser.add_argument('--checkpoint-dir', dest='checkpoint_dir',
+                        default=None,
+                        help=('Directory for the positions in the collector '
+                              'streams (default: dbfeed-checkpoints)'))
+    parser.add_argument('--disable-server-filter',
+                        dest='disable_server_filter', action='store_true',
+                        help=('receive also the discarded events '
+                              'from the collectors'))
     parser.add_argument('collectors', nargs='*',
                         default=['http://localhost:9109/backend/compressed'],
                         help='collector/backend stream URLs')
@@ -86,14 +179,24 @@ def main():
     utils.configure_logging('dbfeed-{}'.format(args.port),
                             level=args.log_level,
                             disable_stderr=args.disable_stderr)
+    if args.disable_server_filter:
+        collectors = args.collectors
+    else:
+        collectors = [subscriptions.subscription_url(url,
+                                                     exclude=excluded_events) \
+                      for url in args.collectors]
     server = ztreamy.StreamServer(args.port)
     stream = DBFeedStream('dbfeed',
-                          args.collectors,
+                          collectors,
                           label='dbfeed',
                           num_recent_events=2**17,
-                          persist_events=not args.disable_persistence,
                           buffering_time=buffering_time,
                           retrieve_missing_events=True,
+                          recent_events_bytes=args.recent_events_bytes,
+                          event_log_options=utils.event_log_options(args),
+                          dedup_window=args.dedup_window,
+                          dedup_max_events=args.dedup_max_events,
+                          checkpoint_dir=args.checkpoint_dir,
                           log_event_time=args.log_event_time)
     server.add_stream(stream)
     try:
@@ -0,0 +1,138 @@
+"""Recent-events buffer that stores serialized events.
+
+`CompactEventsBuffer` can replace the `recent_events` buffer of the
+dispatcher of a ztreamy stream. Instead of keeping a fixed number of
+event objects, it copies their serialization into a preallocated
+byte ring and keeps as many events as fit in it. Events are parsed
+again only when a client asks for them (e.g. missing events after
+a reconnection).
+
+"""
+from __future__ import unicode_literals
+
+import collections
+
+from . import rawevents
+
+
+_Entry = collections.namedtuple('_Entry', ('event_id', 'offset', 'length'))
+
+
+class CompactEventsBuffer(object):
+    def __init__(self, max_bytes):
+        self.data = bytearray(max_bytes)
+        self.entries = collections.deque()
+        self.positions = {}
+        self.first_position = 0
+        self.write_offset = 0
+
+    @property
+    def size(self):
+        return len(self.data)
+
+    def append_event(self, event):
+        cache_serialization(event)
+        serialized = event._serialize()
+        length = len(serialized)
+        if length > len(self.data):
+            return
+        offset = self._make_room(length)
+        self.data[offset:offset + length] = serialized
+        self.positions[event.event_id] = self.first_position \
+                                          + len(self.entries)
+        self.entries.append(_Entry(event.event_id, offset, length))
+        self.write_offset = offset + length
+
+    def append_events(self, evs):
+        for event in evs:
+            self.append_event(event)
+
+    def load_from_file(self, file_):
+        deserializer = rawevents.RawBodyDeserializer([])
+        for evs in deserializer.deserialize_file(file_, parse_body=False):
+            self.append_events(evs)
+
+    def newer_than(self, event_id, limit=None):
+        """Returns the events newer than the given `event_id`.
+
+        Returns a tuple (events, complete), with the same meaning
+        as in `ztreamy.events_buffer.EventsBuffer.newer_than`.
+
+        """
+        position = self.positions.get(event_id)
+        if position is not None:
+            start = position - self.first_position + 1
+            complete = True
+        else:
+            start = 0
+            complete = False
+        if limit is not None and len(self.entries) - start > limit:
+            start = len(self.entries) - limit
+            complete = False
+        return self._events(start), complete
+
+    def most_recent(self, num_events):
+        return self._events(max(0, len(self.entries) - num_events))
+
+    def contains(self, event):
+        return event.event_id in self.positions
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _events(self, start):
+        if start >= len(self.entries):
+            return []
+        data = b''.join([bytes(self.data[entry.offset:
+                                         entry.offset + entry.length]) \
+                         for entry in list(self.entries)[start:]])
+        deserializer = rawevents.RawBodyDeserializer([])
+        return deserializer.deserialize(data, complete=True)
+
+    def _make_room(self, length):
+        # Returns the offset for a new event of `length` bytes,
+        # evicting the oldest events that are in the way
+        offset = self.write_offset
+        while self.entries:
+            oldest = self.entries[0].offset
+            if oldest >= offset:
+                if offset + length <= oldest:
+                    break
+                self._evict_oldest()
+            elif offset + length <= len(self.data):
+                break
+            else:
+                offset = 0
+        if not self.entries and offset + length > len(self.data):
+            offset = 0
+        return offset
+
+    def _evict_oldest(self):
+        entry = self.entries.popleft()
+        if self.positions.get(entry.event_id) == self.first_position:
+            del self.positions[entry.event_id]
+        self.first_position += 1
+
+
+class _CachedSerialization(object):
+    def __init__(self, serialize):
+        self.serialize = serialize
+        self.data = None
+
+    def __call__(self):
+        if self.data is None:
+            self.data = self.serialize()
+        return self.data
+
+
+def cache_serialization(event):
+    """Makes every stream reuse the first serialization of the event.
+
+    ztreamy serializes the events of each stream on its own. The
+    instance attributes take precedence over the methods the
+    serializers of ztreamy call.
+
+    """
+    if not isinstance(event._serialize, _CachedSerialization):
+        event._serialize = _CachedSerialization(event._serialize)
+        event.serialize_json = _CachedSerialization(event.serialize_json)
@@ -1,8 +1,15 @@
 import random
+import struct
+import zlib
 
 from . import locations
 
 
+SCORES_TEXT_MEDIA_TYPE = 'text/plain'
+SCORES_BINARY_MEDIA_TYPE = 'application/x-hermes-scores'
+SCORES_BINARY_HASHES_MEDIA_TYPE = 'application/x-hermes-scores-hashes'
+
+
 class Status(object):
     OK = 1
     DISABLED = 11
@@ -67,16 +74,25 @@ class CloseScores(object):
             'closeScores': [score.as_dict() for score in self.scores],
         }
 
+    def load_scores(self, scores):
+        self.status = Status.OK
+        self.scores.extend(scores)
+
     def load_from_lines(self, lines):
         self.status = Status.OK
         for line in lines:
             if line:
                 parts = [p.strip() for p in line.split(',')]
-                if len(parts) != 3:
+                if len(parts) == 3:
+                    user_hash_ = None
+                elif len(parts) == 4:
+                    user_hash_ = int(parts[3])
+                else:
                     raise ValueError('Malformed score line')
                 self.add_score(DriverScore(float(parts[0]),
                                            float(parts[1]),
-                                           int(parts[2])))
+                                           int(parts[2]),
+                                           user_hash=user_hash_))
 
 
 class RoadInfo(object):
@@ -106,10 +122,18 @@ class RoadInfo(object):
 
 
 class DriverScore(object):
-    def __init__(self, latitude, longitude, score):
+    def __init__(self, latitude, longitude, score, user_hash=None):
+        """Creates the score of a driver at a location.
+
+        `user_hash` (see `user_hash`) identifies the driver between
+        the score service and the collector, which uses it to filter
+        cached scores. It is not sent to the driver apps.
+
+        """
         self.latitude = latitude
         self.longitude = longitude
         self.score = score
+        self.user_hash = user_hash
 
     def as_dict(self):
         return {
@@ -119,6 +143,191 @@ class DriverScore(object):
         }
 
 
+class ScoresReply(object):
+    """Reply of the score service to a driver scores request.
+
+    The reply type is one of:
+
+    - `SCORES`: the driver moved far enough. The reply contains
+      the previous location of the driver and the scores of
+      other drivers around.
+
+    - `PREVIOUS_LOCATION`: the driver moved, but not enough for
+      new scores to be sent. The reply contains the previous location.
+
+    - `NOT_MOVED`: the driver didn't move enough. The reply is empty.
+
+    Replies are serialized either as text (CRLF-separated lines,
+    the default) or in a compact binary format: one header byte
+    with the reply type, the previous location as two float64 values
+    (not present for `NOT_MOVED`) and one (float64 latitude,
+    float64 longitude, int32 score) record per score.
+    All the values are little endian.
+
+    The user hashes of the scores are only sent when asked for
+    (`with_hashes`), so that clients that don't know them still get
+    the formats above. In the text format, the user hash is then
+    a fourth field of the score lines. In the binary format, the reply
+    has the `SCORES_BINARY_HASHES_MEDIA_TYPE` media type and a uint32
+    user hash at the end of each record, 0 meaning that it is unknown.
+
+    """
+    SCORES = b'+'
+    PREVIOUS_LOCATION = b'i'
+    NOT_MOVED = b'*'
+
+    _header = struct.Struct(b'<c')
+    _location = struct.Struct(b'<dd')
+    _score = struct.Struct(b'<ddi')
+    _hashed_score = struct.Struct(b'<ddiI')
+
+    def __init__(self, reply_type, previous=None, scores=None):
+        if reply_type not in (ScoresReply.SCORES,
+                              ScoresReply.PREVIOUS_LOCATION,
+                              ScoresReply.NOT_MOVED):
+            raise ValueError('Unknown scores reply type')
+        if reply_type != ScoresReply.NOT_MOVED and previous is None:
+            raise ValueError('Scores reply without previous location')
+        self.reply_type = reply_type
+        self.previous = previous
+        if scores is not None:
+            self.scores = scores
+        else:
+            self.scores = []
+
+    def serialize(self, media_type=SCORES_TEXT_MEDIA_TYPE,
+                  with_hashes=False):
+        """Serializes the reply.
+
+        With `with_hashes`, the binary formats must be requested
+        with `SCORES_BINARY_HASHES_MEDIA_TYPE`.
+
+        """
+        if media_type == SCORES_BINARY_MEDIA_TYPE:
+            return self.serialize_binary()
+        elif media_type == SCORES_BINARY_HASHES_MEDIA_TYPE:
+            return self.serialize_binary(with_hashes=True)
+        else:
+            return self.serialize_text(with_hashes=with_hashes)
+
+    def serialize_text(self, with_hashes=False):
+        if self.reply_type == ScoresReply.NOT_MOVED:
+            lines = [b'#*']
+        else:
+            lines = [b'#' + self.reply_type + str(self.previous)]
+            for score in self.scores:
+                if not with_hashes or score.user_hash is None:
+                    lines.append(b'{},{},{}'.format(score.latitude,
+                                                    score.longitude,
+                                                    score.score))
+                else:
+                    lines.append(b'{},{},{},{}'.format(score.latitude,
+                                                       score.longitude,
+                                                       score.score,
+                                                       score.user_hash))
+        lines.append(b'')
+        return b'\r\n'.join(lines)
+
+    def serialize_binary(self, with_hashes=False):
+        parts = [self._header.pack(self.reply_type)]
+        if self.reply_type != ScoresReply.NOT_MOVED:
+            parts.append(self._location.pack(self.previous.lat,
+                                             self.previous.long))
+            if with_hashes:
+                pack = self._hashed_score.pack
+                for score in self.scores:
+                    parts.append(pack(score.latitude, score.longitude,
+                                      int(score.score), score.user_hash or 0))
+            else:
+                pack = self._score.pack
+                for score in self.scores:
+                    parts.append(pack(score.latitude, score.longitude,
+                                      int(score.score)))
+        return b''.join(parts)
+
+    @staticmethod
+    def parse(data, media_type=SCORES_TEXT_MEDIA_TYPE):
+        if media_type == SCORES_BINARY_MEDIA_TYPE:
+            return ScoresReply.parse_binary(data)
+        elif media_type == SCORES_BINARY_HASHES_MEDIA_TYPE:
+            return ScoresReply.parse_binary(data, with_hashes=True)
+        else:
+            return ScoresReply.parse_text(data)
+
+    @staticmethod
+    def parse_text(data):
+        lines = data.split(b'\r\n')
+        if not lines[0].startswith(b'#') or len(lines[0]) < 2:
+            raise ValueError('Malformed scores reply')
+        reply_type = lines[0][1:2]
+        if reply_type == ScoresReply.NOT_MOVED:
+            return ScoresReply(reply_type)
+        previous = locations.Location.parse(lines[0][2:])
+        scores = CloseScores()
+        scores.load_from_lines(lines[1:])
+        return ScoresReply(reply_type, previous=previous,
+                           scores=scores.scores)
+
+    @staticmethod
+    def parse_binary(data, with_hashes=False):
+        if with_hashes:
+            score_struct = ScoresReply._hashed_score
+        else:
+            score_struct = ScoresReply._score
+        header_size = ScoresReply._header.size
+        location_size = ScoresReply._location.size
+        score_size = score_struct.size
+        if len(data) < header_size:
+            raise ValueError('Malformed scores reply')
+        reply_type = ScoresReply._header.unpack_from(data)[0]
+        if reply_type == ScoresReply.NOT_MOVED:
+            return ScoresReply(reply_type)
+        offset = header_size + location_size
+        if (len(data) < offset
+            or (len(data) - offset) % score_size != 0):
+            raise ValueError('Malformed scores reply')
+        previous = locations.Location( \
+                        *ScoresReply._location.unpack_from(data, header_size))
+        unpack_from = score_struct.unpack_from
+        scores = []
+        for pos in range(offset, len(data), score_size):
+            values = unpack_from(data, pos)
+            if with_hashes:
+                scores.append(DriverScore(*values[:3],
+                                          user_hash=values[3] or None))
+            else:
+                scores.append(DriverScore(*values))
+        return ScoresReply(reply_type, previous=previous, scores=scores)
+
+
+def serialize_locations(locations_):
+    """Serializes (location, score) pairs for the score service.
+
+    There is one 'latitude,longitude,score' line per pair,
+    separated by CRLF.
+
+    """
+    return b''.join(b'{!r},{!r},{!r}\r\n'.format(location.lat, location.long,
+                                                  score) \
+                   for location, score in locations_)
+
+def parse_locations(data):
+    """Parses the (location, score) pairs of `serialize_locations`."""
+    locations_ = []
+    for line in data.split(b'\r\n'):
+        if line:
+            parts = line.split(b',')
+            if len(parts) != 3:
+                raise ValueError('Malformed location line')
+            locations_.append((locations.Location(float(parts[0]),
+                                                  float(parts[1])),
+                               float(parts[2])))
+    return locations_
+
+def user_hash(user_id):
+    """Returns the hash of a user id that goes along with its scores."""
+    return zlib.crc32(user_id.encode('utf-8')) & 0xffffffff
+
 def fake_driver_score(base):
     return DriverScore(base.lat + random.uniform(-0.005, 0.005),
                        base.long + random.uniform(-0.005, 0.005),
@@ -9,6 +9,15 @@ def _create_stream_server(port, buffering_time, disable_feedback=False,
                           backend_stream=None,
                           score_info_url=collector.DEFAULT_SCORE_INFO_URL,
                           road_info_url=collector.DEFAULT_ROAD_INFO_URL,
+                          scores_cache_ttl=collector.DEFAULT_SCORES_CACHE_TTL,
+                          binary_scores=False,
+                          parse_all_bodies=False,
+                          relay_queue_size=collector.BACKEND_RELAY_QUEUE_SIZE,
+                          spill_dir=None,
+                          recent_events_bytes=None,
+                          priority_lanes=None,
+                          max_parsed_body_size=\
+                                        collector.MAX_PARSED_BODY_SIZE,
                           log_event_time=None):
     server = ztreamy.StreamServer(port, xheaders=True)
     stream = collector.CollectorStream(buffering_time,
@@ -19,8 +28,18 @@ def _create_stream_server(port, buffering_time, disable_feedback=False,
                                        backend_stream=backend_stream,
                                        score_info_url=score_info_url,
                                        road_info_url=road_info_url,
+                                       scores_cache_ttl=scores_cache_ttl,
+                                       binary_scores=binary_scores,
+                                       raw_bodies=not parse_all_bodies,
+                                       relay_queue_size=relay_queue_size,
+                                       spill_dir=spill_dir,
+                                       recent_events_bytes=recent_events_bytes,
+                                       priority_lanes=priority_lanes,
+                                       max_parsed_body_size=\
+                                                    max_parsed_body_size,
                                        log_event_time=log_event_time)
     server.add_stream(stream)
+    server.add_handlers('.*$', collector.websocket_handlers(stream))
     return server
 
 def main():
@@ -41,6 +60,14 @@ def main():
                                 backend_stream=args.backend_stream,
                                 score_info_url=args.score_info_url,
                                 road_info_url=args.road_info_url,
+                                scores_cache_ttl=args.scores_cache_ttl,
+                                binary_scores=args.binary_scores,
+                                parse_all_bodies=args.parse_all_bodies,
+                                relay_queue_size=args.relay_queue_size,
+                                spill_dir=args.spill_dir,
+                                recent_events_bytes=args.recent_events_bytes,
+                                priority_lanes=args.lanes,
+                                max_parsed_body_size=args.max_parsed_body_size,
                                 log_event_time=args.log_event_time)
     ztreamy.client.configure_max_clients(1000)
     try:
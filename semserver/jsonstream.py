@@ -0,0 +1,154 @@
+"""Incremental decoding of large JSON documents.
+
+The arrays of a `Data Section` event (e.g. `roadSection` and
+`rrSection`) may have thousands of samples. The functions of this
+module walk the serialized body and decode one array item at a time,
+so that the decoded form of the whole document is never in memory.
+The members that are not requested are skipped by the C decoder
+of the `json` module, which discards their objects as it reads them.
+
+Walking the document is slower than decoding it with `json.loads`,
+so it is worth only for documents too large to be decoded at once.
+
+A path is a sequence of object keys, e.g. ('Data Section',
+'roadSection').
+
+"""
+from __future__ import unicode_literals
+
+import json
+import re
+
+
+def iter_array(text, path):
+    """Generator of the decoded items of the array at `path`.
+
+    It yields nothing if there is no value at `path`.
+
+    """
+    scanner = _Scanner(text)
+    if scanner.find(path):
+        if scanner.peek() != '[':
+            raise ValueError('Not an array: {}'.format('/'.join(path)))
+        for _ in scanner.items():
+            yield scanner.decode()
+
+def array_length(text, path):
+    """Returns the number of items of the array at `path`.
+
+    The items are skipped without building them. It returns 0
+    if there is no value at `path`.
+
+    """
+    scanner = _Scanner(text)
+    if not scanner.find(path):
+        return 0
+    if scanner.peek() != '[':
+        raise ValueError('Not an array: {}'.format('/'.join(path)))
+    length = 0
+    for _ in scanner.items():
+        scanner.skip()
+        length += 1
+    return length
+
+def load_object(text, path, skip=()):
+    """Decodes the object at `path`, except the members in `skip`.
+
+    Returns None if there is no value at `path`.
+
+    """
+    scanner = _Scanner(text)
+    if not scanner.find(path):
+        return None
+    data = {}
+    for key in scanner.members():
+        if key in skip:
+            scanner.skip()
+        else:
+            data[key] = scanner.decode()
+    return data
+
+
+class _Scanner(object):
+    """Reads a JSON document sequentially.
+
+    The `items` and `members` generators yield before each value.
+    The caller must then consume it with `decode`, `skip`, or a nested
+    `items` / `members` loop before asking for the next one.
+
+    """
+    def __init__(self, text):
+        self.text = text
+        self.pos = 0
+
+    def peek(self):
+        self.pos = _whitespace.match(self.text, self.pos).end()
+        return self.text[self.pos:self.pos + 1]
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError('Expected {!r} at {}'.format(char, self.pos))
+        self.pos += 1
+
+    def decode(self):
+        self.peek()
+        value, self.pos = _decoder.raw_decode(self.text, self.pos)
+        return value
+
+    def skip(self):
+        self.peek()
+        self.pos = _skipper.raw_decode(self.text, self.pos)[1]
+
+    def items(self):
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield
+            if not self._next_value(']'):
+                return
+
+    def members(self):
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.decode()
+            if not isinstance(key, basestring):
+                raise ValueError('Expected a key at {}'.format(self.pos))
+            self.expect(':')
+            yield key
+            if not self._next_value('}'):
+                return
+
+    def find(self, path):
+        """Moves to the value at `path`. Returns False if missing."""
+        for step in path:
+            if self.peek() != '{':
+                return False
+            for key in self.members():
+                if key == step:
+                    break
+                self.skip()
+            else:
+                return False
+        return True
+
+    def _next_value(self, closing):
+        char = self.peek()
+        self.pos += 1
+        if char == ',':
+            return True
+        elif char == closing:
+            return False
+        else:
+            raise ValueError('Expected {!r} at {}'.format(closing,
+                                                          self.pos - 1))
+
+
+_decoder = json.JSONDecoder()
+# Objects are not built: their members are discarded as they are read
+_skipper = json.JSONDecoder(object_pairs_hook=lambda pairs: None)
+_whitespace = re.compile(r'[ \t\n\r]*')
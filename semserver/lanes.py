@@ -0,0 +1,205 @@
+"""Priority lanes for the events published to a stream.
+
+A lane selects events by application id and event type, and dispatches
+them to the buffered clients of the stream with its own buffering time.
+Small, latency-sensitive events (e.g. vehicle locations and alerts)
+therefore do not wait for the buffering cycle of bulk events (e.g. data
+sections). The events that match no lane follow the normal buffering
+of the stream. Priority and local clients still receive every event
+immediately, in publication order (e.g. the relay to the backend,
+which keeps the order of the events of each source and spills them
+to disk when the backend is down).
+
+A lane dispatches at most `batch_size` events per IOLoop iteration.
+It also dispatches as soon as that many events are waiting. A large
+backlog is dispatched in several batches, and the events of other
+lanes can be dispatched in between.
+
+The bodies of the events of bulk lanes are not parsed by the publish
+handler. They are kept as received (see `rawevents.RawBodyEvent`),
+and are parsed only if a client needs them.
+
+"""
+from __future__ import unicode_literals
+
+import functools
+import logging
+
+import tornado.ioloop
+
+
+class Lane(object):
+    def __init__(self, name, events, buffering_time, batch_size, bulk=False):
+        """Creates a lane definition.
+
+        `events` is a collection of (application_id, event_type)
+        tuples. An event type of None matches every event of the
+        application. `buffering_time` is in seconds (0 for dispatching
+        the events in the next IOLoop iteration).
+
+        """
+        if batch_size < 1:
+            raise ValueError('Wrong lane batch size')
+        self.name = name
+        self.events = frozenset(events)
+        self.buffering_time = buffering_time
+        self.batch_size = batch_size
+        self.bulk = bulk
+
+    @staticmethod
+    def parse(spec, bulk=False):
+        """Parses 'name:seconds:batch_size:app_id[/event_type],...'.
+
+        For example: 'alerts:0.1:500:SmartDriver/High Speed'.
+
+        """
+        try:
+            name, buffering_time, batch_size, events = spec.split(':', 3)
+            keys = []
+            for event in events.split(','):
+                parts = event.split('/', 1)
+                if not parts[0]:
+                    raise ValueError()
+                keys.append((parts[0], parts[1] if len(parts) > 1 else None))
+            return Lane(name, keys, float(buffering_time), int(batch_size),
+                        bulk=bulk)
+        except ValueError:
+            raise ValueError('Wrong lane: {}'.format(spec))
+
+
+DEFAULT_LANES = [
+    Lane('priority',
+         [('SmartDriver', 'Vehicle Location'),
+          ('SmartDriver', 'High Speed'),
+          ('SmartDriver', 'High Acceleration'),
+          ('SmartDriver', 'High Deceleration'),
+          ('SmartDriver', 'High Heart Rate'),
+         ],
+         0.1, 500),
+    Lane('bulk',
+         [('SmartDriver', 'Data Section')],
+         2.0, 200, bulk=True),
+]
+
+
+def parse_lane(spec):
+    return Lane.parse(spec)
+
+def parse_bulk_lane(spec):
+    return Lane.parse(spec, bulk=True)
+
+
+class PriorityLanes(object):
+    """Dispatches the events of a stream through its lanes."""
+    def __init__(self, stream, lanes):
+        self.stream = stream
+        self.lanes = [_LaneBuffer(lane) for lane in lanes]
+        self.routes = {}
+        for lane in self.lanes:
+            for key in lane.definition.events:
+                # The first lane that selects an event type wins
+                self.routes.setdefault(key, lane)
+        self.timers = [tornado.ioloop.PeriodicCallback( \
+                                functools.partial(self._flush, lane),
+                                lane.definition.buffering_time * 1000,
+                                io_loop=stream.ioloop) \
+                       for lane in self.lanes \
+                       if lane.definition.buffering_time > 0]
+
+    @property
+    def bulk_events(self):
+        """Events whose body should not be parsed at publication."""
+        return frozenset(key for lane in self.lanes if lane.definition.bulk \
+                         for key in lane.definition.events)
+
+    def dispatch_events(self, evs):
+        """Puts the events of `evs` that belong to a lane in its buffer.
+
+        Returns a tuple with the accepted events of the lanes
+        and the events that belong to no lane. The accepted events
+        are not dispatched to the priority and local clients, so that
+        the stream can dispatch them along with the rest of the batch
+        (see `collector.CollectorStream.dispatch_events`).
+
+        """
+        accepted = []
+        rest = []
+        for event in evs:
+            lane = self.routes.get((event.application_id, event.event_type))
+            if lane is None:
+                lane = self.routes.get((event.application_id, None))
+            if lane is None:
+                rest.append(event)
+            elif (not self.is_duplicate(event)
+                  and not self.stream.dispatcher.is_duplicate(event)):
+                event.aggregator_id.append(self.stream.source_id)
+                lane.append(event)
+                accepted.append(event)
+                if (len(lane) >= lane.definition.batch_size
+                    or lane.definition.buffering_time <= 0):
+                    self._schedule_flush(lane)
+        return accepted, rest
+
+    def is_duplicate(self, event):
+        return any(event.event_id in lane.event_ids for lane in self.lanes)
+
+    def start(self):
+        for timer in self.timers:
+            timer.start()
+
+    def stop(self):
+        """Stops the timers and dispatches every buffered event."""
+        for timer in self.timers:
+            timer.stop()
+        for lane in self.lanes:
+            if len(lane):
+                self.stream.dispatcher.dispatch(lane.take(len(lane)))
+
+    def log_stats(self, label):
+        for lane in self.lanes:
+            logging.info('{} lane {}: {} ev / {} batches / {} waiting'\
+                         .format(label, lane.definition.name,
+                                 lane.num_events, lane.num_batches,
+                                 len(lane)))
+            lane.num_events = 0
+            lane.num_batches = 0
+
+    def _schedule_flush(self, lane):
+        if not lane.flush_scheduled:
+            lane.flush_scheduled = True
+            self.stream.ioloop.add_callback(self._flush, lane)
+
+    def _flush(self, lane):
+        lane.flush_scheduled = False
+        if len(lane):
+            evs = lane.take(lane.definition.batch_size)
+            self.stream.dispatcher.dispatch(evs)
+            lane.num_events += len(evs)
+            lane.num_batches += 1
+            if len(lane):
+                # Let other lanes and requests run before the next batch
+                self._schedule_flush(lane)
+
+
+class _LaneBuffer(object):
+    def __init__(self, definition):
+        self.definition = definition
+        self.events = []
+        self.event_ids = set()
+        self.flush_scheduled = False
+        self.num_events = 0
+        self.num_batches = 0
+
+    def append(self, event):
+        self.events.append(event)
+        self.event_ids.add(event.event_id)
+
+    def take(self, num_events):
+        evs = self.events[:num_events]
+        self.events = self.events[num_events:]
+        for event in evs:
+            self.event_ids.discard(event.event_id)
+        return evs
+
+    def __len__(self):
+        return len(self.events)
@@ -50,9 +50,37 @@ class Location(collections.namedtuple('Location', ('lat', 'long'),
         return (self.from_radians(self.lat_r - r, self.long_r - delta_long),
                 self.from_radians(self.lat_r + r, self.long_r + delta_long))
 
+    def tile(self, zoom):
+        """Return the (x, y) coordinates of the map tile of this location.
+
+        Tiles are numbered as in the usual slippy map (web mercator)
+        scheme, with 2 ** `zoom` tiles on each axis.
+
+        """
+        n = 2 ** zoom
+        x = int((self.long + 180.0) / 360.0 * n)
+        y = int((1.0 - math.log(math.tan(self.lat_r)
+                                + 1.0 / math.cos(self.lat_r)) / math.pi)
+                / 2.0 * n)
+        return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
     def __str__(self):
         return '{},{}'.format(self.lat, self.long)
 
+    @staticmethod
+    def tile_bounding_box(zoom, x, y):
+        """ Return the rectangle covered by a map tile.
+
+        Returns a tuple of two locations (south-west and north-east
+        corners), in the same order as `bounding_box`.
+
+        """
+        n = 2 ** zoom
+        if not (0 <= x < n and 0 <= y < n):
+            raise ValueError('Tile out of range')
+        return (Location(_tile_lat(y + 1, n), x * 360.0 / n - 180.0),
+                Location(_tile_lat(y, n), (x + 1) * 360.0 / n - 180.0))
+
     @staticmethod
     def from_radians(lat_r, long_r):
         """ Returns a Location object from lat and long in radians."""
@@ -113,6 +141,14 @@ class LocationIndex(object):
         AND (user_id <> :3 OR timestamp < :4)
         ORDER BY timestamp DESC"""
 
+    _query_lookup_area = """
+        SELECT lat, long, user_id, score
+        FROM Locations INNER JOIN Data ON Data.id = Locations.id
+        WHERE lat_max >= :1 AND lat_min <= :2
+        AND long_max >= :3 AND long_min <= :4
+        AND lat >= :1 AND lat < :2 AND long >= :3 AND long < :4
+        ORDER BY Data.id DESC"""
+
     def __init__(self, search_radius, ttl=600, allow_same_user=False,
                  to_filename=None, ordered_lookup=True):
         """ Create a new index.
@@ -157,17 +193,40 @@ class LocationIndex(object):
         ##                                          location.long,
         ##                                          time.time()))
 
-    def lookup(self, location, user_id):
+    def lookup(self, location, user_id, with_users=False):
+        """ Yield a location and score of each user around `location`.
+
+        The user `user_id` is left out. If `with_users` is True,
+        the user id of each result is yielded after the score.
+
+        """
         cursor = self.conn.cursor()
         users = set()
         users.add(user_id)
         for row in cursor.execute(self._query_lookup,
                                   (location.lat, location.long)):
+            if not row[2] in users:
+                users.add(row[2])
+                yield _lookup_result(row, with_users)
+
+    def lookup_area(self, south_west, north_east):
+        """ Yield the latest location and score of each user in an area.
+
+        The area is the rectangle between the `south_west` and
+        `north_east` corners, as returned by `Location.bounding_box`.
+        Newer entries are yielded first.
+
+        """
+        cursor = self.conn.cursor()
+        users = set()
+        for row in cursor.execute(self._query_lookup_area,
+                                  (south_west.lat, north_east.lat,
+                                   south_west.long, north_east.long)):
             if not row[2] in users:
                 users.add(row[2])
                 yield (Location(row[0], row[1]), row[3])
 
-    def _lookup_allow_same_user(self, location, user_id):
+    def _lookup_allow_same_user(self, location, user_id, with_users=False):
         # This method replaces the lookup method in the constructor,
         # when configured.
         # Don't get results from the same user in the last hour
@@ -179,7 +238,7 @@ class LocationIndex(object):
                                    user_id, timestamp_lim)):
             if not row[2] in users:
                 users.add(row[2])
-                yield (Location(row[0], row[1]), row[3])
+                yield _lookup_result(row, with_users)
 
     def roll(self):
         cursor = self.conn.cursor()
@@ -232,13 +291,13 @@ class LocationIndex(object):
             cursor.execute(table_decl)
         self.conn.commit()
 
-    def _lookup_logging_wrapper(self, location, user_id):
+    def _lookup_logging_wrapper(self, location, user_id, with_users=False):
         self._queries.append(('l',
                                      str(location.lat),
                                      str(location.long),
                                      user_id,
                                      ''))
-        return self._lookup_internal(location, user_id)
+        return self._lookup_internal(location, user_id, with_users=with_users)
 
     def _insert_logging_wrapper(self, location, user_id, score):
         self._queries.append(('i',
@@ -261,3 +320,13 @@ class LocationIndex(object):
         data = self._queries
         self._queries = None
         return data
+
+
+def _lookup_result(row, with_users):
+    if with_users:
+        return (Location(row[0], row[1]), row[3], row[2])
+    else:
+        return (Location(row[0], row[1]), row[3])
+
+def _tile_lat(y, n):
+    return math.atan(math.sinh(math.pi * (1 - 2.0 * y / n))) * 180 / math.pi
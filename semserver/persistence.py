@@ -0,0 +1,516 @@
+"""Segmented, append-only event log for the streams with persistence.
+
+Events are appended to segment files, one compressed block per
+dispatch cycle of the stream. A new segment is started when the
+current one reaches a size or an age, and the oldest segments are
+removed when the log exceeds its maximum size.
+
+Blocks are written by a background thread, so that disk I/O does not
+stall the IOLoop. The blocks that are pending when the thread wakes up
+are written together (group commit) and synced according to the
+fsync policy of the log:
+
+- 'none': never calls fsync (the OS decides when data reaches disk).
+
+- 'interval': calls fsync at most once every `fsync_interval` seconds
+  while there is unsynced data.
+
+- 'always': calls fsync after every group of blocks.
+
+Each segment has an index file with the offset, length and number of
+events of its blocks, followed by the CRC32 of the ids of their events.
+The index is kept in memory as compact arrays, so that the events after
+a given event id can be found without decompressing the whole log.
+
+"""
+from __future__ import unicode_literals
+
+import array
+import bisect
+import collections
+import functools
+import logging
+import os
+import os.path
+import Queue
+import struct
+import threading
+import time
+import zlib
+
+import ztreamy
+
+from . import eventsbuffer
+from . import rawevents
+
+
+_INDEX_RECORD = struct.Struct(b'>QII')
+_BLOCK_HEADER = struct.Struct(b'>I')
+
+
+class EventLog(object):
+    FSYNC_POLICIES = ('none', 'interval', 'always')
+    SEGMENT_PREFIX = 'segment-'
+    LOG_SUFFIX = '.log'
+    INDEX_SUFFIX = '.idx'
+
+    def __init__(self, directory, fsync='interval', fsync_interval=1.0,
+                 segment_size=2**26, segment_period=3600, max_bytes=2**30,
+                 compression_level=6, max_read_events=10000):
+        """Opens the event log stored in `directory`.
+
+        The directory is created if it doesn't exist. Segments
+        left by a previous run are kept, and new events go to
+        a new segment.
+
+        `newer_than` returns at most `max_read_events` events,
+        because it reads them in the IOLoop.
+
+        """
+        if fsync not in self.FSYNC_POLICIES:
+            raise ValueError('Unknown fsync policy: {}'.format(fsync))
+        self.directory = directory
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.segment_size = segment_size
+        self.segment_period = segment_period
+        self.max_bytes = max_bytes
+        self.compression_level = compression_level
+        self.max_read_events = max_read_events
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.segments = []
+        for number in sorted(self._find_segments()):
+            segment = self._load_segment(number)
+            if segment.size:
+                self.segments.append(segment)
+            else:
+                self._remove_files(number)
+        self.next_segment = self.segments[-1].number + 1 \
+                            if self.segments else 0
+        # Accessed only from the writer thread:
+        self.write_segment = None
+        self.write_started = None
+        self.log_file = None
+        self.index_file = None
+        self.uncommitted = []
+        self.unsynced = False
+        self.last_sync = time.time()
+        # Shared with the writer thread:
+        self.lock = threading.Lock()
+        self.unwritten = collections.deque()
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self._run,
+                                       name='event-log-writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def size(self):
+        with self.lock:
+            return sum(segment.size for segment in self.segments)
+
+    def append(self, evs):
+        """Queues a list of events to be written as a single block."""
+        if evs:
+            for event in evs:
+                eventsbuffer.cache_serialization(event)
+            data = ztreamy.serialize_events(evs)
+            hashes = [_hash(event.event_id) for event in evs]
+            with self.lock:
+                self.unwritten.append(evs)
+            self.queue.put((data, hashes))
+
+    def after_commit(self, callback, *args):
+        """Calls `callback` once the events appended so far are committed.
+
+        The callback is called from the writer thread.
+
+        """
+        self.queue.put(functools.partial(callback, *args))
+
+    def newer_than(self, event_id, limit=None):
+        """Returns the logged events after `event_id`.
+
+        Returns a tuple (events, complete) like
+        `ztreamy.events_buffer.EventsBuffer.newer_than`,
+        or None if the event is not in the log. The limit
+        is never above `max_read_events`.
+
+        """
+        if limit is None or limit > self.max_read_events:
+            limit = self.max_read_events
+        snapshot, unwritten = self._snapshot()
+        for i, event in enumerate(unwritten):
+            if event.event_id == event_id:
+                return _tail(unwritten[i + 1:], limit)
+        position = self._find(snapshot, event_id)
+        if position is None:
+            return None
+        segment_index, block, evs, index = position
+        blocks = []
+        for segment, num_blocks, _ in snapshot[segment_index:]:
+            first_block = block + 1 if segment is snapshot[segment_index][0] \
+                          else 0
+            blocks.extend((segment, b) for b in range(first_block, num_blocks))
+        num_events = len(evs) - index - 1 + len(unwritten) \
+                     + sum(segment.block_events(b) for segment, b in blocks)
+        skip = num_events - limit if limit is not None else 0
+        result = []
+        for part in [evs[index + 1:]] + blocks + [unwritten]:
+            if isinstance(part, tuple):
+                count = part[0].block_events(part[1])
+            else:
+                count = len(part)
+            if skip >= count:
+                skip -= count
+                continue
+            if isinstance(part, tuple):
+                part = self._read_block(*part)
+                if part is None:
+                    return None
+            result.extend(part[max(skip, 0):])
+            skip = 0
+        return result, num_events == len(result)
+
+    def most_recent(self, num_events):
+        """Returns up to `num_events` of the latest logged events."""
+        snapshot, unwritten = self._snapshot()
+        parts = [unwritten]
+        count = len(unwritten)
+        for segment, num_blocks, _ in reversed(snapshot):
+            for block in reversed(range(num_blocks)):
+                if count >= num_events:
+                    break
+                evs = self._read_block(segment, block)
+                if evs is None:
+                    break
+                parts.append(evs)
+                count += len(evs)
+        result = [event for evs in reversed(parts) for event in evs]
+        return result[max(len(result) - num_events, 0):]
+
+    def close(self):
+        """Writes the pending events and stops the writer thread."""
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def _snapshot(self):
+        # The writer thread only appends to the index of a segment
+        # after its data has been flushed, so the blocks counted here
+        # can be read from disk
+        with self.lock:
+            snapshot = [(segment, len(segment.ends), segment.num_events) \
+                        for segment in self.segments]
+            unwritten = [event for evs in self.unwritten for event in evs]
+        return snapshot, unwritten
+
+    def _find(self, snapshot, event_id):
+        hash_value = struct.pack(b'=I', _hash(event_id))
+        for segment_index in reversed(range(len(snapshot))):
+            segment, num_blocks, num_events = snapshot[segment_index]
+            hashes = segment.hashes.tostring()
+            end = num_events * 4
+            while True:
+                pos = hashes.rfind(hash_value, 0, end)
+                if pos < 0:
+                    break
+                end = pos + 3
+                if pos % 4:
+                    continue
+                block = bisect.bisect_right(segment.ends, pos // 4,
+                                            0, num_blocks)
+                evs = self._read_block(segment, block)
+                if evs is None:
+                    return None
+                for index, event in enumerate(evs):
+                    if event.event_id == event_id:
+                        return segment_index, block, evs, index
+        return None
+
+    def _read_block(self, segment, block):
+        try:
+            with open(self._path(segment.number, self.LOG_SUFFIX),
+                      'rb') as file_:
+                file_.seek(segment.offsets[block] + _BLOCK_HEADER.size)
+                data = file_.read(segment.lengths[block] - _BLOCK_HEADER.size)
+        except IOError:
+            # The segment has been removed in the meantime
+            return None
+        deserializer = rawevents.RawBodyDeserializer([])
+        return deserializer.deserialize(zlib.decompress(data), complete=True)
+
+    def _run(self):
+        while True:
+            if self.unsynced:
+                timeout = max(self.last_sync + self.fsync_interval \
+                              - time.time(), 0)
+            else:
+                timeout = None
+            try:
+                items = [self.queue.get(timeout=timeout)]
+            except Queue.Empty:
+                self._sync()
+                continue
+            while True:
+                try:
+                    items.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            callbacks = []
+            for item in items:
+                if isinstance(item, tuple):
+                    try:
+                        self._write_block(*item)
+                    except (IOError, OSError) as e:
+                        logging.error('Event log write error: {}'.format(e))
+                        self.uncommitted.append(None)
+                elif item is not None:
+                    callbacks.append(item)
+            self._commit()
+            for callback in callbacks:
+                try:
+                    callback()
+                except Exception:
+                    logging.exception('Error in event log commit callback')
+            if None in items:
+                self._close_files()
+                return
+
+    def _write_block(self, data, hashes):
+        if self.write_segment is None \
+            or self.log_file.tell() >= self.segment_size \
+            or time.time() - self.write_started >= self.segment_period:
+            self._roll()
+        block = zlib.compress(data, self.compression_level)
+        offset = self.log_file.tell()
+        length = _BLOCK_HEADER.size + len(block)
+        self.log_file.write(_BLOCK_HEADER.pack(len(block)))
+        self.log_file.write(block)
+        self.index_file.write(_index_record(offset, length, hashes))
+        self.uncommitted.append((offset, length, hashes))
+
+    def _commit(self):
+        # Blocks that could not be written are None in `uncommitted`
+        try:
+            if self.log_file is not None:
+                self.log_file.flush()
+                self.index_file.flush()
+                if self.fsync == 'always' \
+                    or (self.fsync == 'interval' \
+                        and time.time() - self.last_sync \
+                            >= self.fsync_interval):
+                    self._sync()
+                elif self.fsync == 'interval' and self.uncommitted:
+                    self.unsynced = True
+        except (IOError, OSError) as e:
+            logging.error('Event log write error: {}'.format(e))
+            self.uncommitted = [None] * len(self.uncommitted)
+        with self.lock:
+            for entry in self.uncommitted:
+                if entry is not None:
+                    self.write_segment.add_block(*entry)
+                self.unwritten.popleft()
+        self.uncommitted = []
+        self._remove_old_segments()
+
+    def _sync(self):
+        if self.log_file is not None:
+            os.fsync(self.log_file.fileno())
+            os.fsync(self.index_file.fileno())
+        self.last_sync = time.time()
+        self.unsynced = False
+
+    def _roll(self):
+        self._commit()
+        self._close_files()
+        segment = _Segment(self.next_segment)
+        self.next_segment += 1
+        self.log_file = open(self._path(segment.number, self.LOG_SUFFIX),
+                             'wb')
+        self.index_file = open(self._path(segment.number, self.INDEX_SUFFIX),
+                               'wb')
+        self.write_segment = segment
+        self.write_started = time.time()
+        with self.lock:
+            self.segments.append(segment)
+
+    def _close_files(self):
+        if self.log_file is not None:
+            if self.fsync != 'none':
+                self._sync()
+            self.log_file.close()
+            self.index_file.close()
+            self.log_file = None
+            self.index_file = None
+
+    def _remove_old_segments(self):
+        total = sum(segment.size for segment in self.segments)
+        while total > self.max_bytes and len(self.segments) > 1:
+            with self.lock:
+                segment = self.segments.pop(0)
+            total -= segment.size
+            self._remove_files(segment.number)
+
+    def _load_segment(self, number):
+        segment = _Segment(number)
+        log_path = self._path(number, self.LOG_SUFFIX)
+        index_path = self._path(number, self.INDEX_SUFFIX)
+        log_size = os.path.getsize(log_path) \
+                   if os.path.exists(log_path) else 0
+        data = b''
+        if os.path.exists(index_path):
+            with open(index_path, 'rb') as file_:
+                data = file_.read()
+        pos = 0
+        while pos + _INDEX_RECORD.size <= len(data):
+            offset, length, count = _INDEX_RECORD.unpack_from(data, pos)
+            end = pos + _INDEX_RECORD.size + 4 * count
+            if (end > len(data) or offset != segment.size
+                or offset + length > log_size):
+                break
+            segment.add_block(offset, length,
+                              struct.unpack_from(b'>{}I'.format(count), data,
+                                                 pos + _INDEX_RECORD.size))
+            pos = end
+        if segment.size < log_size or pos < len(data):
+            # Recover the blocks that were not indexed before a crash
+            # and discard the partially written ones
+            self._recover_blocks(segment, log_path, log_size)
+            if segment.size < log_size:
+                logging.warning('Truncated event log segment {}'\
+                                .format(number))
+                with open(log_path, 'r+b') as file_:
+                    file_.truncate(segment.size)
+            with open(index_path, 'wb') as file_:
+                for block in range(len(segment.ends)):
+                    file_.write(_index_record(segment.offsets[block],
+                                              segment.lengths[block],
+                                              segment.block_hashes(block)))
+        return segment
+
+    def _recover_blocks(self, segment, log_path, log_size):
+        with open(log_path, 'rb') as file_:
+            file_.seek(segment.size)
+            while segment.size < log_size:
+                header = file_.read(_BLOCK_HEADER.size)
+                if len(header) < _BLOCK_HEADER.size:
+                    break
+                block = file_.read(_BLOCK_HEADER.unpack(header)[0])
+                try:
+                    deserializer = rawevents.RawBodyDeserializer([])
+                    evs = deserializer.deserialize(zlib.decompress(block),
+                                                   complete=True)
+                except zlib.error:
+                    break
+                segment.add_block(segment.size,
+                                  _BLOCK_HEADER.size + len(block),
+                                  [_hash(event.event_id) for event in evs])
+
+    def _remove_files(self, number):
+        for suffix in (self.LOG_SUFFIX, self.INDEX_SUFFIX):
+            path = self._path(number, suffix)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _find_segments(self):
+        for filename in os.listdir(self.directory):
+            if (filename.startswith(self.SEGMENT_PREFIX)
+                and filename.endswith(self.LOG_SUFFIX)):
+                try:
+                    yield int(filename[len(self.SEGMENT_PREFIX):
+                                       -len(self.LOG_SUFFIX)])
+                except ValueError:
+                    pass
+
+    def _path(self, number, suffix):
+        return os.path.join(self.directory,
+                            '{}{}{}'.format(self.SEGMENT_PREFIX, number,
+                                            suffix))
+
+
+class LoggedEventsBuffer(object):
+    """Recent events buffer backed up by an `EventLog`.
+
+    It replaces the `recent_events` buffer of the dispatcher
+    of a stream. The events are served from `memory_buffer`
+    when possible, and from the log when a client asks for
+    events older than the ones in memory.
+
+    """
+    def __init__(self, memory_buffer, log, preload_events=0):
+        self.memory_buffer = memory_buffer
+        self.log = log
+        if preload_events:
+            memory_buffer.append_events(log.most_recent(preload_events))
+
+    def append_event(self, event):
+        self.append_events([event])
+
+    def append_events(self, evs):
+        self.memory_buffer.append_events(evs)
+        self.log.append(evs)
+
+    def load_from_file(self, file_):
+        self.memory_buffer.load_from_file(file_)
+
+    def newer_than(self, event_id, limit=None):
+        evs, complete = self.memory_buffer.newer_than(event_id, limit=limit)
+        if not complete and (limit is None or len(evs) < limit):
+            logged = self.log.newer_than(event_id, limit=limit)
+            # The log may return fewer events than memory when it
+            # reaches its read limit
+            if logged is not None and (logged[1] or len(logged[0]) > len(evs)):
+                return logged
+        return evs, complete
+
+    def most_recent(self, num_events):
+        return self.memory_buffer.most_recent(num_events)
+
+    def contains(self, event):
+        return self.memory_buffer.contains(event)
+
+
+class _Segment(object):
+    def __init__(self, number):
+        self.number = number
+        self.size = 0
+        self.offsets = array.array(b'L')
+        self.lengths = array.array(b'L')
+        self.ends = array.array(b'L')
+        self.hashes = array.array(b'I')
+
+    @property
+    def num_events(self):
+        return len(self.hashes)
+
+    def add_block(self, offset, length, hashes):
+        self.offsets.append(offset)
+        self.lengths.append(length)
+        self.hashes.extend(hashes)
+        self.ends.append(len(self.hashes))
+        self.size = offset + length
+
+    def block_events(self, block):
+        return self.ends[block] - (self.ends[block - 1] if block else 0)
+
+    def block_hashes(self, block):
+        return self.hashes[self.ends[block] - self.block_events(block):
+                           self.ends[block]]
+
+
+def _index_record(offset, length, hashes):
+    return _INDEX_RECORD.pack(offset, length, len(hashes)) \
+           + struct.pack(b'>{}I'.format(len(hashes)), *hashes)
+
+def _hash(event_id):
+    if isinstance(event_id, unicode):
+        event_id = event_id.encode('utf-8')
+    return zlib.crc32(event_id) & 0xffffffff
+
+def _tail(evs, limit):
+    if limit is not None and len(evs) > limit:
+        return evs[len(evs) - limit:], False
+    return evs, True
@@ -0,0 +1,159 @@
+"""Events that keep the body they were published with.
+
+The frontends only need to look into the body of a few events
+(e.g. vehicle locations, for the feedback to the driver). The rest
+of the events keep their body as the bytes received from the
+publisher, which are relayed to the backend without being parsed
+and serialized again. The backend parses JSON bodies, so the frontends
+check their syntax (`check_json`) before accepting them.
+
+"""
+from __future__ import unicode_literals
+
+import json
+import logging
+
+import ztreamy
+import ztreamy.events
+
+
+class RawBodyEvent(ztreamy.events.Event):
+    """An event whose body is kept in its serialized form."""
+
+    def body_as_json(self):
+        # Parsed only when a client asks for the JSON serialization
+        if self.syntax in _json_syntaxes:
+            try:
+                return json.loads(self.body)
+            except ValueError:
+                # Sent as a string, instead of breaking the client stream
+                logging.warning('Malformed JSON body in event {}'\
+                                .format(self.event_id))
+        return None
+
+
+class RawBodyDeserializer(ztreamy.events.Deserializer):
+    """Deserializes events, parsing only the bodies that are needed.
+
+    `parsed_events` is a collection of (application_id, event_type)
+    tuples. The body of the events that match one of them is parsed
+    as `ztreamy.events.Deserializer` would do. The rest of the events
+    are created as `RawBodyEvent` objects, except for ztreamy commands.
+
+    If `check_json` is True, the JSON bodies of `RawBodyEvent` objects
+    are checked to be well-formed, without building their objects,
+    and a `ztreamy.ZtreamyException` is raised otherwise.
+
+    """
+    def __init__(self, parsed_events, check_json=False):
+        super(RawBodyDeserializer, self).__init__()
+        self.parsed_events = frozenset(parsed_events)
+        self.check_json = check_json
+
+    def deserialize_next(self, parse_body=True):
+        # Read headers (as in ztreamy.events.Deserializer).
+        # The data is a byte string: avoid decoding it with unicode literals.
+        pos = 0
+        while not self._header_complete and pos < len(self._data):
+            end = self._data.find(b'\n', pos)
+            if end == -1:
+                self._data = self._data[pos:]
+                return None
+            part = self._data[pos:end]
+            pos = end + 1
+            if not part or part == b'\r':
+                self._header_complete = True
+                break
+            comps = part.split(b':')
+            if len(comps) < 2:
+                raise ztreamy.ZtreamyException('Event syntax error',
+                                               'event_deserialize')
+            self._update_header(comps[0].strip(),
+                                part[len(comps[0]) + 1:].strip())
+        if not self._header_complete:
+            self._data = self._data[pos:]
+            return None
+        if (not 'Event-Id' in self._event
+            or not 'Source-Id' in self._event
+            or not 'Syntax' in self._event):
+            raise ztreamy.ZtreamyException('Missing headers in event',
+                                           'event_deserialize')
+        end = pos + int(self._event.get('Body-Length', 0))
+        if end > len(self._data):
+            self._data = self._data[pos:]
+            return None
+        body = self._data[pos:end]
+        self._data = self._data[end:]
+        if parse_body and self._needs_body():
+            event_class = ztreamy.events.Event.create
+        else:
+            event_class = RawBodyEvent
+            if self.check_json and self._event['Syntax'] in _json_syntaxes:
+                _check_json(body)
+        event = event_class(self._event.get('Source-Id'),
+                            self._event.get('Syntax'),
+                            body,
+                            event_id=self._event.get('Event-Id'),
+                            application_id=self._event.get('Application-Id'),
+                            aggregator_id=self._event.get('Aggregator-Ids', []),
+                            event_type=self._event.get('Event-Type'),
+                            timestamp=self._event.get('Timestamp'),
+                            extra_headers=self._extra_headers)
+        self._event_reset()
+        return event
+
+    def _needs_body(self):
+        syntax = self._event['Syntax']
+        return ((self._event.get('Application-Id'),
+                 self._event.get('Event-Type')) in self.parsed_events
+                or (syntax in ztreamy.events.Event._always_parse
+                    and syntax not in _json_syntaxes))
+
+
+class DeferredBodyDeserializer(RawBodyDeserializer):
+    """Deserializes events, parsing every body except some of them.
+
+    `deferred_events` is a collection of (application_id, event_type)
+    tuples. The events that match one of them are created as
+    `RawBodyEvent` objects. An event type of None matches every
+    event of the application.
+
+    The events whose body is longer than `max_body_size` bytes
+    are also created as `RawBodyEvent` objects, so that parsing
+    them does not hold the IOLoop (e.g. data sections with hundreds
+    of samples). The events that match `parsed_events`, which the
+    publish handler needs to read, are always parsed.
+
+    """
+    def __init__(self, deferred_events, max_body_size=None, parsed_events=(),
+                 check_json=False):
+        super(DeferredBodyDeserializer, self).__init__(parsed_events,
+                                                       check_json=check_json)
+        self.deferred_events = frozenset(deferred_events)
+        self.max_body_size = max_body_size
+
+    def _needs_body(self):
+        application_id = self._event.get('Application-Id')
+        key = (application_id, self._event.get('Event-Type'))
+        if key in self.parsed_events:
+            return True
+        elif (key in self.deferred_events
+              or (application_id, None) in self.deferred_events):
+            return False
+        else:
+            return (not self.max_body_size
+                    or int(self._event.get('Body-Length', 0)) \
+                        <= self.max_body_size)
+
+
+def _check_json(body):
+    try:
+        _json_checker.decode(body)
+    except ValueError:
+        raise ztreamy.ZtreamyException('Malformed JSON body',
+                                       'event_deserialize')
+
+
+_json_syntaxes = (ztreamy.json_media_type, ztreamy.json_ld_media_type)
+# Objects are not built: their members are discarded as they are read
+_json_checker = json.JSONDecoder(object_pairs_hook=lambda pairs: None)
@@ -0,0 +1,316 @@
+"""Fast textual serialization of RDF terms and documents.
+
+The functions in this module write RDF terms directly as N3 text,
+without creating rdflib objects. Their output is the same
+rdflib would produce for the equivalent `rdflib.Literal` objects.
+
+Whole documents are described as lists of `Node` objects and
+written by the serializers in `output_formats`:
+
+    Node(IRI('http://example.com/obs-1'), [
+        (TYPE, 'hermes:Speed'),
+        ('hermes:average_speed', 12.5),
+        ('hermes:happens_at_timestamp', Typed('2016-...', 'xsd:timestamp')),
+        ('hermes:has_location', Node(None, [...])),
+    ])
+
+Predicates and classes are prefixed names. Objects are either
+Python values (literals with the datatype rdflib would assign),
+`Typed` literals, `IRI` objects or nested blank `Node` objects.
+
+"""
+from __future__ import unicode_literals
+
+import collections
+import json
+import math
+import re
+
+
+NS_RDF = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#'
+NS_XSD = 'http://www.w3.org/2001/XMLSchema#'
+
+TYPE = 'rdf:type'
+
+
+class IRI(unicode):
+    """A full IRI in the object position of a statement."""
+    __slots__ = ()
+
+
+Typed = collections.namedtuple('Typed', ('lexical', 'datatype'))
+
+Node = collections.namedtuple('Node', ('subject', 'properties'))
+
+
+def iri(uri):
+    """Returns the N3 representation of an IRI.
+
+    Raises ValueError if the IRI contains characters that
+    cannot be written in N3.
+
+    """
+    if _re_unsafe_iri.search(uri):
+        raise ValueError('Unsafe character in IRI')
+    return '<' + uri + '>'
+
+def string_literal(text):
+    return ('"'
+            + text.replace('\\', '\\\\').replace('"', '\\"')\
+                  .replace('\n', '\\n').replace('\r', '\\r')
+            + '"')
+
+def typed_literal(lexical, datatype):
+    """Returns a typed literal.
+
+    `datatype` must be already in its N3 representation
+    (e.g. 'xsd:date' or '<http://...>').
+
+    """
+    return string_literal(lexical) + '^^' + datatype
+
+def double_literal(value):
+    # Like rdflib, get the lexical value first and format it afterwards
+    lexical = unicode(value)
+    try:
+        number = float(lexical)
+    except ValueError:
+        return typed_literal(lexical, 'xsd:double')
+    if math.isinf(number) or math.isnan(number):
+        return typed_literal(_special_double(number), 'xsd:double')
+    else:
+        return _re_double_exponent.sub('e', '%e' % number)
+
+def literal(value):
+    """Returns a literal with the datatype rdflib would assign to value."""
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    elif isinstance(value, (int, long)):
+        return unicode(value)
+    elif isinstance(value, float):
+        return double_literal(value)
+    else:
+        return string_literal(unicode(value))
+
+
+class N3Serializer(object):
+    """Writes nodes as an N3 document with a prefix header."""
+    media_type = 'text/n3'
+
+    def __init__(self, prefixes):
+        self.header = ''.join(['@prefix {}: <{}> .\n'.format(prefix, uri) \
+                               for prefix, uri in sorted(prefixes.items())])\
+                        .encode('utf-8') + b'\n'
+
+    def serialize(self, nodes, bnode_prefix=None):
+        return self.header \
+            + '\n'.join([_n3_properties(iri(node.subject), node.properties, 1)
+                         + ' .\n' for node in nodes]).encode('utf-8')
+
+    def merge(self, bodies):
+        header_length = len(self.header)
+        return b'\n'.join(bodies[:1] + [body[header_length:] \
+                                        for body in bodies[1:]])
+
+
+class NTriplesSerializer(object):
+    """Writes nodes as N-Triples, one statement per line.
+
+    Blank nodes are labelled with `bnode_prefix` followed by
+    a counter, so documents with different prefixes can be
+    concatenated.
+
+    """
+    media_type = 'application/n-triples'
+
+    def __init__(self, prefixes):
+        self.prefixes = dict(prefixes)
+        self.prefixes['rdf'] = NS_RDF
+        self.prefixes['xsd'] = NS_XSD
+        self.terms = {}
+
+    def serialize(self, nodes, bnode_prefix='b'):
+        lines = []
+        bnode_count = [0]
+        for node in nodes:
+            self._add_triples(iri(node.subject), node.properties, lines,
+                              bnode_prefix, bnode_count)
+        return ''.join(lines).encode('utf-8')
+
+    def merge(self, bodies):
+        return b''.join(bodies)
+
+    def _add_triples(self, subject, properties, lines,
+                     bnode_prefix, bnode_count):
+        for predicate, value in properties:
+            if isinstance(value, Node):
+                obj = '_:{}x{}'.format(bnode_prefix, bnode_count[0])
+                bnode_count[0] += 1
+                self._add_triples(obj, value.properties, lines,
+                                  bnode_prefix, bnode_count)
+            elif predicate == TYPE:
+                obj = self._term(value)
+            else:
+                obj = self._object(value)
+            lines.append(subject + ' ' + self._term(predicate)
+                         + ' ' + obj + ' .\n')
+
+    def _term(self, name):
+        # Expands a prefixed name, caching the result
+        try:
+            return self.terms[name]
+        except KeyError:
+            prefix, local_name = name.split(':', 1)
+            term = iri(self.prefixes[prefix] + local_name)
+            self.terms[name] = term
+            return term
+
+    def _object(self, value):
+        if isinstance(value, IRI):
+            return iri(value)
+        elif isinstance(value, Typed):
+            if value.datatype == 'xsd:double':
+                lexical = _double_lexical(value.lexical)
+            else:
+                lexical = value.lexical
+            return typed_literal(lexical, self._term(value.datatype))
+        elif isinstance(value, bool):
+            return typed_literal('true' if value else 'false',
+                                 self._term('xsd:boolean'))
+        elif isinstance(value, (int, long)):
+            return typed_literal(unicode(value), self._term('xsd:integer'))
+        elif isinstance(value, float):
+            return typed_literal(_double_lexical(value),
+                                 self._term('xsd:double'))
+        else:
+            return string_literal(unicode(value))
+
+
+class JSONLDSerializer(object):
+    """Writes nodes as a compact JSON-LD document.
+
+    The prefixes are declared in the context, so that
+    prefixed names are used as keys and types.
+
+    """
+    media_type = 'application/ld+json'
+
+    def __init__(self, prefixes):
+        context = json.dumps(collections.OrderedDict(sorted(prefixes.items())),
+                             separators=(',', ':'))
+        self.header = ('{"@context":' + context + ',"@graph":[')\
+                        .encode('utf-8')
+        self.footer = b']}'
+        self.compact_prefixes = sorted([(uri, prefix + ':') \
+                                        for prefix, uri in prefixes.items()],
+                                       key=lambda item: -len(item[0]))
+
+    def serialize(self, nodes, bnode_prefix=None):
+        return self.header \
+            + ','.join([json.dumps(self._node(node), separators=(',', ':'),
+                                   ensure_ascii=False) \
+                        for node in nodes]).encode('utf-8') \
+            + self.footer
+
+    def _node(self, node):
+        data = collections.OrderedDict()
+        if node.subject is not None:
+            data['@id'] = self._compact(node.subject)
+        for predicate, value in node.properties:
+            if predicate == TYPE:
+                key = '@type'
+            else:
+                key = predicate
+                value = self._value(value)
+            if key not in data:
+                data[key] = value
+            elif isinstance(data[key], list):
+                data[key].append(value)
+            else:
+                data[key] = [data[key], value]
+        return data
+
+    def _value(self, value):
+        if isinstance(value, Node):
+            return self._node(value)
+        elif isinstance(value, IRI):
+            return {'@id': self._compact(value)}
+        elif isinstance(value, Typed):
+            return {'@value': value.lexical, '@type': value.datatype}
+        elif isinstance(value, (bool, int, long)):
+            return value
+        elif isinstance(value, float):
+            # Same value as the lexical form rdflib would write
+            number = float(unicode(value))
+            if math.isinf(number) or math.isnan(number):
+                return {'@value': _special_double(number),
+                        '@type': 'xsd:double'}
+            else:
+                return number
+        else:
+            return unicode(value)
+
+    def _compact(self, uri):
+        for prefix_uri, prefix in self.compact_prefixes:
+            if uri.startswith(prefix_uri):
+                return prefix + uri[len(prefix_uri):]
+        return uri
+
+    def merge(self, bodies):
+        start = len(self.header)
+        end = -len(self.footer)
+        graphs = [body[start:end] for body in bodies if body[start:end]]
+        return self.header + b','.join(graphs) + self.footer
+
+
+output_formats = collections.OrderedDict([
+    ('n3', N3Serializer),
+    ('ntriples', NTriplesSerializer),
+    ('json-ld', JSONLDSerializer),
+])
+
+
+def _n3_properties(subject, properties, depth):
+    separator = ' ;\n' + '    ' * (2 * depth - 1)
+    return subject + ' ' + separator.join( \
+        [('a' if predicate == TYPE else predicate) + ' '
+         + _n3_object(predicate, value, depth) \
+         for predicate, value in properties])
+
+def _n3_object(predicate, value, depth):
+    if isinstance(value, Node):
+        return _n3_properties('[', value.properties, depth + 1) + ' ]'
+    elif predicate == TYPE:
+        return value
+    elif isinstance(value, IRI):
+        return iri(value)
+    elif isinstance(value, Typed):
+        if value.datatype == 'xsd:double':
+            return double_literal(value.lexical)
+        else:
+            return typed_literal(value.lexical, value.datatype)
+    else:
+        return literal(value)
+
+def _double_lexical(value):
+    lexical = unicode(value)
+    try:
+        number = float(lexical)
+    except ValueError:
+        return lexical
+    if math.isinf(number) or math.isnan(number):
+        return _special_double(number)
+    else:
+        return lexical
+
+def _special_double(number):
+    if math.isnan(number):
+        return 'NaN'
+    elif number > 0:
+        return 'INF'
+    else:
+        return '-INF'
+
+
+_re_unsafe_iri = re.compile(r'[\x00-\x20<>"{}|^`\\]')
+_re_double_exponent = re.compile(r'\.?0*e')
@@ -7,6 +7,8 @@ import logging
 import collections
 import datetime
 import time
+import json
+import itertools
 
 import tornado.ioloop
 import tornado.web
@@ -15,6 +17,7 @@ import ztreamy
 
 from . import utils
 from . import locations
+from . import feedback
 
 
 class DataClient(ztreamy.Client):
@@ -93,51 +96,212 @@ class LatestDataHandler(tornado.web.RequestHandler):
 
 
 class DriverScoresHandler(tornado.web.RequestHandler):
-    def initialize(self, index, locations_short, locations_long, stats):
+    def initialize(self, index, sessions, stats):
         self.index = index
-        self.locations_short = locations_short
-        self.locations_long = locations_long
+        self.sessions = sessions
         self.stats = stats
 
     def get(self):
+        self._reply([])
+
+    def post(self):
+        """Like GET, with older locations of the driver in the body.
+
+        The older locations (see `feedback.parse_locations`)
+        are inserted into the index, in order, before the location
+        of the query arguments.
+
+        """
+        try:
+            previous_locations = feedback.parse_locations(self.request.body)
+        except ValueError:
+            self.send_error(status_code=422, reason='Unprocessable Entity')
+        else:
+            self._reply(previous_locations)
+
+    def _reply(self, previous_locations):
         try:
             user_id = self.get_query_argument('user')
             latitude = float(self.get_query_argument('latitude'))
             longitude = float(self.get_query_argument('longitude'))
             score = float(self.get_query_argument('score'))
+            lookup = self.get_query_argument('lookup', default='1') != '0'
+            hashes = self.get_query_argument('hashes', default='0') != '0'
         except (tornado.web.MissingArgumentError, ValueError):
-            self.send_error(status_code=422)
+            self.send_error(status_code=422, reason='Unprocessable Entity')
         else:
+            for previous_location, previous_score in previous_locations:
+                if self.sessions.advance(user_id, previous_location,
+                                         previous_score):
+                    self.index.insert(previous_location, user_id,
+                                      previous_score)
             location = locations.Location(latitude, longitude)
-            self.set_header('Content-Type', 'text/plain')
-            check, previous = self.locations_short.check(user_id, location)
-            if check:
-                # Check the long locations buffer to decide whether
-                # to get the scores of other drivers
-                check, previous = self.locations_long.check(user_id, location)
-                if check:
-                    self.write('#+{}\r\n'.format(previous))
-                    num_results = 0
-                    for o_loc, o_score in self.index.lookup(location, user_id):
-                        self.write('{},{},{}\r\n'.format(o_loc.lat,
-                                                         o_loc.long,
-                                                         o_score))
-                        num_results += 1
-                        if num_results == 10:
-                            break
+            moved, moved_long, previous = self.sessions.check(user_id,
+                                                              location,
+                                                              score)
+            if moved:
+                # Get the scores of other drivers only when the driver
+                # moved far enough from the long anchor
+                if moved_long and lookup:
+                    # The user hashes let the collector filter
+                    # the scores it caches for other drivers
+                    scores = [feedback.DriverScore( \
+                                        o_loc.lat, o_loc.long, o_score,
+                                        user_hash=feedback.user_hash(o_user)) \
+                              for o_loc, o_score, o_user in itertools.islice( \
+                                    self.index.lookup(location, user_id,
+                                                      with_users=True), 10)]
+                    reply = feedback.ScoresReply(feedback.ScoresReply.SCORES,
+                                                 previous=previous,
+                                                 scores=scores)
                     self.stats.notify_request(scores=True,
-                                              num_scores=num_results,
+                                              num_scores=len(scores),
                                               road_info=True)
                 else:
-                    self.write('#i{}\r\n'.format(previous))
+                    reply = feedback.ScoresReply( \
+                                        feedback.ScoresReply.PREVIOUS_LOCATION,
+                                        previous=previous)
                     self.stats.notify_request(road_info=True)
                 ## logging.debug('Sent {} locations'.format(num_results))
                 self.index.insert(location, user_id, score)
             else:
                 ## logging.debug('Driver didn\'t move enough')
-                self.locations_long.refresh(user_id)
-                self.write('#*\r\n')
+                reply = feedback.ScoresReply(feedback.ScoresReply.NOT_MOVED)
                 self.stats.notify_request()
+            if (feedback.SCORES_BINARY_MEDIA_TYPE
+                in self.request.headers.get('Accept', '')):
+                if hashes:
+                    media_type = feedback.SCORES_BINARY_HASHES_MEDIA_TYPE
+                else:
+                    media_type = feedback.SCORES_BINARY_MEDIA_TYPE
+            else:
+                media_type = feedback.SCORES_TEXT_MEDIA_TYPE
+            self.set_header('Content-Type', media_type)
+            self.write(reply.serialize(media_type=media_type,
+                                       with_hashes=hashes))
+
+
+class ScoreTilesHandler(tornado.web.RequestHandler):
+    MAX_AGE = 30
+
+    def initialize(self, tiles, stats):
+        self.tiles = tiles
+        self.stats = stats
+
+    def get(self, zoom, x, y):
+        try:
+            tile = self.tiles.get(int(zoom), int(x), int(y))
+        except ValueError:
+            self.send_error(status_code=404)
+            return
+        if tile.dirty:
+            self.tiles.regenerate(tile)
+            self.stats.notify_tile_request(regenerated=True)
+        else:
+            self.stats.notify_tile_request()
+        compress = 'gzip' in self.request.headers.get('Accept-Encoding', '')
+        self.set_header('Content-Type', ztreamy.json_media_type)
+        self.set_header('Cache-Control',
+                        'public, max-age={}'.format(self.MAX_AGE))
+        self.set_header('Vary', 'Accept-Encoding')
+        if compress:
+            self.set_header('Etag', tile.etag_compressed)
+        else:
+            self.set_header('Etag', tile.etag)
+        if self.check_etag_header():
+            self.set_status(304)
+        elif compress:
+            self.set_header('Content-Encoding', 'gzip')
+            self.write(tile.compressed_data)
+        else:
+            self.write(tile.data)
+
+
+class ScoreTile(object):
+    def __init__(self, zoom, x, y):
+        # Check that the tile exists
+        locations.Location.tile_bounding_box(zoom, x, y)
+        self.key = (zoom, x, y)
+        self.dirty = True
+        self.last_update = time.time()
+        self.data = None
+        self.compressed_data = None
+
+    @property
+    def etag(self):
+        return '"{:x}"'.format(int(self.last_update * 1000))
+
+    @property
+    def etag_compressed(self):
+        return '"{:x}-gz"'.format(int(self.last_update * 1000))
+
+
+class ScoreTiles(object):
+    """Summaries of the scores in the score index per map tile.
+
+    Tiles are computed lazily when requested, and computed again
+    only if the scores in their area have changed since then.
+
+    """
+    MIN_ZOOM = 10
+    MAX_ZOOM = 16
+    MAX_SCORES = 100
+    MAX_TILES = 10000
+    ROLL_PERIOD = 300000 # 5 minutes
+
+    def __init__(self, index, ioloop):
+        self.index = index
+        self.tiles = utils.LatestValueBuffer(max_entries=self.MAX_TILES)
+        tornado.ioloop.PeriodicCallback(self.tiles.roll, self.ROLL_PERIOD,
+                                        ioloop).start()
+
+    def get(self, zoom, x, y):
+        if not self.MIN_ZOOM <= zoom <= self.MAX_ZOOM:
+            raise ValueError('Zoom level out of range')
+        key = (zoom, x, y)
+        try:
+            tile = self.tiles[key]
+        except KeyError:
+            tile = ScoreTile(zoom, x, y)
+            self.tiles[key] = tile
+        else:
+            self.tiles.refresh(key)
+        return tile
+
+    def regenerate(self, tile):
+        scores = feedback.CloseScores()
+        scores.status_ok()
+        south_west, north_east = \
+                        locations.Location.tile_bounding_box(*tile.key)
+        for location, score in itertools.islice( \
+                            self.index.lookup_area(south_west, north_east),
+                            self.MAX_SCORES):
+            scores.add_score(feedback.DriverScore(location.lat,
+                                                  location.long,
+                                                  score))
+        data = scores.as_dict()
+        data['tile'] = list(tile.key)
+        serialized = json.dumps(data)
+        if serialized != tile.data:
+            tile.data = serialized
+            tile.compressed_data = utils.compress_gzip(serialized)
+            tile.last_update = time.time()
+        tile.dirty = False
+
+    def mark_dirty(self, location):
+        x, y = location.tile(self.MAX_ZOOM)
+        for zoom in range(self.MIN_ZOOM, self.MAX_ZOOM + 1):
+            shift = self.MAX_ZOOM - zoom
+            key = (zoom, x >> shift, y >> shift)
+            if key in self.tiles:
+                self.tiles[key].dirty = True
+
+    def invalidate(self):
+        for key in self.tiles:
+            self.tiles[key].dirty = True
+
+    def __len__(self):
+        return len(self.tiles)
 
 
 class ScoreIndex(locations.LocationIndex):
@@ -146,32 +310,141 @@ class ScoreIndex(locations.LocationIndex):
         # In the future, about 30 min or less would be enough
 #        super(ScoreIndex, self).__init__(500.0, ttl=259200)
         super(ScoreIndex, self).__init__(500.0, ttl=ttl, **kwargs)
+        self.tiles = None
         # Roll every ttl / 4 (seconds) = ttl * 250 (milliseconds)
         tornado.ioloop.PeriodicCallback(self.roll, ttl * 250, ioloop).start()
 
-
-class LatestLocations(utils.LatestValueBuffer):
-    def __init__(self, threshold_distance, ioloop):
-        super(LatestLocations, self).__init__()
-        self.threshold_distance = threshold_distance
-        tornado.ioloop.PeriodicCallback(self.roll, 30000, ioloop).start()
-
-    def check(self, user_id, location):
-        try:
-            previous = self[user_id]
-        except KeyError:
-            answer = True
-            previous = location
+    def insert(self, location, user_id, score):
+        super(ScoreIndex, self).insert(location, user_id, score)
+        if self.tiles is not None:
+            self.tiles.mark_dirty(location)
+
+    def roll(self):
+        super(ScoreIndex, self).roll()
+        if self.tiles is not None:
+            self.tiles.invalidate()
+
+
+class UserSession(object):
+    """Latest state of a driver that requests scores.
+
+    `short_anchor` and `long_anchor` are the last locations at which
+    the driver was considered to have moved enough for, respectively,
+    a new insertion in the score index and a new lookup of scores.
+    `long_anchor` is None while no scores have been looked up.
+    `long_bound` is an upper bound of the distance between both anchors.
+
+    """
+    __slots__ = ('short_anchor', 'long_anchor', 'long_bound', 'score',
+                 'last_seen', 'generation')
+
+    def __init__(self, location, score, generation):
+        self.short_anchor = location
+        self.long_anchor = location
+        self.long_bound = 0.0
+        self.score = score
+        self.last_seen = time.time()
+        self.generation = generation
+
+
+class UserSessions(object):
+    """Stores a session for every driver that requests scores.
+
+    Sessions belong to the generation in which they were last seen.
+    Each roll drops the sessions not seen since the previous roll,
+    so that they live for at least one and at most two roll periods.
+
+    """
+    ROLL_PERIOD = 30000 # 30 seconds
+
+    def __init__(self, short_distance, long_distance, ioloop):
+        self.short_distance = short_distance
+        self.long_distance = long_distance
+        self.sessions = {}
+        self.generation = 0
+        tornado.ioloop.PeriodicCallback(self.roll, self.ROLL_PERIOD,
+                                        ioloop).start()
+
+    def check(self, user_id, location, score):
+        """Updates the session of the user with a new location.
+
+        Returns a tuple `(moved, moved_long, previous)`.
+        `moved` is True when the driver moved at least the short
+        distance since the short anchor, and `moved_long` when
+        the driver moved at least the long distance since the long
+        anchor. `previous` is the long anchor before this update.
+
+        The distance to the long anchor is only computed when
+        the upper bound kept in the session doesn't rule it out,
+        which means just one distance evaluation for most requests.
+
+        """
+        session = self.sessions.get(user_id)
+        if session is None or session.long_anchor is None:
+            self.sessions[user_id] = UserSession(location, score,
+                                                 self.generation)
+            return True, True, location
+        session.generation = self.generation
+        session.last_seen = time.time()
+        distance = location.distance(session.short_anchor)
+        if distance < self.short_distance:
+            return False, False, session.long_anchor
+        session.short_anchor = location
+        session.score = score
+        long_bound = session.long_bound + distance
+        if long_bound >= self.long_distance:
+            long_bound = location.distance(session.long_anchor)
+        previous = session.long_anchor
+        if long_bound >= self.long_distance:
+            session.long_anchor = location
+            session.long_bound = 0.0
+            return True, True, previous
         else:
-            if location.distance(previous) >= self.threshold_distance:
-                answer = True
-            else:
-                answer = False
-        if answer:
-            self[user_id] = location
-        else:
-            self.refresh(user_id)
-        return answer, previous
+            session.long_bound = long_bound
+            return True, False, previous
+
+    def advance(self, user_id, location, score):
+        """Updates the session of the user with an older location.
+
+        Only the short anchor moves, so that the lookup of scores
+        still depends on the next location checked. Returns True
+        when the driver moved at least the short distance.
+        If the user had no session, the next location checked
+        gets a lookup, as the first location of a session does.
+
+        """
+        session = self.sessions.get(user_id)
+        if session is None:
+            session = UserSession(location, score, self.generation)
+            session.long_anchor = None
+            self.sessions[user_id] = session
+            return True
+        session.generation = self.generation
+        session.last_seen = time.time()
+        distance = location.distance(session.short_anchor)
+        if distance < self.short_distance:
+            return False
+        session.short_anchor = location
+        session.score = score
+        # Still an upper bound of the distance between the anchors
+        session.long_bound += distance
+        return True
+
+    def roll(self):
+        expired = [user_id for user_id, session in self.sessions.iteritems() \
+                   if session.generation < self.generation]
+        for user_id in expired:
+            del self.sessions[user_id]
+        self.generation += 1
+
+    def __contains__(self, user_id):
+        return user_id in self.sessions
+
+    def __getitem__(self, user_id):
+        return self.sessions[user_id]
+
+    def __len__(self):
+        return len(self.sessions)
 
 
 PeriodStats = collections.namedtuple('PeriodStats',
@@ -179,25 +452,28 @@ PeriodStats = collections.namedtuple('PeriodStats',
                                       'scores_requests',
                                       'road_info_requests',
                                       'scores',
+                                      'tile_requests',
+                                      'tile_updates',
                                       'total_time',
                                       'real_time',
                                       'size_score_index',
-                                      'size_locations_short',
-                                      'size_locations_long'),
+                                      'size_sessions',
+                                      'size_tiles'),
                                      verbose=False)
 
 
 class StatsTracker(object):
-    def __init__(self, score_index, locations_short, locations_long, ioloop):
+    def __init__(self, score_index, sessions, ioloop):
         self.score_index = score_index
-        self.locations_short = locations_short
-        self.locations_long = locations_long
+        self.sessions = sessions
         self.ioloop = ioloop
         self.latest_times = os.times()
         self.num_requests = 0
         self.num_scores_requests = 0
         self.num_road_info_requests = 0
         self.num_scores = 0
+        self.num_tile_requests = 0
+        self.num_tile_updates = 0
 
     def notify_request(self, scores=False, num_scores=0, road_info=False):
         self.num_requests += 1
@@ -207,6 +483,11 @@ class StatsTracker(object):
         if road_info:
             self.num_road_info_requests += 1
 
+    def notify_tile_request(self, regenerated=False):
+        self.num_tile_requests += 1
+        if regenerated:
+            self.num_tile_updates += 1
+
     def compute_cycle(self):
         current_times = os.times()
         user_time = current_times[0] - self.latest_times[0]
@@ -217,15 +498,19 @@ class StatsTracker(object):
                             self.num_scores_requests,
                             self.num_road_info_requests,
                             self.num_scores,
+                            self.num_tile_requests,
+                            self.num_tile_updates,
                             total_time,
                             real_time,
                             len(self.score_index),
-                            len(self.locations_short),
-                            len(self.locations_long))
+                            len(self.sessions),
+                            len(self.score_index.tiles or ()))
         self.num_requests = 0
         self.num_scores_requests = 0
         self.num_road_info_requests = 0
         self.num_scores = 0
+        self.num_tile_requests = 0
+        self.num_tile_updates = 0
         self.latest_times = current_times
         return stats
 
@@ -234,12 +519,13 @@ class StatsTracker(object):
         logging.info('restserver: '
                      '{0.requests} r / {0.total_time:.02f}s '
                      '/ {0.scores_requests} s / {0.road_info_requests} ri '
-                     '/ {0.scores} ss'\
+                     '/ {0.scores} ss / {0.tile_requests} tr '
+                     '/ {0.tile_updates} tu'\
                      .format(stats))
-        logging.info('sizes: {} sc_idx / {} shrt_loc / {} lng_loc'.\
+        logging.info('sizes: {} sc_idx / {} sessions / {} tiles'.\
                      format(stats.size_score_index,
-                            stats.size_locations_short,
-                            stats.size_locations_long))
+                            stats.size_sessions,
+                            stats.size_tiles))
         logging.info('cpu {0.requests},{0.total_time:.03f},'
                      '{0.real_time:.03f},{1:.03f}'\
                      .format(stats, time.time()))
@@ -300,9 +586,10 @@ def main():
                              ttl=args.index_ttl,
                              allow_same_user=args.allow_same_user,
                              ordered_lookup=False)
-    locations_short = LatestLocations(10.0, tornado.ioloop.IOLoop.instance())
-    locations_long = LatestLocations(300.0, tornado.ioloop.IOLoop.instance())
-    stats_tracker = StatsTracker(score_index, locations_short, locations_long,
+    score_index.tiles = ScoreTiles(score_index,
+                                   tornado.ioloop.IOLoop.instance())
+    sessions = UserSessions(10.0, 300.0, tornado.ioloop.IOLoop.instance())
+    stats_tracker = StatsTracker(score_index, sessions,
                                  tornado.ioloop.IOLoop.instance())
     application = tornado.web.Application([
         ## ('/last_driver_data', LatestDataHandler,
@@ -313,8 +600,11 @@ def main():
         ##  {'data_client': steps_client}),
         ('/driver_scores', DriverScoresHandler,
          {'index': score_index,
-          'locations_short': locations_short,
-          'locations_long': locations_long,
+          'sessions': sessions,
+          'stats': stats_tracker,
+         }),
+        (r'/score_tiles/(\d+)/(\d+)/(\d+)', ScoreTilesHandler,
+         {'tiles': score_index.tiles,
           'stats': stats_tracker,
          }),
         ('/dump_index', DumpLocationIndexHandler,
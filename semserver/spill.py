@@ -0,0 +1,190 @@
+"""Event queues that spill to disk when they are full.
+
+Events that do not fit in memory are appended to segment files in
+a local directory. Each spilled batch is written as a compressed
+block, preceded by its length. Segments are replayed in order and
+deleted once their events are back in memory. Segments left by
+a previous run are replayed before any new event.
+
+"""
+from __future__ import unicode_literals
+
+import collections
+import logging
+import os
+import os.path
+import struct
+import zlib
+
+import ztreamy
+
+from . import rawevents
+
+
+class SpillBuffer(object):
+    SEGMENT_PREFIX = 'segment-'
+    SEGMENT_SUFFIX = '.z'
+
+    def __init__(self, directory, max_events=10000, segment_size=2**24,
+                 compression_level=6):
+        """Creates a new FIFO event buffer.
+
+        At most `max_events` events are kept in memory. The rest
+        of them are written to segments of about `segment_size`
+        bytes in `directory`, which is created if it doesn't exist.
+
+        """
+        self.directory = directory
+        self.max_events = max_events
+        self.segment_size = segment_size
+        self.compression_level = compression_level
+        self.memory = collections.deque()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.segments = sorted(self._find_segments())
+        self.next_segment = self.segments[-1] + 1 if self.segments else 0
+        self.disk_bytes = sum(os.path.getsize(self._segment_path(segment)) \
+                              for segment in self.segments)
+        self.spilled_bytes = 0
+        self.write_file = None
+        self.write_segment = None
+        self.read_file = None
+        self.read_bytes = 0
+        if self.segments:
+            logging.info('Spilled events to replay: {} segments / {} bytes'\
+                         .format(len(self.segments), self.disk_bytes))
+
+    def append(self, evs):
+        if not self.has_spilled():
+            room = self.max_events - len(self.memory)
+            self.memory.extend(evs[:room])
+            evs = evs[room:]
+        if evs:
+            self._spill(evs)
+
+    def pop(self, max_events):
+        """Removes and returns up to `max_events` of the oldest events."""
+        if not self.memory:
+            self._load_block()
+        num_events = min(max_events, len(self.memory))
+        return [self.memory.popleft() for _ in range(num_events)]
+
+    def has_spilled(self):
+        return bool(self.segments or self.write_file is not None)
+
+    def close(self, head_events=()):
+        """Writes to disk the events still in memory.
+
+        `head_events` are written before them, since they are older
+        (e.g. events that were pending to be sent). The segments keep
+        their order, so that they are replayed by the next buffer
+        created in the same directory.
+
+        """
+        evs = list(head_events) + list(self.memory)
+        self.memory.clear()
+        self._close_write_file()
+        if self.read_file is not None:
+            # Replace the segment being read by the events in memory
+            # followed by its unread blocks
+            segment = self.segments[0]
+            remainder = self.read_file.read()
+            self.read_file.close()
+            self.read_file = None
+        else:
+            segment = self.segments[0] - 1 if self.segments \
+                      else self.next_segment
+            remainder = b''
+        if evs or remainder:
+            path = self._segment_path(segment)
+            with open(path + '.tmp', 'wb') as file_:
+                if evs:
+                    file_.write(self._block(evs))
+                file_.write(remainder)
+            os.rename(path + '.tmp', path)
+
+    def __len__(self):
+        return len(self.memory)
+
+    def _spill(self, evs):
+        if self.write_file is None:
+            self.write_segment = self.next_segment
+            self.next_segment += 1
+            self.write_file = open(self._segment_path(self.write_segment),
+                                   'ab')
+        block = self._block(evs)
+        self.write_file.write(block)
+        self.write_file.flush()
+        self.disk_bytes += len(block)
+        self.spilled_bytes += len(block)
+        if self.write_file.tell() >= self.segment_size:
+            self._close_write_file()
+
+    def _block(self, evs):
+        data = zlib.compress(ztreamy.serialize_events(evs),
+                             self.compression_level)
+        return struct.pack(b'>I', len(data)) + data
+
+    def _close_write_file(self):
+        if self.write_file is not None:
+            self.write_file.close()
+            self.segments.append(self.write_segment)
+            self.write_file = None
+            self.write_segment = None
+
+    def _load_block(self):
+        while True:
+            if self.read_file is None:
+                if not self.segments:
+                    # Read also the segment being written
+                    self._close_write_file()
+                    if not self.segments:
+                        return
+                self.read_file = open(self._segment_path(self.segments[0]),
+                                      'rb')
+                self.read_bytes = 0
+            header = self.read_file.read(4)
+            data = None
+            if len(header) == 4:
+                length = struct.unpack(b'>I', header)[0]
+                data = self.read_file.read(length)
+                if len(data) < length:
+                    logging.warning('Truncated spill segment {}'\
+                                    .format(self.segments[0]))
+                    data = None
+            elif header:
+                logging.warning('Truncated spill segment {}'\
+                                .format(self.segments[0]))
+            if data is not None:
+                self.disk_bytes -= len(header) + len(data)
+                self.read_bytes += len(header) + len(data)
+                deserializer = rawevents.RawBodyDeserializer([])
+                self.memory.extend(deserializer.deserialize( \
+                                                    zlib.decompress(data),
+                                                    complete=True))
+                return
+            self._remove_read_segment()
+
+    def _remove_read_segment(self):
+        segment = self.segments.pop(0)
+        path = self._segment_path(segment)
+        self.read_file.close()
+        self.read_file = None
+        # Discount also the bytes of truncated blocks
+        self.disk_bytes -= os.path.getsize(path) - self.read_bytes
+        os.remove(path)
+
+    def _find_segments(self):
+        for filename in os.listdir(self.directory):
+            if (filename.startswith(self.SEGMENT_PREFIX)
+                and filename.endswith(self.SEGMENT_SUFFIX)):
+                try:
+                    yield int(filename[len(self.SEGMENT_PREFIX):
+                                       -len(self.SEGMENT_SUFFIX)])
+                except ValueError:
+                    pass
+
+    def _segment_path(self, segment):
+        return os.path.join(self.directory,
+                            '{}{}{}'.format(self.SEGMENT_PREFIX, segment,
+                                            self.SEGMENT_SUFFIX))
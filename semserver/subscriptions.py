@@ -0,0 +1,245 @@
+"""Server-side filters for the clients of a stream.
+
+Clients select the events they want with query parameters in the
+URL of the stream, e.g.:
+
+    /backend/compressed?exclude=SmartDriver/Vehicle%20Location
+
+Both `include` and `exclude` may be repeated. Their values are
+either an application id or an application id and an event type
+separated by a slash. When there are `include` parameters, only
+the events matching at least one of them are sent, and events
+matching any `exclude` parameter are never sent.
+
+Clients with the same filter share a view of the stream with its
+own dispatchers, so that the filter is evaluated once per batch
+and events are serialized once per view.
+
+"""
+from __future__ import unicode_literals, print_function
+
+import logging
+import urllib
+import urlparse
+
+import tornado.ioloop
+import tornado.web
+import ztreamy.server
+
+
+class SubscriptionFilter(object):
+    def __init__(self, include=(), exclude=()):
+        """Creates a new filter.
+
+        `include` and `exclude` are iterables of
+        (application_id, event_type) tuples. The event type may be
+        None in order to match every event of the application.
+
+        """
+        self.include = frozenset(include)
+        self.exclude = frozenset(exclude)
+        self.key = urllib.urlencode( \
+                [('include', _format_selector(s)) for s in sorted(include)]
+                + [('exclude', _format_selector(s)) for s in sorted(exclude)])
+
+    def matches(self, event):
+        if self.include and not self._match(self.include, event):
+            return False
+        return not self._match(self.exclude, event)
+
+    def filter_events(self, evs):
+        return [e for e in evs if self.matches(e)]
+
+    @staticmethod
+    def _match(selectors, event):
+        return ((event.application_id, None) in selectors
+                or (event.application_id, event.event_type) in selectors)
+
+    @staticmethod
+    def parse(arguments):
+        """Creates a filter from the query arguments of a request.
+
+        `arguments` maps names to lists of values, as in
+        `tornado.httputil.HTTPServerRequest.query_arguments`.
+        Returns None if there are no filter arguments.
+
+        """
+        include = [_parse_selector(v) for v in arguments.get('include', [])]
+        exclude = [_parse_selector(v) for v in arguments.get('exclude', [])]
+        if include or exclude:
+            return SubscriptionFilter(include=include, exclude=exclude)
+        else:
+            return None
+
+
+class FilteringDispatcher(object):
+    """Wraps the dispatcher of a stream in order to serve filtered views.
+
+    The wrapper must replace the `dispatcher` attribute of the stream
+    before the server is started, so that the handlers of the stream
+    use it. Views are created when the first client with a given
+    filter connects and removed after they have been without clients
+    for at least `idle_period` milliseconds.
+
+    """
+    def __init__(self, dispatcher, stream, max_views=16,
+                 num_recent_events=2048, idle_period=120000):
+        self.dispatcher = dispatcher
+        self.stream = stream
+        self.max_views = max_views
+        self.num_recent_events = num_recent_events
+        self.views = {}
+        self.idle_timer = tornado.ioloop.PeriodicCallback( \
+                                                self._remove_idle_views,
+                                                idle_period // 2,
+                                                io_loop=stream.ioloop)
+        self.idle_timer.start()
+
+    @property
+    def num_clients(self):
+        return (self.dispatcher.num_clients
+                + sum(view.dispatcher.num_clients \
+                      for view in self.views.values()))
+
+    def register_client(self, client, **kwargs):
+        subscription_filter, kwargs = self._subscription(client, kwargs)
+        if subscription_filter is None:
+            self.dispatcher.register_client(client, **kwargs)
+        else:
+            self._view(subscription_filter).dispatcher.register_client( \
+                                                            client, **kwargs)
+
+    def dispatch_immediate(self, evs):
+        self.dispatcher.dispatch_immediate(evs)
+        for view in self.views.values():
+            view.dispatcher.dispatch_immediate( \
+                                    view.subscription_filter.filter_events(evs))
+
+    def dispatch(self, evs):
+        self.dispatcher.dispatch(evs)
+        for view in self.views.values():
+            view.dispatcher.dispatch(view.subscription_filter.filter_events(evs))
+
+    def close(self):
+        self.dispatcher.close()
+        for view in self.views.values():
+            view.close()
+        self.views = {}
+        self.idle_timer.stop()
+
+    def __getattr__(self, name):
+        # Anything else is provided by the wrapped dispatcher
+        return getattr(self.dispatcher, name)
+
+    def _subscription(self, client, kwargs):
+        handler = getattr(client, 'handler', None)
+        if handler is None:
+            # Local clients
+            return None, kwargs
+        arguments = _query_arguments(handler.request.query_arguments)
+        try:
+            subscription_filter = SubscriptionFilter.parse(arguments)
+        except ValueError:
+            raise tornado.web.HTTPError(400, 'Bad subscription filter')
+        if (kwargs.get('last_event_seen') is None
+            and 'last-seen' in arguments):
+            kwargs = dict(kwargs, last_event_seen=arguments['last-seen'][0])
+        return subscription_filter, kwargs
+
+    def _view(self, subscription_filter):
+        view = self.views.get(subscription_filter.key)
+        if view is None:
+            if len(self.views) >= self.max_views:
+                raise tornado.web.HTTPError(503, 'Too many filtered views')
+            view = _FilteredView(self.stream, subscription_filter,
+                                 self.num_recent_events)
+            # Make the recent events available to clients that reconnect
+            view.dispatcher.recent_events.append_events( \
+                subscription_filter.filter_events( \
+                    self.dispatcher.recent_events.most_recent( \
+                                                self.num_recent_events)))
+            self.views[subscription_filter.key] = view
+            logging.info('{}: new filtered view: {}'\
+                         .format(self.stream.path, subscription_filter.key))
+        view.idle = False
+        return view
+
+    def _remove_idle_views(self):
+        for key, view in list(self.views.items()):
+            if view.dispatcher.num_clients == 0:
+                if view.idle:
+                    view.close()
+                    del self.views[key]
+                    logging.info('{}: removed filtered view: {}'\
+                                 .format(self.stream.path, key))
+                else:
+                    view.idle = True
+
+
+class _FilteredView(object):
+    def __init__(self, stream, subscription_filter, num_recent_events):
+        # The view plays the role of the stream for its dispatcher,
+        # so that the events are not counted twice in the stream stats
+        self.path = stream.path
+        self.label = stream.label
+        self.stats = _NullStats()
+        self.subscription_filter = subscription_filter
+        self.dispatcher = ztreamy.server._EventDispatcher( \
+                                        self,
+                                        num_recent_events=num_recent_events,
+                                        ioloop=stream.ioloop)
+        self.idle = False
+
+    def close(self):
+        self.dispatcher.close()
+        self.dispatcher.periodic_maintenance_timer.stop()
+
+
+class _NullStats(object):
+    def count_events(self, num_events):
+        pass
+
+
+def subscription_url(url, include=(), exclude=()):
+    """Appends the query parameters of a filter to a stream URL."""
+    subscription_filter = SubscriptionFilter(include=include, exclude=exclude)
+    if not subscription_filter.key:
+        return url
+    elif '?' in url:
+        return url + '&' + subscription_filter.key
+    else:
+        return url + '?' + subscription_filter.key
+
+def _parse_selector(value):
+    parts = value.split('/', 1)
+    if not parts[0]:
+        raise ValueError('Empty application id in filter')
+    if len(parts) == 1:
+        return (parts[0], None)
+    else:
+        return (parts[0], parts[1])
+
+def _format_selector(selector):
+    if selector[1] is None:
+        return selector[0].encode('utf-8')
+    else:
+        return '/'.join(selector).encode('utf-8')
+
+def _query_arguments(query_arguments):
+    """Decodes the query arguments of a request.
+
+    The ztreamy client appends '?last-seen=...' to the URL even when it
+    already has a query, so the values are split again at '?'.
+
+    """
+    arguments = {}
+    for name, values in query_arguments.items():
+        for value in values:
+            value = value.decode('utf-8')
+            if '?' in value:
+                value, extra = value.split('?', 1)
+                for extra_name, extra_values \
+                        in urlparse.parse_qs(extra).items():
+                    arguments.setdefault(extra_name, []).extend(extra_values)
+            arguments.setdefault(name, []).append(value)
+    return arguments
@@ -27,6 +27,7 @@ def main():
                                       parse_event_body=True,
                                       buffering_time=buffering_time,
                                       allow_publish=True)
+    utils.use_compact_recent_events(test_stream, args.recent_events_bytes)
     server.add_stream(test_stream)
     try:
         server.start()
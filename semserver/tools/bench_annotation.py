@@ -0,0 +1,226 @@
+"""Annotation throughput benchmark with synthetic HERMES events.
+
+Each event type is benchmarked in a separate process, so that
+the peak memory reported for it is not affected by the other types.
+The results are printed as CSV, or as one JSON object per line
+with the --json option.
+
+"""
+from __future__ import unicode_literals, print_function, division
+
+import argparse
+import datetime
+import json
+import multiprocessing
+import random
+import resource
+import time
+
+import rdflib
+import ztreamy.events
+
+from .. import annotate
+from .. import rdftext
+
+
+# Value generator for each SmartDriver event type
+driver_values = {
+    'Average Speed Section': lambda: random.uniform(10, 120),
+    'Standard Deviation of Vehicle Speed Section': \
+                                        lambda: random.uniform(0, 20),
+    'Inefficient Speed Section': lambda: random.uniform(90, 150),
+    'Heart Rate Section': lambda: random.uniform(60, 100),
+    'Standard Deviation Heart Rate Section': lambda: random.uniform(0, 15),
+    'High Heart Rate': lambda: random.uniform(120, 180),
+    'Stops Section': lambda: float(random.randint(0, 10)),
+    'Positive Kinetic Energy': lambda: random.uniform(0, 1),
+    'High Acceleration': lambda: random.uniform(2, 5),
+    'High Deceleration': lambda: random.uniform(-5, -2),
+}
+
+fields = ('event_type', 'annotator', 'format', 'events', 'triples_per_event',
+          'bytes_per_event', 'events_per_second', 'triples_per_second',
+          'peak_rss_kb', 'rss_increase_kb')
+
+
+def create_driver_event(top_key, user_id):
+    body = {
+        top_key: {
+            'orientation': random.uniform(0, 360),
+            'latitude': random.uniform(40.3, 40.5),
+            'longitude': random.uniform(-3.8, -3.6),
+            'value': driver_values[top_key](),
+            'distancia': random.uniform(0, 10000),
+        }
+    }
+    return ztreamy.events.JSONEvent( \
+                    user_id, 'application/json', body,
+                    application_id=annotate.HermesAnnotator.application_id_driver)
+
+def create_steps_event(user_id, num_days=1, num_samples=100):
+    body = {'dataset': [{
+        'dateTime': _fitbit_date(day),
+        'stepsList': [{'timeLog': _fitbit_time(i),
+                       'steps': random.randint(0, 200)} \
+                      for i in range(num_samples)],
+    } for day in range(num_days)]}
+    return ztreamy.events.JSONEvent( \
+                    user_id, 'application/json', body,
+                    application_id=annotate.HermesAnnotator.application_id_steps)
+
+def create_heart_rate_event(user_id, num_days=1, num_samples=100):
+    body = {'dataset': [{
+        'dateTime': _fitbit_date(day),
+        'heartRateList': [{'timeLog': _fitbit_time(i),
+                           'heartRate': random.randint(50, 180)} \
+                          for i in range(num_samples)],
+    } for day in range(num_days)]}
+    return ztreamy.events.JSONEvent( \
+            user_id, 'application/json', body,
+            application_id=annotate.HermesAnnotator.application_id_heart_rate)
+
+def create_sleep_event(user_id, num_days=1):
+    body = {'dataset': [{
+        'dateTime': _fitbit_date(day),
+        'awakenings': random.randint(0, 5),
+        'minutesAsleep': random.randint(300, 500),
+        'minutesInBed': random.randint(320, 540),
+        'startTime': '23:{:02d}:00'.format(random.randint(0, 59)),
+        'endTime': '07:{:02d}:00'.format(random.randint(0, 59)),
+    } for day in range(num_days)]}
+    return ztreamy.events.JSONEvent( \
+                    user_id, 'application/json', body,
+                    application_id=annotate.HermesAnnotator.application_id_sleep)
+
+def event_types():
+    return sorted(driver_values) + ['Steps', 'Heart Rate', 'Sleep']
+
+def create_events(event_type, num_events, num_users=100, num_days=1,
+                  num_samples=100):
+    users = ['user-{}'.format(i) for i in range(num_users)]
+    if event_type in driver_values:
+        return [create_driver_event(event_type, random.choice(users)) \
+                for _ in range(num_events)]
+    elif event_type == 'Steps':
+        return [create_steps_event(random.choice(users), num_days,
+                                   num_samples) \
+                for _ in range(num_events)]
+    elif event_type == 'Heart Rate':
+        return [create_heart_rate_event(random.choice(users), num_days,
+                                        num_samples) \
+                for _ in range(num_events)]
+    elif event_type == 'Sleep':
+        return [create_sleep_event(random.choice(users), num_days) \
+                for _ in range(num_events)]
+    else:
+        raise ValueError('Unknown event type: ' + event_type)
+
+def benchmark(event_type, args):
+    """Runs the benchmark of an event type and returns its results."""
+    events = create_events(event_type, args.num_events,
+                           num_days=args.num_days,
+                           num_samples=args.num_samples)
+    if args.annotator == 'rdflib':
+        annotator = annotate.HermesAnnotator(output_format=args.format)
+    else:
+        annotator = annotate.HermesTemplateAnnotator(output_format=args.format)
+    initial_rss = _max_rss()
+    num_bytes = 0
+    start = time.time()
+    for i in range(0, len(events), args.batch_size):
+        for event in annotator.annotate_events(events[i:i + args.batch_size]):
+            num_bytes += len(event.serialize_body())
+    elapsed = time.time() - start
+    triples = _count_triples(annotator, events[0])
+    return {
+        'event_type': event_type,
+        'annotator': args.annotator,
+        'format': args.format,
+        'events': len(events),
+        'triples_per_event': triples,
+        'bytes_per_event': num_bytes // len(events),
+        'events_per_second': round(len(events) / elapsed, 1),
+        'triples_per_second': round(triples * len(events) / elapsed, 1),
+        'peak_rss_kb': _max_rss(),
+        'rss_increase_kb': _max_rss() - initial_rss,
+    }
+
+def _run_benchmark(arguments):
+    return benchmark(*arguments)
+
+def _count_triples(annotator, event):
+    # Approximated from one event (datasets have a fixed size)
+    annotated = annotator.annotate_event(event)[0]
+    if isinstance(annotated.body, rdflib.Graph):
+        return len(annotated.body)
+    graph = rdflib.Graph()
+    graph.parse(data=annotated.serialize_body(),
+                format=_rdflib_formats[annotated.syntax])
+    return len(graph)
+
+def _max_rss():
+    # In KiB in Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def _fitbit_date(day):
+    date = datetime.date(2016, 1, 1) + datetime.timedelta(days=day)
+    return date.strftime('%d/%m/%Y')
+
+def _fitbit_time(sample):
+    return '{:02d}:{:02d}:00'.format(sample // 60 % 24, sample % 60)
+
+_rdflib_formats = {
+    'text/n3': 'n3',
+    'application/n-triples': 'nt',
+    'application/ld+json': 'json-ld',
+}
+
+def _parse_args():
+    parser = argparse.ArgumentParser( \
+                    description='Benchmark the annotation of HERMES events.')
+    parser.add_argument('-n', '--events', type=int, dest='num_events',
+                        default=1000,
+                        help='number of events per event type')
+    parser.add_argument('-b', '--batch-size', type=int, dest='batch_size',
+                        default=20,
+                        help='events per call to annotate_events')
+    parser.add_argument('-d', '--days', type=int, dest='num_days',
+                        default=1,
+                        help='days in each Fitbit dataset')
+    parser.add_argument('-s', '--samples', type=int, dest='num_samples',
+                        default=100,
+                        help='samples per day in steps and heart rate data')
+    parser.add_argument('-a', '--annotator', choices=('template', 'rdflib'),
+                        default='template',
+                        help='annotator to benchmark')
+    parser.add_argument('-f', '--format', choices=list(rdftext.output_formats),
+                        default='n3',
+                        help='output format of the annotations')
+    parser.add_argument('-t', '--type', dest='event_types', action='append',
+                        choices=event_types(),
+                        help='event type to benchmark (default: all)')
+    parser.add_argument('--json', action='store_true', dest='json',
+                        help='print one JSON object per line instead of CSV')
+    return parser.parse_args()
+
+def main():
+    args = _parse_args()
+    if not args.json:
+        print(','.join(fields))
+    for event_type in args.event_types or event_types():
+        # A new process for each type, in order to measure its memory peak
+        pool = multiprocessing.Pool(processes=1)
+        try:
+            result = pool.apply(_run_benchmark, ((event_type, args), ))
+        finally:
+            pool.terminate()
+        if args.json:
+            print(json.dumps(result, sort_keys=True))
+        else:
+            print(','.join('"{}"'.format(result[field]) \
+                               if field == 'event_type' \
+                               else unicode(result[field]) \
+                           for field in fields))
+
+if __name__ == "__main__":
+    main()
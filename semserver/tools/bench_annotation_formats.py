@@ -0,0 +1,50 @@
+from __future__ import unicode_literals, print_function
+
+import argparse
+import timeit
+
+from .. import annotate
+from .. import rdftext
+from .bench_annotation import create_driver_event, create_steps_event
+
+
+def benchmark(annotator, event, repetitions):
+    data = annotator.annotate_event(event)[0].serialize_body()
+    annotate_time = timeit.timeit( \
+                    lambda: annotator.annotate_event(event)[0].serialize_body(),
+                    number=repetitions)
+    return len(data), annotate_time / repetitions
+
+def _parse_args():
+    parser = argparse.ArgumentParser( \
+                    description='Benchmark the output formats of annotations.')
+    parser.add_argument('-s', '--samples', type=int, dest='num_samples',
+                        default=100,
+                        help='number of samples in the steps event')
+    parser.add_argument('-n', '--repetitions', type=int, dest='repetitions',
+                        default=1000,
+                        help='number of annotations per format')
+    parser.add_argument('--rdflib', action='store_true', dest='rdflib',
+                        help='include the rdflib-based annotator as baseline')
+    return parser.parse_args()
+
+def main():
+    args = _parse_args()
+    annotators = [('template', format_,
+                   annotate.HermesTemplateAnnotator(output_format=format_)) \
+                  for format_ in rdftext.output_formats]
+    if args.rdflib:
+        annotators.insert(0, ('rdflib', 'n3', annotate.HermesAnnotator()))
+    events = [('driver', create_driver_event('High Acceleration', 'user-1')),
+              ('steps', create_steps_event('user-1',
+                                           num_samples=args.num_samples))]
+    print('event,annotator,format,bytes,cpu_us')
+    for event_label, event in events:
+        for annotator_label, format_, annotator in annotators:
+            size, annotate_time = benchmark(annotator, event, args.repetitions)
+            print('{},{},{},{},{:.01f}'.format(event_label, annotator_label,
+                                               format_, size,
+                                               annotate_time * 1e6))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""Benchmark the publish latency with large Data Section events.
+
+The IOLoop of the collector processes publish requests one at a time.
+This benchmark measures the time it takes to deserialize each request
+with every body-parsing policy, and replays a sequence of requests
+(Poisson arrivals) through a single-server queue with those times.
+It reports the latency percentiles of the Vehicle Location requests,
+which wait behind the Data Section requests that arrive before them.
+
+"""
+from __future__ import unicode_literals, print_function
+
+import argparse
+import random
+import time
+
+import ztreamy
+import ztreamy.events
+
+from .. import collector
+from .. import rawevents
+
+
+def data_section_event(num_samples):
+    samples = [{'latitude': 40.339300 + i * 1e-5,
+                'longitude': -3.773988 + i * 1e-5,
+                'timeStamp': '2016-02-01T10:00:{:02d}.000+01:00'\
+                             .format(i % 60),
+                'accuracy': 5.0,
+                'speed': 50.0 + i % 10}
+               for i in range(num_samples)]
+    body = {'Data Section': {'roadSection': samples,
+                             'rrSection': [800 + i % 50 \
+                                           for i in range(num_samples)],
+                             'averageSpeed': 52.3,
+                             'medianSpeed': 53.0,
+                             'accelerationPeaks': [1.2, 1.5]}}
+    return ztreamy.events.JSONEvent('user-1', 'application/json', body,
+                                    application_id='SmartDriver',
+                                    event_type='Data Section')
+
+def location_event():
+    body = {'Location': {'latitude': 40.339300,
+                         'longitude': -3.773988,
+                         'speed': 50.0,
+                         'accuracy': 5.0,
+                         'score': 3}}
+    return ztreamy.events.JSONEvent('user-1', 'application/json', body,
+                                    application_id='SmartDriver',
+                                    event_type='Vehicle Location')
+
+def create_deserializer(policy, max_body_size):
+    if policy == 'inline':
+        return ztreamy.events.Deserializer()
+    else:
+        return rawevents.DeferredBodyDeserializer( \
+                    (), max_body_size=max_body_size,
+                    parsed_events=collector.PublishRequestHandler.PARSED_EVENTS)
+
+def service_time(policy, data, max_body_size, repetitions):
+    start = time.time()
+    for _ in range(repetitions):
+        create_deserializer(policy, max_body_size).deserialize(data,
+                                                               complete=True)
+    return (time.time() - start) / repetitions
+
+def simulate(requests, service_times, rate):
+    """Returns the latency of each request in a single-server queue."""
+    latencies = []
+    arrival = finish = 0.0
+    for kind in requests:
+        arrival += random.expovariate(rate)
+        finish = max(arrival, finish) + service_times[kind]
+        latencies.append((kind, finish - arrival))
+    return latencies
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def _parse_args():
+    parser = argparse.ArgumentParser( \
+                    description='Benchmark the publish latency of locations '
+                                'with large Data Section events.')
+    parser.add_argument('-s', '--samples', type=int, dest='num_samples',
+                        default=600,
+                        help='samples per Data Section event')
+    parser.add_argument('-r', '--rate', type=float, dest='rate',
+                        default=200.0,
+                        help='publish requests per second')
+    parser.add_argument('-f', '--data-section-fraction', type=float,
+                        dest='fraction', default=0.05,
+                        help='fraction of Data Section requests')
+    parser.add_argument('-n', '--requests', type=int, dest='num_requests',
+                        default=100000,
+                        help='number of simulated requests')
+    parser.add_argument('--max-parsed-body-size', type=int,
+                        dest='max_parsed_body_size',
+                        default=collector.MAX_PARSED_BODY_SIZE,
+                        help='threshold of the deferred policy')
+    parser.add_argument('--repetitions', type=int, dest='repetitions',
+                        default=200,
+                        help='deserializations for measuring each request')
+    return parser.parse_args()
+
+def main():
+    args = _parse_args()
+    data = {'section': ztreamy.serialize_events( \
+                                [data_section_event(args.num_samples)]),
+            'location': ztreamy.serialize_events([location_event()])}
+    random.seed(1)
+    requests = ['section' if random.random() < args.fraction else 'location' \
+                for _ in range(args.num_requests)]
+    print('policy,section_bytes,section_us,location_us,'
+          'location_p50_ms,location_p99_ms,location_max_ms')
+    for policy in ('inline', 'deferred'):
+        service_times = dict((kind, service_time(policy, data[kind],
+                                                 args.max_parsed_body_size,
+                                                 args.repetitions)) \
+                             for kind in data)
+        random.seed(2)
+        latencies = [latency for kind, latency \
+                     in simulate(requests, service_times, args.rate) \
+                     if kind == 'location']
+        print('{},{},{:.01f},{:.01f},{:.03f},{:.03f},{:.03f}'\
+              .format(policy, len(data['section']),
+                      service_times['section'] * 1e6,
+                      service_times['location'] * 1e6,
+                      percentile(latencies, 0.5) * 1e3,
+                      percentile(latencies, 0.99) * 1e3,
+                      max(latencies) * 1e3))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+from __future__ import unicode_literals, print_function
+
+import argparse
+import random
+import timeit
+
+from .. import feedback
+from .. import locations
+
+
+def create_reply(num_scores):
+    base = locations.Location(40.339300, -3.773988)
+    scores = [feedback.fake_driver_score(base) for _ in range(num_scores)]
+    previous = locations.Location(base.lat + random.uniform(-0.001, 0.001),
+                                  base.long + random.uniform(-0.001, 0.001))
+    return feedback.ScoresReply(feedback.ScoresReply.SCORES,
+                                previous=previous,
+                                scores=scores)
+
+def benchmark(media_type, reply, repetitions):
+    data = reply.serialize(media_type=media_type)
+    encode_time = timeit.timeit(lambda: reply.serialize(media_type=media_type),
+                                number=repetitions)
+    decode_time = timeit.timeit( \
+                    lambda: feedback.ScoresReply.parse(data,
+                                                       media_type=media_type),
+                    number=repetitions)
+    return len(data), encode_time / repetitions, decode_time / repetitions
+
+def _parse_args():
+    parser = argparse.ArgumentParser( \
+                    description='Benchmark the scores reply formats.')
+    parser.add_argument('-s', '--scores', type=int, dest='num_scores',
+                        default=10,
+                        help='number of scores per reply')
+    parser.add_argument('-n', '--repetitions', type=int, dest='repetitions',
+                        default=100000,
+                        help='number of encode/decode operations')
+    return parser.parse_args()
+
+def main():
+    args = _parse_args()
+    reply = create_reply(args.num_scores)
+    print('format,bytes,encode_us,decode_us')
+    for label, media_type in (('text', feedback.SCORES_TEXT_MEDIA_TYPE),
+                              ('binary', feedback.SCORES_BINARY_MEDIA_TYPE)):
+        size, encode_time, decode_time = benchmark(media_type, reply,
+                                                   args.repetitions)
+        print('{},{},{:.03f},{:.03f}'.format(label, size,
+                                             encode_time * 1e6,
+                                             decode_time * 1e6))
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,7 @@ from __future__ import unicode_literals
 import sys
 import gzip
 import collections
+import itertools
 import argparse
 import copy
 import logging
@@ -15,6 +16,8 @@ import requests
 import ztreamy
 
 from .. import locations as loc
+from .. import jsonstream
+from .. import rawevents
 
 
 simple_event_types = (
@@ -36,6 +39,9 @@ _tz_london = dateutil.tz.tz.gettz('Europe/London')
 ROAD_INFO_URL = ('http://cronos.lbd.org.es'
                  '/hermes/api/smartdriver/network/link')
 
+# Larger bodies are decoded incrementally (see `jsonstream`)
+MAX_PARSED_BODY_SIZE = 2**20
+
 
 class Record(object):
     def __init__(self, user_id, default_tz=None):
@@ -285,9 +291,14 @@ def tz_for_latitude(latitude):
     else:
         return _tz_london
 
-def read_file(filename):
+def read_file(filename, max_parsed_body_size=MAX_PARSED_BODY_SIZE):
     with gzip.GzipFile(filename, 'r') as f:
-        for events in ztreamy.Deserializer().deserialize_file(f):
+        # Larger bodies are kept unparsed, except for the simple events
+        deserializer = rawevents.DeferredBodyDeserializer( \
+                    (), max_body_size=max_parsed_body_size,
+                    parsed_events=[('SmartDriver', event_type) \
+                                   for event_type in simple_event_types])
+        for events in deserializer.deserialize_file(f):
             for e in events:
                 if not e.source_id in ignore_source_ids:
                     yield e
@@ -299,52 +310,80 @@ def group(events):
     return groups
 
 def extract_data(event):
+    """Generator of the records of an event."""
     try:
         if event.event_type == 'Data Section':
-            records = extract_data_section_event(event)
+            for record in extract_data_section_event(event):
+                yield record
         else:
-            records = extract_simple_event(event)
+            for record in extract_simple_event(event):
+                yield record
     except ValueError:
         print('Warning: Value Error {}'.format(sys.exc_info()[1]))
-        records = []
-    return records
 
 def extract_positions(event):
-    records = []
-    if 'roadSection' in event.body['Data Section']:
-        try:
-            samples = event.body['Data Section']['roadSection']
-            for sample in samples:
-                default_tz = tz_for_latitude(sample['latitude'])
-                record = Record(event.source_id, default_tz=default_tz)
-                record.record_type = 'Vehicle Location'
-                record.latitude = sample['latitude']
-                record.longitude = sample['longitude']
-                record.timestamp = sample['timeStamp']
-                if 'accuracy' in sample:
-                    record.accuracy = sample['accuracy']
-                if 'speed' in sample:
-                    record.speed = sample['speed']
-                try:
-                    # Check that the timestamp is correct
-                    record.time
-                except ztreamy.ZtreamyException:
-                    logging.warning('Discard record because of timestamp: {}'\
-                                    .format(record.timestamp))
-                else:
-                    records.append(record)
-            if 'rrSection' in event.body['Data Section']:
-                samples = event.body['Data Section']['rrSection']
-                if len(samples) == len(records):
-                    for rr_value, record in zip(samples, records):
-                        record.rr_value = rr_value
-                elif samples:
-                    logging.warning('roadSection of size {} '
-                                    'with rrSection of size {}'.\
-                                    format(len(records), len(samples)))
-        except KeyError:
-            logging.warning('Key error in a Data Section event')
-    return records
+    """Generator of the location records of a Data Section event.
+
+    The samples are decoded one at a time when the body of the event
+    has not been parsed (see `jsonstream`), and each record is yielded
+    as soon as it is built. The rrSection values are paired with
+    the samples by position. They are left out when both arrays have
+    different lengths, which is checked before the first record.
+
+    """
+    num_samples = _array_length(event, 'roadSection')
+    num_rr_values = _array_length(event, 'rrSection')
+    if num_rr_values and num_rr_values != num_samples:
+        logging.warning('roadSection of size {} with rrSection of size {}'\
+                        .format(num_samples, num_rr_values))
+        rr_values = itertools.repeat(None)
+    else:
+        rr_values = itertools.chain(_iter_samples(event, 'rrSection'),
+                                    itertools.repeat(None))
+    try:
+        for sample, rr_value in itertools.izip( \
+                                    _iter_samples(event, 'roadSection'),
+                                    rr_values):
+            default_tz = tz_for_latitude(sample['latitude'])
+            record = Record(event.source_id, default_tz=default_tz)
+            record.record_type = 'Vehicle Location'
+            record.latitude = sample['latitude']
+            record.longitude = sample['longitude']
+            record.timestamp = sample['timeStamp']
+            record.rr_value = rr_value
+            if 'accuracy' in sample:
+                record.accuracy = sample['accuracy']
+            if 'speed' in sample:
+                record.speed = sample['speed']
+            try:
+                # Check that the timestamp is correct
+                record.time
+            except ztreamy.ZtreamyException:
+                logging.warning('Discard record because of timestamp: {}'\
+                                .format(record.timestamp))
+            else:
+                yield record
+    except KeyError:
+        logging.warning('Key error in a Data Section event')
+
+def _iter_samples(event, key):
+    if isinstance(event.body, dict):
+        return iter(event.body['Data Section'].get(key, []))
+    else:
+        return jsonstream.iter_array(event.body, ('Data Section', key))
+
+def _array_length(event, key):
+    if isinstance(event.body, dict):
+        return len(event.body['Data Section'].get(key, []))
+    else:
+        return jsonstream.array_length(event.body, ('Data Section', key))
+
+def _data_section_summary(event):
+    if isinstance(event.body, dict):
+        return event.body.get('Data Section')
+    else:
+        return jsonstream.load_object(event.body, ('Data Section',),
+                                      skip=('roadSection', 'rrSection'))
 
 def extract_simple_event(event):
     event_type = event.event_type
@@ -378,58 +417,72 @@ def extract_simple_event(event):
     return records
 
 def extract_data_section_event(event):
-    records = []
-    if 'Data Section' in event.body:
-        data = event.body['Data Section']
-        locations = extract_positions(event)
-        if len(locations) >= 2:
-            # Create a common base record and clone it
-            base_record = Record(event.source_id)
-            base_record.timestamp_ini = locations[0].timestamp
-            base_record.timestamp = locations[-1].timestamp
-            base_record.latitude_ini = locations[0].latitude
-            base_record.latitude = locations[-1].latitude
-            base_record.longitude_ini = locations[0].longitude
-            base_record.longitude = locations[-1].longitude
-            if hasattr(locations[0], 'accuracy'):
-                base_record.accuracy_ini = locations[0].accuracy
-            if hasattr(locations[-1], 'accuracy'):
-                base_record.accuracy = locations[-1].accuracy
-            # Vehicle speed:
-            speed_record = base_record.clone()
-            speed_record.record_type = 'Vehicle Speed'
-            speed_record.median_value = data['medianSpeed']
-            speed_record.mean_value = data['averageSpeed']
-            speed_record.std_dev = data['standardDeviationSpeed']
-            speed_record.min_value = data['minSpeed']
-            speed_record.max_value = data['maxSpeed']
-            # Driver's heart rate
-            heart_record = base_record.clone()
-            heart_record.record_type = 'Heart Rate'
-            heart_record.mean_value = data['averageHeartRate']
-            heart_record.std_dev = data['standardDeviationHeartRate']
-            # Driver's RR
-            rr_record = base_record.clone()
-            rr_record.record_type = 'RR'
-            rr_record.mean_value = data['averageRR']
-            rr_record.std_dev = data['standardDeviationRR']
-            # Vehicle positive kinetic energy
-            pke_record = base_record.clone()
-            pke_record.record_type = 'Pke'
-            pke_record.value = data['pke']
-            # Collect all the records into a list
-            records.extend(locations)
-            records.append(speed_record)
-            records.append(pke_record)
-            if heart_record.mean_value > 0:
-                records.append(heart_record)
-            if rr_record.mean_value > 0:
-                records.append(rr_record)
-            # Enrich data with road info
-            for record in records:
-                record.road_info = get_road_info_region(record.latitude,
-                                                        record.longitude)
-    return records
+    """Generator of the records of a Data Section event.
+
+    The location records are yielded first, followed by the summary
+    records of the section.
+
+    """
+    data = _data_section_summary(event)
+    if data is None:
+        return
+    first_location = None
+    last_location = None
+    for location in extract_positions(event):
+        if first_location is None:
+            first_location = location
+            continue
+        elif last_location is None:
+            # Sections with a single location are discarded
+            yield _with_road_info(first_location)
+        last_location = location
+        yield _with_road_info(location)
+    if last_location is None:
+        return
+    # Create a common base record and clone it
+    base_record = Record(event.source_id)
+    base_record.timestamp_ini = first_location.timestamp
+    base_record.timestamp = last_location.timestamp
+    base_record.latitude_ini = first_location.latitude
+    base_record.latitude = last_location.latitude
+    base_record.longitude_ini = first_location.longitude
+    base_record.longitude = last_location.longitude
+    if hasattr(first_location, 'accuracy'):
+        base_record.accuracy_ini = first_location.accuracy
+    if hasattr(last_location, 'accuracy'):
+        base_record.accuracy = last_location.accuracy
+    # Vehicle speed:
+    speed_record = base_record.clone()
+    speed_record.record_type = 'Vehicle Speed'
+    speed_record.median_value = data['medianSpeed']
+    speed_record.mean_value = data['averageSpeed']
+    speed_record.std_dev = data['standardDeviationSpeed']
+    speed_record.min_value = data['minSpeed']
+    speed_record.max_value = data['maxSpeed']
+    # Driver's heart rate
+    heart_record = base_record.clone()
+    heart_record.record_type = 'Heart Rate'
+    heart_record.mean_value = data['averageHeartRate']
+    heart_record.std_dev = data['standardDeviationHeartRate']
+    # Driver's RR
+    rr_record = base_record.clone()
+    rr_record.record_type = 'RR'
+    rr_record.mean_value = data['averageRR']
+    rr_record.std_dev = data['standardDeviationRR']
+    # Vehicle positive kinetic energy
+    pke_record = base_record.clone()
+    pke_record.record_type = 'Pke'
+    pke_record.value = data['pke']
+    yield _with_road_info(speed_record)
+    yield _with_road_info(pke_record)
+    if heart_record.mean_value > 0:
+        yield _with_road_info(heart_record)
+    if rr_record.mean_value > 0:
+        yield _with_road_info(rr_record)
+
+def _with_road_info(record):
+    record.road_info = get_road_info_region(record.latitude, record.longitude)
+    return record
 
 def write_records(records):
     logging.info('Writing {} records'.format(len(records)))
@@ -443,7 +496,8 @@ def clear_records_file():
     with open('data.csv', mode='w'):
         pass
 
-def process_file(events_file, from_timestamp=None):
+def process_file(events_file, from_timestamp=None,
+                 max_parsed_body_size=MAX_PARSED_BODY_SIZE):
     clear_records_file()
     if from_timestamp is not None:
         from_time = ztreamy.parse_timestamp(from_timestamp)
@@ -452,9 +506,9 @@ def process_file(events_file, from_timestamp=None):
     records = []
     num_events = 0
     num_records = 0
-    for event in read_file(events_file):
+    for event in read_file(events_file,
+                           max_parsed_body_size=max_parsed_body_size):
         num_events += 1
-        new_records = extract_data(event)
         new_records = [r for r in extract_data(event) \
                        if r.time >= from_time]
         records.extend(new_records)
@@ -483,6 +537,11 @@ def _parse_args():
     parser.add_argument('-c', '--road-info-cache', dest='road_info_cache_file',
                         default=None,
                         help='file for loading/writing the road info cache')
+    parser.add_argument('--max-parsed-body-size', type=int,
+                        dest='max_parsed_body_size',
+                        default=MAX_PARSED_BODY_SIZE,
+                        help=('Bodies longer than this number of bytes are '
+                              'decoded incrementally'))
     return parser.parse_args()
 
 def main():
@@ -495,7 +554,8 @@ def main():
     if load_info_cache:
         load_info_cache(args.road_info_cache_file)
     try:
-        process_file(args.events_file, from_timestamp=args.from_date)
+        process_file(args.events_file, from_timestamp=args.from_date,
+                     max_parsed_body_size=args.max_parsed_body_size)
     except KeyboardInterrupt:
         pass
     finally:
@@ -6,59 +6,172 @@ import cStringIO
 import gzip
 import json
 import collections
-import itertools
+import sys
 import time
 
+import tornado.ioloop
 import ztreamy
 
+from . import eventsbuffer
+from . import persistence
+
 
 DIRNAME_LOGGING = 'logs-semserver'
+DEFAULT_RECENT_EVENTS_BYTES = 2**26
+DEFAULT_DEDUP_WINDOW = 600
+DEFAULT_DEDUP_MAX_EVENTS = 2**20
 
 
 class LatestValueBuffer(collections.MutableMapping):
     """Stores the latest data value associated to a key.
 
-    Older data items can be periodically removed through the `roll` method.
+    Older data items are periodically removed through the `roll` method.
+    Entries are grouped in `generations`. Setting or refreshing
+    a key moves it into the current generation, and each call
+    to `roll` opens a new generation and drops the oldest one
+    when there are more than `generations` of them. Therefore,
+    an entry that is not updated lives between `generations - 1`
+    and `generations` roll periods.
+
+    If `max_entries` is set, the number of entries is bounded by
+    that value: the least recently updated entry is evicted
+    in order to make room for new keys.
 
     """
-    def __init__(self):
-        self.current = {}
-        self.previous = {}
+    def __init__(self, generations=2, max_entries=None):
+        if generations < 1:
+            raise ValueError('At least one generation is needed')
+        if max_entries is not None and max_entries < 1:
+            raise ValueError('Wrong maximum number of entries')
+        self.num_generations = generations
+        self.max_entries = max_entries
+        self.generations = collections.deque([self._new_generation()])
+        self.locations = {}
+        self.num_evictions = 0
 
     def roll(self):
-        self.previous = self.current
-        self.current = {}
+        self.generations.append(self._new_generation())
+        if len(self.generations) > self.num_generations:
+            for key in self.generations.popleft():
+                del self.locations[key]
 
     def refresh(self, key):
-        if not key in self.current:
-            self.current[key] = self.previous[key]
+        generation = self.locations[key]
+        current = self.generations[-1]
+        if generation is not current or self.max_entries is not None:
+            current[key] = generation.pop(key)
+            self.locations[key] = current
+
+    def generation_stats(self):
+        """Returns a list with a GenerationStats for each generation.
+
+        The first item corresponds to the current generation.
+        Sizes are approximate (shallow sizes of keys and values).
+
+        """
+        stats = []
+        for age, generation in enumerate(reversed(self.generations)):
+            size = sys.getsizeof(generation)
+            for key, value in generation.iteritems():
+                size += sys.getsizeof(key) + sys.getsizeof(value)
+            stats.append(GenerationStats(age, len(generation), size))
+        return stats
 
     def __contains__(self, key):
-        return key in self.current or key in self.previous
+        return key in self.locations
 
     def __setitem__(self, key, value):
-        self.current[key] = value
+        generation = self.locations.get(key)
+        if generation is not None:
+            del generation[key]
+        elif (self.max_entries is not None
+              and len(self.locations) >= self.max_entries):
+            self._evict()
+        current = self.generations[-1]
+        current[key] = value
+        self.locations[key] = current
 
     def __getitem__(self, key):
-        try:
-            result = self.current[key]
-        except KeyError:
-            result = self.previous[key]
-        return result
+        return self.locations[key][key]
 
     def __delitem__(self, key):
-        try:
-            del self.current[key]
-        except KeyError:
-            del self.previous[key]
+        del self.locations.pop(key)[key]
 
     def __len__(self):
-        # Note the value is incorrect because of intersections,
-        # but we don't want to worry about this matter.
-        return len(self.current) + len(self.previous)
+        return len(self.locations)
 
     def __iter__(self):
-        return itertools.chain(self.current, self.previous)
+        return iter(self.locations)
+
+    def _new_generation(self):
+        if self.max_entries is None:
+            return {}
+        else:
+            # Keep the update order for LRU eviction
+            return collections.OrderedDict()
+
+    def _evict(self):
+        for generation in self.generations:
+            if generation:
+                key, _ = generation.popitem(last=False)
+                del self.locations[key]
+                self.num_evictions += 1
+                break
+
+
+GenerationStats = collections.namedtuple('GenerationStats',
+                                         ('age', 'entries', 'size'),
+                                         verbose=False)
+
+
+class DuplicateFilter(object):
+    """Discards the events whose id has been seen recently.
+
+    Event ids are kept in a `LatestValueBuffer` rolled every `window`
+    seconds, so they are remembered between `window` and twice that
+    time. In order to bound memory, the buffer is rolled earlier
+    when its current generation reaches half `max_events` ids.
+
+    """
+    def __init__(self, window=DEFAULT_DEDUP_WINDOW,
+                 max_events=DEFAULT_DEDUP_MAX_EVENTS, ioloop=None):
+        self.event_ids = LatestValueBuffer(generations=2)
+        self.max_generation_size = max(max_events // 2, 1)
+        self.num_duplicates = 0
+        self.num_early_rolls = 0
+        self.timer = tornado.ioloop.PeriodicCallback(self.event_ids.roll,
+                                                     window * 1000,
+                                                     io_loop=ioloop)
+
+    def filter_events(self, evs):
+        """Returns the events of `evs` that are not duplicates."""
+        accepted = []
+        for event in evs:
+            if event.event_id in self.event_ids:
+                self.num_duplicates += 1
+                continue
+            if len(self.event_ids.generations[-1]) \
+                    >= self.max_generation_size:
+                self.event_ids.roll()
+                self.num_early_rolls += 1
+            self.event_ids[event.event_id] = None
+            accepted.append(event)
+        return accepted
+
+    def log_stats(self, label):
+        logging.info('{}: {} duplicates suppressed / {} ids / '
+                     '{} early rolls'\
+                     .format(label, self.num_duplicates, len(self.event_ids),
+                             self.num_early_rolls))
+
+    @staticmethod
+    def create(window, max_events, ioloop=None):
+        """Returns a new filter, or None if `window` is 0 or None."""
+        if window:
+            return DuplicateFilter(window=window, max_events=max_events,
+                                   ioloop=ioloop)
+        else:
+            return None
 
 
 class StatsTracker(object):
@@ -190,7 +303,14 @@ def log_stats_value(label, stats):
                  '{0.real_time:.03f},{1:.03f}'\
                  .format(stats, time.time()))
 
-def add_server_options(parser, default_port, stream=False):
+def log_buffer_stats(label, buffer_):
+    logging.info('{}: {} entries / {} evicted / generations {}'\
+                 .format(label, len(buffer_), buffer_.num_evictions,
+                         ' '.join('{0.entries}:{0.size}'.format(stats) \
+                                  for stats in buffer_.generation_stats())))
+
+def add_server_options(parser, default_port, stream=False,
+                       persistent=False, dedup=False):
     parser.add_argument('-p', '--port', type=int, dest='port',
                         default=default_port, help='TCP port to use')
     parser.add_argument('--log-level', dest='log_level',
@@ -203,8 +323,91 @@ def add_server_options(parser, default_port, stream=False):
         parser.add_argument('-b', '--buffer', type=float, dest='buffer',
                             default=2.0,
                             help='Buffer time in seconds (0 for no buffering)')
+        parser.add_argument('--recent-events-bytes', type=int,
+                            dest='recent_events_bytes',
+                            default=DEFAULT_RECENT_EVENTS_BYTES,
+                            help=('Memory for the serialized recent events '
+                                  '(0 keeps a fixed number of events)'))
+    if persistent:
+        parser.add_argument('--disable-persistence',
+                            dest='disable_persistence', action='store_true')
+        parser.add_argument('--persistence-dir', dest='persistence_dir',
+                            default=None,
+                            help=('Directory of the event log '
+                                  '(default: <label>-events)'))
+        parser.add_argument('--fsync', dest='fsync',
+                            choices=persistence.EventLog.FSYNC_POLICIES,
+                            default='interval',
+                            help='When to sync the event log to disk')
+        parser.add_argument('--fsync-interval', type=float,
+                            dest='fsync_interval', default=1.0,
+                            help='Seconds between syncs with "interval"')
+        parser.add_argument('--segment-size', type=int, dest='segment_size',
+                            default=2**26,
+                            help='Bytes per event log segment')
+        parser.add_argument('--segment-period', type=float,
+                            dest='segment_period', default=3600,
+                            help='Seconds before rolling a log segment')
+        parser.add_argument('--persistence-max-bytes', type=int,
+                            dest='persistence_max_bytes', default=2**30,
+                            help='Maximum size of the event log')
+        parser.add_argument('--persistence-max-read-events', type=int,
+                            dest='persistence_max_read_events', default=10000,
+                            help=('Maximum number of events read from the '
+                                  'event log for a client'))
+    if dedup:
+        parser.add_argument('--dedup-window', type=float, dest='dedup_window',
+                            default=DEFAULT_DEDUP_WINDOW,
+                            help=('Seconds to remember event ids for '
+                                  'discarding duplicates (0 disables it)'))
+        parser.add_argument('--dedup-max-events', type=int,
+                            dest='dedup_max_events',
+                            default=DEFAULT_DEDUP_MAX_EVENTS,
+                            help='Maximum number of event ids to remember')
+
+def event_log_options(args):
+    """Returns the `persistence.EventLog` arguments from the command line.
+
+    Returns None if persistence is disabled.
 
+    """
+    if args.disable_persistence:
+        return None
+    return dict(directory=args.persistence_dir,
+                fsync=args.fsync,
+                fsync_interval=args.fsync_interval,
+                segment_size=args.segment_size,
+                segment_period=args.segment_period,
+                max_bytes=args.persistence_max_bytes,
+                max_read_events=args.persistence_max_read_events)
+
+def use_event_log(stream, preload_events, directory=None, **kwargs):
+    """Backs the recent events of a stream up to a `persistence.EventLog`.
+
+    The latest `preload_events` events of the log are loaded back
+    into memory. Returns the log, which must be closed when the stream
+    is stopped. Must be called before the dispatcher of the stream
+    is wrapped (e.g. by `subscriptions.FilteringDispatcher`).
+
+    """
+    log = persistence.EventLog(directory or '{}-events'.format(stream.label),
+                               **kwargs)
+    stream.dispatcher.recent_events = persistence.LoggedEventsBuffer( \
+                                            stream.dispatcher.recent_events,
+                                            log,
+                                            preload_events=preload_events)
+    return log
 
+def use_compact_recent_events(stream, max_bytes):
+    """Replaces the recent events buffer of a stream.
+
+    Must be called before the dispatcher of the stream is wrapped
+    (e.g. by `subscriptions.FilteringDispatcher`).
+
+    """
+    if max_bytes:
+        stream.dispatcher.recent_events = \
+                        eventsbuffer.CompactEventsBuffer(max_bytes)
 
 def serialize_object_json(data, compress=False):
     serialized = json.dumps(data.as_dict())
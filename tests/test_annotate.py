@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+import unittest
+
+import rdflib
+import rdflib.compare
+import tornado.ioloop
+import ztreamy.events
+
+import semserver.annotate as annotate
+
+
+class TestHermesTemplateAnnotator(unittest.TestCase):
+
+    def setUp(self):
+        self.annotator = annotate.HermesAnnotator()
+        self.template_annotator = annotate.HermesTemplateAnnotator()
+        self.format_annotators = [annotate.HermesTemplateAnnotator( \
+                                                    output_format=format_) \
+                                  for format_ in _parseable_formats()]
+
+    def test_driver_events(self):
+        for i, top_key in enumerate(sorted(self.annotator.classes_driver)):
+            data = {
+                'orientation': 123.456789012345,
+                'latitude': 40.33930123456789,
+                'longitude': -3.7739880001,
+                'value': 12.5 + i,
+            }
+            if i % 2 == 0:
+                data['distancia'] = 1234.5678
+            self._check_equivalent(annotate.HermesAnnotator.application_id_driver,
+                                   {top_key: data})
+
+    def test_literal_types(self):
+        self._check_equivalent(annotate.HermesAnnotator.application_id_driver,
+                               {'Stops Section': {
+                                   'orientation': 'Norte "1"\n\\ ñ\r',
+                                   'latitude': 40,
+                                   'longitude': True,
+                                   'value': 3.0,
+                                   'distancia': '17',
+                               }})
+
+    def test_steps(self):
+        body = {'dataset': [
+            {'dateTime': '01/02/2016',
+             'stepsList': [{'timeLog': '08:00:00', 'steps': 10},
+                           {'timeLog': '08:01:00', 'steps': 0}]},
+            {'dateTime': '02/02/2016', 'stepsList': []},
+        ]}
+        self._check_equivalent(annotate.HermesAnnotator.application_id_steps,
+                               body)
+
+    def test_heart_rate(self):
+        body = {'dataset': [
+            {'dateTime': '01/02/2016',
+             'heartRateList': [{'timeLog': '08:00:00', 'heartRate': 70},
+                               {'timeLog': '08:01:00', 'heartRate': 72}]},
+        ]}
+        self._check_equivalent( \
+                        annotate.HermesAnnotator.application_id_heart_rate,
+                        body)
+
+    def test_sleep(self):
+        body = {'dataset': [
+            {'dateTime': '01/02/2016', 'awakenings': 2,
+             'minutesAsleep': 400, 'minutesInBed': 430,
+             'startTime': '23:30:00', 'endTime': '07:00:00'},
+        ]}
+        self._check_equivalent(annotate.HermesAnnotator.application_id_sleep,
+                               body)
+
+    def test_unsafe_source_id(self):
+        event = self._create_event(annotate.HermesAnnotator.application_id_sleep,
+                                   {'dataset': []}, source_id='user<1>')
+        annotated = self.template_annotator.annotate_event(event)
+        self.assertNotIsInstance(annotated[0], annotate.RDFTextEvent)
+
+    def test_missing_keys(self):
+        event = self._create_event(annotate.HermesAnnotator.application_id_steps,
+                                   {'dataset': [{'dateTime': '01/02/2016'}]})
+        self.assertEqual(self.template_annotator.annotate_event(event),
+                         [event])
+
+    def test_user_uris_bounded(self):
+        annotator = annotate.HermesAnnotator()
+        annotator.user_uris.max_entries = 3
+        for i in range(10):
+            annotator.annotate_event(_steps_event('user-{}'.format(i),
+                                                  '01/02/2016'))
+        self.assertEqual(len(annotator.user_uris), 3)
+        self.assertIn('user-9', annotator.user_uris)
+        self.assertNotIn('user-0', annotator.user_uris)
+
+    def test_json_ld_output(self):
+        annotator = annotate.HermesTemplateAnnotator(output_format='json-ld')
+        event = _steps_event('user-1', '01/02/2016')
+        annotated = annotator.annotate_event(event)
+        self.assertEqual(annotated[0].syntax, 'application/ld+json')
+        data = json.loads(annotated[0].serialize_body())
+        self.assertEqual(data['@context']['hermes'],
+                         annotate.HermesAnnotator.ns_hermes)
+        node = data['@graph'][0]
+        self.assertEqual(node['@id'],
+                         'hermes:Id-Observation-{}-0'.format(event.event_id))
+        self.assertEqual(node['@type'], 'hermes:Stepping')
+        self.assertEqual(node['hermes:has_pedestrian'],
+                         {'@id': 'hermes:Id-User-user-1'})
+        self.assertEqual([item['hermes:steps'] \
+                          for item in node['hermes:has_step_set']],
+                         [10, 12])
+        self.assertEqual(node['hermes:stepping_date'],
+                         {'@value': '2016-02-01', '@type': 'xsd:date'})
+
+    def _check_equivalent(self, application_id, body, source_id='user-1'):
+        event = self._create_event(application_id, body, source_id=source_id)
+        expected = self.annotator.annotate_event(event)
+        for annotator in self.format_annotators:
+            annotated = annotator.annotate_event(event)
+            self.assertEqual(len(annotated), 1)
+            self.assertEqual(annotated[0].extra_headers,
+                             {'X-Derived-From': event.event_id})
+            if annotated[0].syntax == 'text/n3':
+                # Doubles are written with less digits in N3
+                expected_graph = _parse(expected[0].serialize_body())
+            else:
+                expected_graph = _parse(expected[0].body.serialize(format='nt'),
+                                        'application/n-triples')
+            self.assertTrue(rdflib.compare.isomorphic( \
+                                    expected_graph,
+                                    _parse(annotated[0].serialize_body(),
+                                           annotated[0].syntax)))
+
+    @staticmethod
+    def _create_event(application_id, body, source_id='user-1'):
+        return ztreamy.events.JSONEvent(source_id, 'application/json', body,
+                                        application_id=application_id)
+
+
+class TestMergeBatches(unittest.TestCase):
+
+    def test_merge_rdflib(self):
+        self._check_merge(annotate.HermesAnnotator)
+
+    def test_merge_rdflib_ntriples(self):
+        self._check_merge(annotate.HermesAnnotator, output_format='ntriples')
+
+    def test_merge_templates(self):
+        for format_ in _parseable_formats():
+            self._check_merge(annotate.HermesTemplateAnnotator,
+                              output_format=format_)
+
+    def test_merge_json_ld(self):
+        evs = [_steps_event('user-1', '01/02/2016'),
+               _steps_event('user-2', '02/02/2016')]
+        merged = annotate.HermesTemplateAnnotator( \
+                                    merge_batches=True,
+                                    output_format='json-ld')\
+                                            .annotate_events(evs)
+        self.assertEqual(len(merged), 1)
+        data = json.loads(merged[0].serialize_body())
+        self.assertEqual(len(data['@graph']), 2)
+
+    def test_merge_event_types(self):
+        app_id = annotate.HermesAnnotator.application_id_driver
+        evs = [_driver_event('Average Speed Section', 52.5),
+               _driver_event('Heart Rate Section', 80.0),
+               _driver_event('Average Speed Section', 48.0)]
+        for annotator_class in (annotate.HermesAnnotator,
+                                annotate.HermesTemplateAnnotator):
+            merged = annotator_class(merge_batches=True)\
+                                            .annotate_events(evs)
+            self.assertEqual(len(merged), 2)
+            self.assertEqual([e.event_type for e in merged],
+                             ['Average Speed Section', 'Heart Rate Section'])
+            self.assertEqual([e.application_id for e in merged],
+                             [app_id, app_id])
+            self.assertEqual(merged[0].extra_headers['X-Derived-From'],
+                             ','.join([evs[0].event_id, evs[2].event_id]))
+            self.assertEqual(merged[1].extra_headers['X-Derived-From'],
+                             evs[1].event_id)
+
+    def _check_merge(self, annotator_class, output_format='n3'):
+        evs = [_steps_event('user-1', '01/02/2016'),
+               ztreamy.events.Event('user-1', 'text/plain', 'x'),
+               _steps_event('user-2', '02/02/2016'),
+               _steps_event('user-1', '03/02/2016')]
+        expected = annotator_class().annotate_events(evs)
+        merged = annotator_class(merge_batches=True,
+                                 output_format=output_format)\
+                                        .annotate_events(evs)
+        self.assertEqual(len(merged), 2)
+        self.assertIs(merged[1], evs[1])
+        self.assertEqual(merged[0].extra_headers['X-Derived-From'],
+                         ','.join(e.event_id for e in evs if e is not evs[1]))
+        self.assertEqual(merged[0].application_id,
+                         annotate.HermesAnnotator.application_id_steps)
+        self.assertTrue(merged[0].serialize_body().count(b'@prefix hermes:')
+                        <= 1)
+        graph = rdflib.Graph()
+        for event in expected:
+            if event is not evs[1]:
+                graph += _parse(event.serialize_body())
+        self.assertTrue(rdflib.compare.isomorphic( \
+                                    graph,
+                                    _parse(merged[0].serialize_body(),
+                                           merged[0].syntax)))
+
+
+class TestAnnotationPool(unittest.TestCase):
+
+    def setUp(self):
+        self.ioloop = tornado.ioloop.IOLoop()
+        annotator = annotate.HermesTemplateAnnotator(output_format='ntriples')
+        self.stream = annotate.AnnotatedRelayStream('/annotated', [],
+                                                    annotator,
+                                                    num_workers=1,
+                                                    ioloop=self.ioloop)
+
+    def tearDown(self):
+        self.stream.pool.terminate()
+        self.ioloop.close(all_fds=True)
+
+    def test_worker_output_format(self):
+        evs = [_steps_event('user-1', '01/02/2016'),
+               _steps_event('user-2', '02/02/2016')]
+        self.stream.dispatch_events(evs)
+        annotated = self.stream.pending_batches[0][1].get(timeout=30)
+        self.assertEqual(len(annotated), 2)
+        for event in annotated:
+            self.assertEqual(event.syntax, 'application/n-triples')
+            self.assertTrue(len(_parse(event.serialize_body(),
+                                       event.syntax)) > 0)
+
+    def test_failing_event(self):
+        evs = [_steps_event('user-1', '01/02/2016'),
+               _steps_event('user-2', 'wrong date'),
+               _steps_event('user-3', '02/02/2016')]
+        self.stream.dispatch_events(evs)
+        self.stream.pending_batches[0][1].wait(timeout=30)
+        self.stream._dispatch_annotated()
+        self.assertEqual(len(self.stream.pending_batches), 0)
+        relayed = self.stream.dispatcher.recent_events.most_recent(10)
+        self.assertEqual([event.source_id for event in relayed],
+                         ['user-1', 'user-3'])
+
+
+def _steps_event(source_id, date):
+    body = {'dataset': [
+        {'dateTime': date,
+         'stepsList': [{'timeLog': '08:00:00', 'steps': 10},
+                       {'timeLog': '08:01:00', 'steps': 12}]},
+    ]}
+    return ztreamy.events.JSONEvent( \
+                        source_id, 'application/json', body,
+                        application_id=annotate.HermesAnnotator.application_id_steps)
+
+def _driver_event(event_type, value):
+    body = {event_type: {'orientation': 123.45,
+                         'latitude': 40.3393,
+                         'longitude': -3.773988,
+                         'value': value}}
+    return ztreamy.events.JSONEvent( \
+                    'user-1', 'application/json', body,
+                    application_id=annotate.HermesAnnotator.application_id_driver,
+                    event_type=event_type)
+
+
+def _parse(text, syntax='text/n3'):
+    graph = rdflib.Graph()
+    graph.parse(data=text, format=_rdflib_formats[syntax])
+    return graph
+
+def _parseable_formats():
+    formats = ['n3', 'ntriples']
+    try:
+        _parse('{}', 'application/ld+json')
+    except Exception:
+        # The JSON-LD plugin of rdflib is not available
+        pass
+    else:
+        formats.append('json-ld')
+    return formats
+
+_rdflib_formats = {
+    'text/n3': 'n3',
+    'application/n-triples': 'nt',
+    'application/ld+json': 'json-ld',
+}
@@ -0,0 +1,65 @@
+from __future__ import unicode_literals
+
+import shutil
+import tempfile
+import unittest
+
+import tornado.ioloop
+import ztreamy
+import ztreamy.events
+
+import semserver.checkpoints as checkpoints
+import semserver.dbfeed as dbfeed
+
+
+class TestCheckpoints(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.url = 'http://localhost:9109/backend/compressed'
+        self.evs = [ztreamy.events.Event('source', 'text/plain',
+                                         'body {}'.format(i),
+                                         application_id='SmartDriver',
+                                         event_type='Data Section')
+                    for i in range(5)]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_store(self):
+        store = checkpoints.CheckpointStore(self.directory)
+        self.assertIsNone(store.get(self.url))
+        store.save({self.url: 'event-1', 'http://other/stream': None})
+        store.save({self.url: 'event-2'})
+        store = checkpoints.CheckpointStore(self.directory)
+        self.assertEqual(store.get(self.url), 'event-2')
+        self.assertIsNone(store.get('http://other/stream'))
+
+    def test_client_auto_save(self):
+        received = []
+        store = checkpoints.CheckpointStore(self.directory)
+        store.save({self.url: 'event-0'})
+        client = checkpoints.CheckpointedClient([self.url], received.extend,
+                                                store, auto_save=True,
+                                                separate_events=False)
+        self.assertEqual(client.positions(), {self.url: 'event-0'})
+        client.clients[0]._process_received_data( \
+                                        ztreamy.serialize_events(self.evs))
+        self.assertEqual(len(received), 5)
+        store = checkpoints.CheckpointStore(self.directory)
+        self.assertEqual(store.get(self.url), self.evs[-1].event_id)
+
+    def test_dbfeed_checkpoint_after_dispatch(self):
+        stream = dbfeed.DBFeedStream('dbfeed', [self.url],
+                                     label='dbfeed',
+                                     buffering_time=1000,
+                                     retrieve_missing_events=True,
+                                     checkpoint_dir=self.directory,
+                                     ioloop=tornado.ioloop.IOLoop())
+        stream.client.clients[0]._process_received_data( \
+                                        ztreamy.serialize_events(self.evs))
+        store = checkpoints.CheckpointStore(self.directory)
+        self.assertIsNone(store.get(self.url))
+        stream._dump_buffer()
+        store = checkpoints.CheckpointStore(self.directory)
+        self.assertEqual(store.get(self.url), self.evs[-1].event_id)
@@ -0,0 +1,387 @@
+from __future__ import unicode_literals
+
+import json
+import shutil
+import tempfile
+import unittest
+
+import tornado.gen
+import tornado.ioloop
+import tornado.testing
+import tornado.web
+import tornado.websocket
+import ztreamy
+import ztreamy.events
+
+import semserver.collector as collector
+import semserver.feedback as feedback
+import semserver.lanes as lanes
+import semserver.locations as locations
+
+
+class TestEventTypeRelays(unittest.TestCase):
+
+    def setUp(self):
+        ioloop = tornado.ioloop.IOLoop()
+        self.stream = ztreamy.Stream('backend', ioloop=ioloop)
+        self.type_relays = collector.EventTypeRelays( \
+                                        self.stream, 'SmartDriver',
+                                        ['Vehicle Location', 'High Speed'],
+                                        None, ioloop=ioloop)
+        self.type_relays.start()
+
+    def tearDown(self):
+        self.type_relays.stop()
+        for relay in self.type_relays.relays.values():
+            relay.stop()
+        self.stream.stop()
+
+    def test_fan_out(self):
+        received = {}
+        for event_type, relay in self.type_relays.relays.items():
+            received[event_type] = []
+            relay.create_local_client(received[event_type].append)
+        evs = [_event('Vehicle Location'), _event('High Speed'),
+               _event('Vehicle Location'), _event('Context Data')]
+        self.stream.dispatch_events(evs)
+        self.assertEqual(received['Vehicle Location'], [evs[0], evs[2]])
+        self.assertEqual(received['High Speed'], [evs[1]])
+        # The relays do not modify the events of the main stream
+        self.assertEqual(evs[0].aggregator_id, [self.stream.source_id])
+
+    def test_serialize_once(self):
+        event = _event('High Speed')
+        self.stream.dispatch_events([event])
+        data = ztreamy.serialize_events([event])
+        self.assertIs(event._serialize(), event._serialize())
+        self.assertEqual(data, ztreamy.events.Event._serialize(event))
+        self.assertIs(event.serialize_json(), event.serialize_json())
+
+
+class TestBackendStreamRelay(unittest.TestCase):
+
+    def setUp(self):
+        ioloop = tornado.ioloop.IOLoop()
+        self.spill_dir = tempfile.mkdtemp()
+        self.stream = ztreamy.Stream('collector', ioloop=ioloop)
+        self.relay = collector.BackendStreamRelay( \
+                                self.stream,
+                                ['http://localhost:9111/backend/',
+                                 'http://localhost:9112/backend/'],
+                                0.1, self.spill_dir, ioloop=ioloop)
+
+    def tearDown(self):
+        shutil.rmtree(self.spill_dir)
+
+    def test_backend_shard(self):
+        # Must not change across processes or versions
+        self.assertEqual(collector.backend_shard('user-1', 7), 2116437524 % 7)
+        shards = set(collector.backend_shard('user-{}'.format(i), 4) \
+                     for i in range(100))
+        self.assertEqual(shards, set(range(4)))
+
+    def test_routing(self):
+        evs = [ztreamy.events.Event('user-{}'.format(i % 10), 'text/plain',
+                                    'body') for i in range(100)]
+        self.relay.process_events(evs)
+        for i, shard in enumerate(self.relay.shards):
+            pending = shard.publisher.pending_events
+            self.assertTrue(pending)
+            self.assertEqual(pending, [e for e in evs \
+                                       if collector.backend_shard( \
+                                                        e.source_id, 2) == i])
+
+    def test_spill_dir_required(self):
+        self.assertRaises(ValueError, collector.CollectorStream, None,
+                          disable_persistence=True,
+                          backend_stream='http://localhost:9/backend/',
+                          ioloop=self.stream.ioloop)
+
+    def test_lanes_publication_order(self):
+        stream = collector.CollectorStream( \
+                                None,
+                                disable_persistence=True,
+                                priority_lanes=lanes.DEFAULT_LANES,
+                                ioloop=self.stream.ioloop)
+        received = []
+        stream.create_local_client(received.append)
+        evs = [_event('Context Data'), _event('Vehicle Location'),
+               _event('Data Section'), _event('Context Data'),
+               _event('High Speed')]
+        self.assertEqual(stream.dispatch_events(evs), evs)
+        self.assertEqual(received, evs)
+
+    def test_backend_down_with_lanes(self):
+        stream = collector.CollectorStream( \
+                                None,
+                                disable_persistence=True,
+                                backend_stream='http://localhost:9/backend/',
+                                relay_queue_size=100,
+                                spill_dir=self.spill_dir,
+                                priority_lanes=lanes.DEFAULT_LANES,
+                                ioloop=self.stream.ioloop)
+        relay = stream.backend_relay
+        relay.start()
+        evs = []
+        for i in range(20):
+            batch = [_event('Data Section')] \
+                    + [_event('Vehicle Location') for _ in range(499)]
+            stream.dispatch_events(batch)
+            evs.extend(batch)
+        shard = relay.shards[0]
+        # Locations are neither kept in memory nor reordered
+        self.assertEqual(len(shard.publisher.pending_events),
+                         relay.MAX_PUBLISHER_EVENTS)
+        self.assertTrue(shard.queue.disk_bytes > 0)
+        relayed = list(shard.publisher.pending_events)
+        while True:
+            queued = shard.queue.pop(1000)
+            if not queued:
+                break
+            relayed.extend(queued)
+        self.assertEqual([e.event_id for e in relayed],
+                         [e.event_id for e in evs])
+
+
+class TestWebSocketPublish(tornado.testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.stream = collector.CollectorStream( \
+                                None,
+                                disable_persistence=True,
+                                disable_road_info=True,
+                                score_info_url=self.get_url('/scores'),
+                                scores_cache_ttl=0,
+                                ioloop=self.io_loop)
+        self.stream.start()
+        return tornado.web.Application( \
+                    collector.websocket_handlers(self.stream)
+                    + [(r'/scores', _ScoresHandler)])
+
+    def tearDown(self):
+        self.stream.stop()
+        super(TestWebSocketPublish, self).tearDown()
+
+    @tornado.testing.gen_test
+    def test_pushed_feedback(self):
+        url = self.get_url('/collector/publish-ws').replace('http', 'ws', 1)
+        connection = yield tornado.websocket.websocket_connect(url)
+        connection.write_message( \
+                    ztreamy.serialize_events([_location(40.0, -3.0)]),
+                    binary=True)
+        data = json.loads((yield connection.read_message()))
+        self.assertEqual(data['scores']['status'], feedback.Status.OK)
+        self.assertEqual(len(data['scores']['closeScores']), 1)
+        self.assertEqual(data['roadInfo']['status'], feedback.Status.DISABLED)
+        # The driver didn't move: the same feedback is pushed only once
+        for _ in range(2):
+            connection.write_message( \
+                    ztreamy.serialize_events([_location(40.0, -3.0)]),
+                    binary=True)
+        data = json.loads((yield connection.read_message()))
+        self.assertEqual(data['scores']['status'],
+                         feedback.Status.USE_PREVIOUS)
+        connection.write_message(json.dumps([_location(41.0, -3.0).as_json()]))
+        data = json.loads((yield connection.read_message()))
+        self.assertEqual(data['scores']['status'], feedback.Status.OK)
+        self.assertEqual(self.stream.latest_locations.get('user-1'),
+                         locations.Location(41.0, -3.0))
+        connection.close()
+
+    @tornado.testing.gen_test
+    def test_batch_feedback(self):
+        del _ScoresHandler.bodies[:]
+        url = self.get_url('/collector/publish-ws').replace('http', 'ws', 1)
+        connection = yield tornado.websocket.websocket_connect(url)
+        evs = [_location(40.2, -3.0, second=2),
+               _event('Data Section'),
+               _location(40.3, -3.0, second=3),
+               _location(40.1, -3.0, second=1),
+               _location(40.5, -3.0, second=9, source_id='user-2')]
+        self.assertEqual(collector.feedback_events(evs),
+                         (evs[4], []))
+        self.assertEqual(collector.feedback_events(evs[:4]),
+                         (evs[2], [evs[3], evs[0]]))
+        self.assertEqual(collector.feedback_events(evs[1:2]), (None, []))
+        connection.write_message(ztreamy.serialize_events(evs[:4]),
+                                 binary=True)
+        data = json.loads((yield connection.read_message()))
+        self.assertEqual(data['scores']['status'], feedback.Status.OK)
+        # One request for the newest location, with the older ones
+        self.assertEqual(len(_ScoresHandler.bodies), 1)
+        latitude, body = _ScoresHandler.bodies[0]
+        self.assertEqual(latitude, '40.3')
+        self.assertEqual([(location.lat, score) for location, score \
+                          in feedback.parse_locations(body)],
+                         [(40.1, 3), (40.2, 3)])
+        connection.close()
+
+    @tornado.testing.gen_test
+    def test_malformed_older_locations(self):
+        del _ScoresHandler.bodies[:]
+        url = self.get_url('/collector/publish-ws').replace('http', 'ws', 1)
+        connection = yield tornado.websocket.websocket_connect(url)
+        evs = [_location(40.1, -3.0, second=1),
+               _location(40.2, -3.0, second=2),
+               _location(40.3, -3.0, second=3),
+               _location(40.4, -3.0, second=4)]
+        evs[0].body['Location']['score'] = None
+        del evs[1].body['Location']['latitude']
+        connection.write_message(ztreamy.serialize_events(evs),
+                                 binary=True)
+        data = json.loads((yield connection.read_message()))
+        self.assertEqual(data['scores']['status'], feedback.Status.OK)
+        latitude, body = _ScoresHandler.bodies[0]
+        self.assertEqual(latitude, '40.4')
+        self.assertEqual([(location.lat, score) for location, score \
+                          in feedback.parse_locations(body)],
+                         [(40.3, 3)])
+        connection.close()
+
+
+class TestPublishRawBodies(tornado.testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.spill_dir = tempfile.mkdtemp()
+        self.stream = collector.CollectorStream( \
+                                None,
+                                disable_feedback=True,
+                                disable_persistence=True,
+                                backend_stream='http://localhost:9/backend/',
+                                raw_bodies=True,
+                                spill_dir=self.spill_dir,
+                                ioloop=self.io_loop)
+        self.stream.start()
+        return tornado.web.Application([ \
+                    (r'/collector/publish', collector.PublishRequestHandler,
+                     {'stream': self.stream,
+                      'stop_when_source_finishes': False})])
+
+    def tearDown(self):
+        self.stream.stop()
+        shutil.rmtree(self.spill_dir)
+        super(TestPublishRawBodies, self).tearDown()
+
+    def test_malformed_json(self):
+        shard = self.stream.backend_relay.shards[0]
+        good = _raw_event('{"Data Section": {"value": 1.5}}')
+        response = self._publish([good])
+        self.assertEqual(response.code, 200)
+        self.assertEqual([e.event_id for e in shard.publisher.pending_events],
+                         [good.event_id])
+        # The backend would reject the relayed chunk
+        response = self._publish([_raw_event('{"Data Section": {"value": 1'),
+                                  _raw_event('{"Data Section": {}}')])
+        self.assertEqual(response.code, 400)
+        self.assertEqual(len(shard.publisher.pending_events), 1)
+
+    def _publish(self, evs):
+        return self.fetch('/collector/publish', method='POST',
+                          body=ztreamy.serialize_events(evs),
+                          headers={'Content-Type': ztreamy.event_media_type})
+
+
+class TestScoresCache(tornado.testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.stream = collector.CollectorStream( \
+                                None,
+                                disable_persistence=True,
+                                disable_road_info=True,
+                                score_info_url=self.get_url('/scores'),
+                                scores_cache_ttl=60,
+                                ioloop=self.io_loop)
+        return tornado.web.Application([(r'/scores', _AreaScoresHandler)])
+
+    def setUp(self):
+        super(TestScoresCache, self).setUp()
+        del _AreaScoresHandler.lookups[:]
+
+    @tornado.testing.gen_test
+    def test_cache_hit(self):
+        lookup = yield self._run('user-3', 40.0005, -3.0)
+        self.assertEqual(lookup.feedback.scores.status, feedback.Status.OK)
+        self.assertEqual(len(lookup.feedback.scores.scores), 2)
+        self.assertEqual(lookup.previous_location,
+                         locations.Location(39.0, -3.0))
+        # Same geocell: the score of the driver is left out
+        lookup = yield self._run('user-2', 40.0006, -3.0)
+        self.assertEqual([s.score for s in lookup.feedback.scores.scores],
+                         [1])
+        self.assertIsNone(lookup.previous_location)
+        # The driver moved less than the long distance of the score
+        # service: the cache still gives the scores and the previous
+        # location kept by the collector
+        lookup = yield self._run('user-2', 40.0009, -3.0)
+        self.assertEqual(lookup.feedback.scores.status, feedback.Status.OK)
+        self.assertEqual([s.score for s in lookup.feedback.scores.scores],
+                         [1])
+        self.assertEqual(lookup.previous_location,
+                         locations.Location(40.0006, -3.0))
+        self.assertEqual(_AreaScoresHandler.lookups, ['user-3'])
+
+    @tornado.gen.coroutine
+    def _run(self, user_id, latitude, longitude):
+        lookup = collector.FeedbackLookup(self.stream)
+        yield lookup.run(_location(latitude, longitude, source_id=user_id))
+        raise tornado.gen.Return(lookup)
+
+
+class _AreaScoresHandler(tornado.web.RequestHandler):
+    lookups = []
+
+    def get(self):
+        user_id = self.get_query_argument('user')
+        if self.get_query_argument('lookup', '1') == '0':
+            reply = feedback.ScoresReply(feedback.ScoresReply.NOT_MOVED)
+        else:
+            self.lookups.append(user_id)
+            scores = [feedback.DriverScore( \
+                                40.0002, -3.0, i,
+                                user_hash=feedback.user_hash(other_user)) \
+                      for i, other_user in enumerate(('user-1', 'user-2'),
+                                                     start=1) \
+                      if other_user != user_id]
+            reply = feedback.ScoresReply(feedback.ScoresReply.SCORES,
+                                         previous=locations.Location(39.0,
+                                                                     -3.0),
+                                         scores=scores)
+        self.write(reply.serialize( \
+                    with_hashes=self.get_query_argument('hashes', '0') == '1'))
+
+
+class _ScoresHandler(tornado.web.RequestHandler):
+    bodies = []
+
+    def post(self):
+        self.bodies.append((self.get_query_argument('latitude'),
+                            self.request.body))
+        self.get()
+
+    def get(self):
+        reply = feedback.ScoresReply(feedback.ScoresReply.SCORES,
+                                     previous=locations.Location(40.0, -3.0),
+                                     scores=[feedback.DriverScore(40.0, -3.0,
+                                                                  5)])
+        self.write(reply.serialize())
+
+
+def _location(latitude, longitude, second=0, source_id='user-1'):
+    return ztreamy.events.JSONEvent(source_id, 'application/json',
+                                    {'Location': {'latitude': latitude,
+                                                  'longitude': longitude,
+                                                  'score': 3}},
+                                    application_id='SmartDriver',
+                                    event_type='Vehicle Location',
+                                    timestamp='2016-02-01T10:00:{:02d}+01:00'\
+                                              .format(second))
+
+def _raw_event(body):
+    return ztreamy.events.Event('user-1', 'application/json', body,
+                                application_id='SmartDriver',
+                                event_type='Data Section')
+
+def _event(event_type):
+    return ztreamy.events.Event('source', 'text/plain', 'body',
+                                application_id='SmartDriver',
+                                event_type=event_type)
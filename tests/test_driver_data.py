@@ -0,0 +1,56 @@
+from __future__ import unicode_literals
+
+import unittest
+
+import ztreamy.events
+
+import semserver.rawevents as rawevents
+import semserver.tools.driver_data as driver_data
+
+
+class TestExtractPositions(unittest.TestCase):
+
+    def test_rr_values(self):
+        samples = [_sample(i) for i in range(4)]
+        samples[2]['timeStamp'] = 'wrong'
+        for event in _events(samples, [800, 810, 820, 830]):
+            records = list(driver_data.extract_positions(event))
+            self.assertEqual([r.latitude for r in records],
+                             [40.0, 40.001, 40.003])
+            self.assertEqual([r.rr_value for r in records], [800, 810, 830])
+
+    def test_lazy(self):
+        for event in _events([_sample(i) for i in range(3)], [800, 810, 820]):
+            records = driver_data.extract_positions(event)
+            self.assertEqual(next(records).rr_value, 800)
+            self.assertEqual([r.rr_value for r in records], [810, 820])
+
+    def test_rr_size_mismatch(self):
+        for event in _events([_sample(i) for i in range(4)], [800, 810]):
+            records = list(driver_data.extract_positions(event))
+            self.assertEqual(len(records), 4)
+            self.assertEqual([r.rr_value for r in records], [None] * 4)
+        for event in _events([_sample(i) for i in range(2)], None):
+            records = list(driver_data.extract_positions(event))
+            self.assertEqual([r.rr_value for r in records], [None] * 2)
+
+
+def _sample(i):
+    return {'latitude': 40.0 + i * 0.001,
+            'longitude': -3.0,
+            'timeStamp': '2016-02-01T10:00:{:02d}.000+01:00'.format(i)}
+
+def _events(samples, rr_values):
+    """Returns the same Data Section event, parsed and unparsed."""
+    section = {'roadSection': samples}
+    if rr_values is not None:
+        section['rrSection'] = rr_values
+    event = ztreamy.events.JSONEvent('user-1', 'application/json',
+                                     {'Data Section': section},
+                                     application_id='SmartDriver',
+                                     event_type='Data Section')
+    deserializer = rawevents.DeferredBodyDeserializer( \
+                                    [('SmartDriver', 'Data Section')])
+    raw_event = deserializer.deserialize(ztreamy.serialize_events([event]),
+                                         complete=True)[0]
+    return [event, raw_event]
@@ -0,0 +1,56 @@
+from __future__ import unicode_literals
+
+import unittest
+
+import ztreamy
+import ztreamy.events
+
+import semserver.eventsbuffer as eventsbuffer
+
+
+class TestCompactEventsBuffer(unittest.TestCase):
+
+    def setUp(self):
+        self.evs = [ztreamy.events.Event('source', 'text/plain',
+                                         'body {:02d}'.format(i),
+                                         application_id='SmartDriver')
+                    for i in range(20)]
+        self.event_size = len(ztreamy.serialize_events(self.evs[:1]))
+
+    def test_newer_than(self):
+        buffer_ = eventsbuffer.CompactEventsBuffer(2**16)
+        buffer_.append_events(self.evs)
+        evs, complete = buffer_.newer_than(self.evs[14].event_id)
+        self.assertTrue(complete)
+        self.assertEqual(_event_ids(evs), _event_ids(self.evs[15:]))
+        self.assertEqual(evs[0].body, self.evs[15].body)
+        evs, complete = buffer_.newer_than(self.evs[4].event_id, limit=3)
+        self.assertFalse(complete)
+        self.assertEqual(_event_ids(evs), _event_ids(self.evs[17:]))
+        evs, complete = buffer_.newer_than('unknown-id')
+        self.assertFalse(complete)
+        self.assertEqual(len(evs), 20)
+        self.assertEqual(buffer_.newer_than(self.evs[-1].event_id), ([], True))
+
+    def test_eviction(self):
+        buffer_ = eventsbuffer.CompactEventsBuffer(self.event_size * 5 + 10)
+        for i, event in enumerate(self.evs):
+            buffer_.append_event(event)
+            self.assertEqual(_event_ids(buffer_.most_recent(5)),
+                             _event_ids(self.evs[max(0, i - 4):i + 1]))
+        self.assertEqual(len(buffer_), 5)
+        self.assertFalse(buffer_.contains(self.evs[14]))
+        self.assertTrue(buffer_.contains(self.evs[15]))
+        evs, complete = buffer_.newer_than(self.evs[16].event_id)
+        self.assertTrue(complete)
+        self.assertEqual(_event_ids(evs), _event_ids(self.evs[17:]))
+
+    def test_event_too_large(self):
+        buffer_ = eventsbuffer.CompactEventsBuffer(self.event_size - 1)
+        buffer_.append_events(self.evs[:2])
+        self.assertEqual(len(buffer_), 0)
+        self.assertEqual(buffer_.most_recent(5), [])
+
+
+def _event_ids(evs):
+    return [e.event_id for e in evs]
@@ -0,0 +1,108 @@
+import unittest
+
+import semserver.feedback as feedback
+import semserver.locations as locations
+
+
+class TestScoresReply(unittest.TestCase):
+
+    def setUp(self):
+        self.scores = [
+            feedback.DriverScore(40.3393, -3.773988, 501),
+            feedback.DriverScore(40.3401, -3.774012, 0),
+            feedback.DriverScore(-5.0001, 0.00001, 1000,
+                                 user_hash=feedback.user_hash('user-1')),
+        ]
+        self.previous = locations.Location(40.3392, -3.773991)
+
+    def test_text_round_trip(self):
+        self._check_round_trip(feedback.SCORES_TEXT_MEDIA_TYPE)
+
+    def test_text_round_trip_hashes(self):
+        self._check_round_trip(feedback.SCORES_TEXT_MEDIA_TYPE,
+                               with_hashes=True)
+
+    def test_binary_round_trip(self):
+        self._check_round_trip(feedback.SCORES_BINARY_MEDIA_TYPE)
+
+    def test_binary_round_trip_hashes(self):
+        self._check_round_trip(feedback.SCORES_BINARY_HASHES_MEDIA_TYPE,
+                               with_hashes=True)
+
+    def test_text_format(self):
+        reply = feedback.ScoresReply(feedback.ScoresReply.SCORES,
+                                     previous=self.previous,
+                                     scores=self.scores[:1])
+        self.assertEqual(reply.serialize_text(),
+                         '#+40.3392,-3.773991\r\n40.3393,-3.773988,501\r\n')
+        reply = feedback.ScoresReply(feedback.ScoresReply.NOT_MOVED)
+        self.assertEqual(reply.serialize_text(), '#*\r\n')
+
+    def test_user_hash(self):
+        self.assertEqual(feedback.user_hash('user-1'), 2116437524)
+        reply = feedback.ScoresReply(feedback.ScoresReply.SCORES,
+                                     previous=self.previous,
+                                     scores=self.scores[2:])
+        self.assertEqual(reply.serialize_text(with_hashes=True),
+                         '#+40.3392,-3.773991\r\n'
+                         '-5.0001,1e-05,1000,2116437524\r\n')
+        # Only sent when asked for
+        self.assertEqual(reply.serialize_text(),
+                         '#+40.3392,-3.773991\r\n'
+                         '-5.0001,1e-05,1000\r\n')
+        # Not sent to the driver apps
+        self.assertNotIn('user_hash', self.scores[2].as_dict())
+
+    def test_binary_size(self):
+        reply = feedback.ScoresReply(feedback.ScoresReply.SCORES,
+                                     previous=self.previous,
+                                     scores=self.scores)
+        self.assertEqual(len(reply.serialize_binary()), 1 + 16 + 3 * 20)
+        self.assertEqual(len(reply.serialize_binary(with_hashes=True)),
+                         1 + 16 + 3 * 24)
+        reply = feedback.ScoresReply(feedback.ScoresReply.NOT_MOVED)
+        self.assertEqual(len(reply.serialize_binary()), 1)
+
+    def test_malformed_binary(self):
+        reply = feedback.ScoresReply(feedback.ScoresReply.SCORES,
+                                     previous=self.previous,
+                                     scores=self.scores)
+        data = reply.serialize_binary()
+        self.assertRaises(ValueError,
+                          feedback.ScoresReply.parse_binary, data[:-1])
+        self.assertRaises(ValueError,
+                          feedback.ScoresReply.parse_binary, '')
+
+    def test_locations(self):
+        pairs = [(locations.Location(40.339300, -3.773988), 2.5),
+                 (locations.Location(40.3394, -3.7741), 3)]
+        data = feedback.serialize_locations(pairs)
+        self.assertEqual(feedback.parse_locations(data), pairs)
+        self.assertEqual(feedback.parse_locations(b''), [])
+        self.assertRaises(ValueError, feedback.parse_locations, b'40.3,2\r\n')
+
+    def _check_round_trip(self, media_type, with_hashes=False):
+        for reply_type, scores in ((feedback.ScoresReply.SCORES, self.scores),
+                                   (feedback.ScoresReply.SCORES, []),
+                                   (feedback.ScoresReply.PREVIOUS_LOCATION,
+                                    [])):
+            reply = feedback.ScoresReply(reply_type, previous=self.previous,
+                                         scores=scores)
+            data = reply.serialize(media_type=media_type,
+                                   with_hashes=with_hashes)
+            parsed = feedback.ScoresReply.parse(data, media_type=media_type)
+            self.assertEqual(parsed.reply_type, reply_type)
+            self.assertEqual(parsed.previous, self.previous)
+            self.assertEqual([s.as_dict() for s in parsed.scores],
+                             [s.as_dict() for s in scores])
+            if with_hashes:
+                self.assertEqual([s.user_hash for s in parsed.scores],
+                                 [s.user_hash for s in scores])
+            else:
+                self.assertEqual([s.user_hash for s in parsed.scores],
+                                 [None] * len(scores))
+        reply = feedback.ScoresReply(feedback.ScoresReply.NOT_MOVED)
+        parsed = feedback.ScoresReply.parse(reply.serialize(media_type),
+                                            media_type=media_type)
+        self.assertEqual(parsed.reply_type, feedback.ScoresReply.NOT_MOVED)
+        self.assertIsNone(parsed.previous)
@@ -0,0 +1,63 @@
+from __future__ import unicode_literals
+
+import json
+import unittest
+
+import semserver.jsonstream as jsonstream
+
+
+class TestJSONStream(unittest.TestCase):
+
+    def setUp(self):
+        self.data = {'Data Section': {
+            'averageSpeed': 52.5,
+            'roadSection': [{'latitude': 40.0 + i,
+                             'longitude': -3.0,
+                             'timeStamp': 'ts {}'.format(i),
+                             'tags': [[i], {'k': 'v,]}'}]}
+                            for i in range(5)],
+            'rrSection': [800, 810, 820, 830, 840],
+            'accelerationPeaks': [],
+            'empty': {},
+            'pke': 0.25,
+        }}
+        self.text = json.dumps(self.data, indent=1).encode('utf-8')
+
+    def test_iter_array(self):
+        samples = jsonstream.iter_array(self.text,
+                                        ('Data Section', 'roadSection'))
+        self.assertEqual(list(samples),
+                         self.data['Data Section']['roadSection'])
+        self.assertEqual(list(jsonstream.iter_array( \
+                                self.text, ('Data Section', 'rrSection'))),
+                         [800, 810, 820, 830, 840])
+        self.assertEqual(list(jsonstream.iter_array( \
+                                self.text, ('Data Section', 'missing'))), [])
+        self.assertRaises(ValueError, list,
+                          jsonstream.iter_array(self.text,
+                                                ('Data Section', 'pke')))
+
+    def test_array_length(self):
+        self.assertEqual(jsonstream.array_length( \
+                            self.text, ('Data Section', 'roadSection')), 5)
+        self.assertEqual(jsonstream.array_length( \
+                            self.text, ('Data Section', 'accelerationPeaks')),
+                         0)
+        self.assertEqual(jsonstream.array_length(self.text, ('missing',)), 0)
+        self.assertRaises(ValueError, jsonstream.array_length,
+                          self.text, ('Data Section', 'pke'))
+
+    def test_load_object(self):
+        data = jsonstream.load_object(self.text, ('Data Section',),
+                                      skip=('roadSection', 'rrSection'))
+        self.assertEqual(data, {'averageSpeed': 52.5,
+                                'accelerationPeaks': [],
+                                'empty': {},
+                                'pke': 0.25})
+        self.assertIsNone(jsonstream.load_object(self.text, ('missing',)))
+
+    def test_syntax_error(self):
+        self.assertRaises(ValueError, list,
+                          jsonstream.iter_array('{"a": [1, 2 3]}', ('a',)))
+        self.assertRaises(ValueError, jsonstream.load_object,
+                          '{"a": {"b" 1}}', ('a',))
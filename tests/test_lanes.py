@@ -0,0 +1,76 @@
+from __future__ import unicode_literals
+
+import datetime
+import unittest
+
+import tornado.ioloop
+import ztreamy
+import ztreamy.events
+
+import semserver.lanes as lanes
+
+
+class TestPriorityLanes(unittest.TestCase):
+
+    def setUp(self):
+        self.ioloop = tornado.ioloop.IOLoop()
+        self.stream = ztreamy.Stream('collector', buffering_time=10000,
+                                     ioloop=self.ioloop)
+        self.lanes = lanes.PriorityLanes(self.stream, [
+            lanes.Lane.parse('priority:0:2:SmartDriver/Vehicle Location'),
+            lanes.Lane.parse('bulk:10:3:SmartDriver/Data Section,Other',
+                             bulk=True),
+        ])
+        # Buffered dispatches
+        self.batches = []
+        self.stream.dispatcher.dispatch = self.batches.append
+
+    def tearDown(self):
+        self.stream.stop()
+
+    def test_parse(self):
+        lane = lanes.Lane.parse('alerts:0.5:100:SmartDriver/High Speed,App')
+        self.assertEqual(lane.name, 'alerts')
+        self.assertEqual(lane.buffering_time, 0.5)
+        self.assertEqual(lane.batch_size, 100)
+        self.assertEqual(lane.events, frozenset([('SmartDriver', 'High Speed'),
+                                                 ('App', None)]))
+        self.assertFalse(lane.bulk)
+        self.assertRaises(ValueError, lanes.Lane.parse, 'alerts:0.5:App')
+        self.assertRaises(ValueError, lanes.Lane.parse, 'alerts:x:1:App')
+        self.assertEqual(self.lanes.bulk_events,
+                         frozenset([('SmartDriver', 'Data Section'),
+                                    ('Other', None)]))
+
+    def test_dispatch(self):
+        locations = [_event('SmartDriver', 'Vehicle Location')
+                     for _ in range(3)]
+        sections = [_event('SmartDriver', 'Data Section') for _ in range(7)]
+        other = _event('SmartDriver', 'Context Data')
+        accepted, rest = self.lanes.dispatch_events( \
+                                sections + locations + [other, locations[0]])
+        self.assertEqual(accepted, sections + locations)
+        self.assertEqual(rest, [other])
+        self._run_ioloop()
+        # The bulk lane reached its batch size and dispatches its backlog
+        # in batches of 3, interleaved with the batches of the priority lane
+        self.assertEqual(self.batches, [sections[:3], locations[:2],
+                                        sections[3:6], locations[2:],
+                                        sections[6:]])
+        accepted, rest = self.lanes.dispatch_events( \
+                            [_event('SmartDriver', 'Data Section')])
+        self._run_ioloop()
+        self.assertEqual(len(self.batches), 5)
+        self.lanes.stop()
+        self.assertEqual(self.batches[-1], accepted)
+
+    def _run_ioloop(self):
+        self.ioloop.add_timeout(datetime.timedelta(seconds=0.05),
+                                self.ioloop.stop)
+        self.ioloop.start()
+
+
+def _event(application_id, event_type):
+    return ztreamy.events.Event('source', 'text/plain', 'body',
+                                application_id=application_id,
+                                event_type=event_type)
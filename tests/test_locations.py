@@ -47,3 +47,33 @@ class TestLocationIndex(unittest.TestCase):
         finally:
             os.remove(filename_data)
             os.remove(filename_locations)
+
+    def test_lookup_area(self):
+        index = locations.LocationIndex(500.0)
+        index.insert(locations.Location(40.33, -3.77), 'u1', 501)
+        index.insert(locations.Location(40.34, -3.76), 'u2', 502)
+        index.insert(locations.Location(40.335, -3.765), 'u1', 503)
+        index.insert(locations.Location(41.0, -3.77), 'u3', 504)
+        result = list(index.lookup_area(locations.Location(40.3, -3.8),
+                                        locations.Location(40.4, -3.7)))
+        self.assertEqual(len(result), 2)
+        self.assertEqual(result[0],
+                         (locations.Location(40.335, -3.765), 503))
+        self.assertEqual(result[1],
+                         (locations.Location(40.34, -3.76), 502))
+
+
+class TestLocation(unittest.TestCase):
+
+    def test_tile(self):
+        location = locations.Location(40.339300, -3.773988)
+        self.assertEqual(location.tile(0), (0, 0))
+        self.assertEqual(location.tile(16), (32080, 24729))
+        south_west, north_east = \
+                        locations.Location.tile_bounding_box(16, 32080, 24729)
+        self.assertTrue(south_west.lat <= location.lat < north_east.lat)
+        self.assertTrue(south_west.long <= location.long < north_east.long)
+
+    def test_tile_out_of_range(self):
+        self.assertRaises(ValueError,
+                          locations.Location.tile_bounding_box, 2, 4, 0)
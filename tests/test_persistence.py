@@ -0,0 +1,151 @@
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import ztreamy.events
+
+import semserver.eventsbuffer as eventsbuffer
+import semserver.persistence as persistence
+
+
+class TestEventLog(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.evs = [ztreamy.events.Event('source', 'text/plain',
+                                         'body {}'.format(i),
+                                         application_id='SmartDriver')
+                    for i in range(30)]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_newer_than(self):
+        log = persistence.EventLog(self.directory, fsync='always')
+        for i in range(0, 30, 4):
+            log.append(self.evs[i:i + 4])
+        # Some of the events may still be waiting for the writer thread
+        evs, complete = log.newer_than(self.evs[5].event_id)
+        self.assertTrue(complete)
+        self.assertEqual(_event_ids(evs), _event_ids(self.evs[6:]))
+        log.close()
+        log = persistence.EventLog(self.directory)
+        evs, complete = log.newer_than(self.evs[5].event_id)
+        self.assertTrue(complete)
+        self.assertEqual(_event_ids(evs), _event_ids(self.evs[6:]))
+        self.assertEqual(evs[0].body, self.evs[6].body)
+        evs, complete = log.newer_than(self.evs[5].event_id, limit=10)
+        self.assertFalse(complete)
+        self.assertEqual(_event_ids(evs), _event_ids(self.evs[20:]))
+        self.assertEqual(log.newer_than(self.evs[-1].event_id), ([], True))
+        self.assertIsNone(log.newer_than('unknown-id'))
+        self.assertEqual(_event_ids(log.most_recent(7)),
+                         _event_ids(self.evs[23:]))
+        log.close()
+
+    def test_max_read_events(self):
+        log = persistence.EventLog(self.directory, max_read_events=10)
+        for i in range(0, 30, 4):
+            log.append(self.evs[i:i + 4])
+        log.close()
+        log = persistence.EventLog(self.directory, max_read_events=10)
+        evs, complete = log.newer_than(self.evs[5].event_id)
+        self.assertFalse(complete)
+        self.assertEqual(_event_ids(evs), _event_ids(self.evs[20:]))
+        evs, complete = log.newer_than(self.evs[5].event_id, limit=100)
+        self.assertEqual(_event_ids(evs), _event_ids(self.evs[20:]))
+        evs, complete = log.newer_than(self.evs[21].event_id)
+        self.assertTrue(complete)
+        self.assertEqual(_event_ids(evs), _event_ids(self.evs[22:]))
+        log.close()
+
+    def test_after_commit(self):
+        log = persistence.EventLog(self.directory)
+        committed = []
+        log.append(self.evs[:10])
+        log.after_commit(committed.append, 'first')
+        log.close()
+        self.assertEqual(committed, ['first'])
+        self.assertEqual(len(log.most_recent(100)), 10)
+
+    def test_segments(self):
+        log = persistence.EventLog(self.directory, segment_size=1,
+                                   max_bytes=2**30)
+        for i in range(0, 30, 3):
+            log.append(self.evs[i:i + 3])
+        log.close()
+        self.assertEqual(len(os.listdir(self.directory)), 20)
+        log = persistence.EventLog(self.directory, segment_size=1,
+                                   max_bytes=log.size // 2)
+        log.append(self.evs[:1])
+        log.close()
+        self.assertTrue(log.size <= log.max_bytes)
+        self.assertIsNone(log.newer_than(self.evs[3].event_id))
+        evs, complete = log.newer_than(self.evs[26].event_id)
+        self.assertEqual(_event_ids(evs), _event_ids(self.evs[27:30] \
+                                                     + self.evs[:1]))
+
+    def test_recover_unindexed_blocks(self):
+        log = persistence.EventLog(self.directory)
+        log.append(self.evs[:10])
+        log.append(self.evs[10:20])
+        log.close()
+        index_path = os.path.join(self.directory, 'segment-0.idx')
+        log_path = os.path.join(self.directory, 'segment-0.log')
+        with open(index_path, 'r+b') as file_:
+            file_.truncate(os.path.getsize(index_path) - 10)
+        with open(log_path, 'ab') as file_:
+            file_.write(b'\x00\x00\x01\x00partial')
+        log = persistence.EventLog(self.directory)
+        self.assertEqual(_event_ids(log.most_recent(100)),
+                         _event_ids(self.evs[:20]))
+        log.close()
+
+
+class TestLoggedEventsBuffer(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.evs = [ztreamy.events.Event('source', 'text/plain',
+                                         'body {:02d}'.format(i),
+                                         application_id='SmartDriver')
+                    for i in range(20)]
+        self.event_size = len(ztreamy.serialize_events(self.evs[:1]))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_catch_up_from_log(self):
+        buffer_ = persistence.LoggedEventsBuffer( \
+                    eventsbuffer.CompactEventsBuffer(self.event_size * 5),
+                    persistence.EventLog(self.directory))
+        buffer_.append_events(self.evs)
+        self.assertEqual(len(buffer_.memory_buffer), 5)
+        evs, complete = buffer_.newer_than(self.evs[2].event_id)
+        self.assertTrue(complete)
+        self.assertEqual(_event_ids(evs), _event_ids(self.evs[3:]))
+        buffer_.log.close()
+        # Memory has more of the requested events than the log can read
+        buffer_ = persistence.LoggedEventsBuffer( \
+                    eventsbuffer.CompactEventsBuffer(self.event_size * 5),
+                    persistence.EventLog(self.directory, max_read_events=3))
+        buffer_.memory_buffer.append_events(self.evs[15:])
+        evs, complete = buffer_.newer_than(self.evs[2].event_id)
+        self.assertFalse(complete)
+        self.assertEqual(_event_ids(evs), _event_ids(self.evs[15:]))
+        buffer_.log.close()
+        buffer_ = persistence.LoggedEventsBuffer( \
+                    eventsbuffer.CompactEventsBuffer(self.event_size * 5),
+                    persistence.EventLog(self.directory),
+                    preload_events=10)
+        self.assertTrue(buffer_.contains(self.evs[-1]))
+        self.assertEqual(_event_ids(buffer_.most_recent(5)),
+                         _event_ids(self.evs[15:]))
+        buffer_.log.close()
+
+
+def _event_ids(evs):
+    return [e.event_id for e in evs]
@@ -0,0 +1,93 @@
+from __future__ import unicode_literals
+
+import unittest
+
+import ztreamy
+import ztreamy.events
+
+import semserver.rawevents as rawevents
+
+
+class TestRawBodyDeserializer(unittest.TestCase):
+
+    def setUp(self):
+        self.evs = [
+            ztreamy.events.JSONEvent('user-1', 'application/json',
+                                     {'Location': {'latitude': 40.1,
+                                                   'longitude': -3.5,
+                                                   'score': 2}},
+                                     application_id='SmartDriver',
+                                     event_type='Vehicle Location'),
+            ztreamy.events.JSONEvent('user-1', 'application/json',
+                                     {'Data Section': {'value': 1.5}},
+                                     application_id='SmartDriver',
+                                     event_type='Data Section'),
+            ztreamy.events.create_command('user-1', 'Event-Source-Finished'),
+        ]
+        self.data = ztreamy.serialize_events(self.evs)
+        self.deserializer = rawevents.RawBodyDeserializer( \
+                                    [('SmartDriver', 'Vehicle Location')])
+
+    def test_parsed_events(self):
+        evs = self.deserializer.deserialize(self.data, complete=True)
+        self.assertEqual(len(evs), 3)
+        self.assertIsInstance(evs[0], ztreamy.events.JSONEvent)
+        self.assertEqual(evs[0].body['Location']['score'], 2)
+        self.assertIsInstance(evs[1], rawevents.RawBodyEvent)
+        self.assertIsInstance(evs[2], ztreamy.events.Command)
+        self.assertEqual(evs[2].command, 'Event-Source-Finished')
+
+    def test_passthrough(self):
+        evs = self.deserializer.deserialize(self.data, complete=True)
+        self.assertEqual(evs[1].serialize_body(),
+                         self.evs[1].serialize_body())
+        self.assertEqual(ztreamy.serialize_events(evs), self.data)
+        self.assertEqual(evs[1].as_json(), self.evs[1].as_json())
+
+    def test_partial_data(self):
+        evs = self.deserializer.deserialize(self.data[:-10])
+        self.assertEqual(len(evs), 2)
+        evs = self.deserializer.deserialize(self.data[-10:], complete=True)
+        self.assertEqual(len(evs), 1)
+
+    def test_deferred_bodies(self):
+        deserializer = rawevents.DeferredBodyDeserializer( \
+                                    [('SmartDriver', 'Data Section')])
+        evs = deserializer.deserialize(self.data, complete=True)
+        self.assertIsInstance(evs[0], ztreamy.events.JSONEvent)
+        self.assertIsInstance(evs[1], rawevents.RawBodyEvent)
+        self.assertIsInstance(evs[2], ztreamy.events.Command)
+        deserializer = rawevents.DeferredBodyDeserializer( \
+                                    [('SmartDriver', None)])
+        evs = deserializer.deserialize(self.data, complete=True)
+        self.assertIsInstance(evs[0], rawevents.RawBodyEvent)
+
+    def test_check_json(self):
+        evs = [ztreamy.events.Event('user-1', 'application/json', body) \
+               for body in ('{"a": [1, 2]}', '{"a": [1, 2}')]
+        data = ztreamy.serialize_events(evs)
+        deserializer = rawevents.RawBodyDeserializer([], check_json=True)
+        self.assertRaises(ztreamy.ZtreamyException,
+                          deserializer.deserialize, data, complete=True)
+        deserializer = rawevents.RawBodyDeserializer([], check_json=True)
+        self.assertEqual(len(deserializer.deserialize(data[:-30])), 1)
+        # Unchecked malformed bodies are sent as strings to JSON clients
+        evs = self.deserializer.deserialize(data, complete=True)
+        self.assertEqual(evs[0].as_json()['Body'], {'a': [1, 2]})
+        self.assertEqual(evs[1].as_json()['Body'], '{"a": [1, 2}')
+
+    def test_max_body_size(self):
+        deserializer = rawevents.DeferredBodyDeserializer( \
+                                    (), max_body_size=30,
+                                    parsed_events=[('SmartDriver',
+                                                    'Vehicle Location')])
+        evs = deserializer.deserialize(self.data, complete=True)
+        # The location is longer, but needed by the publish handler
+        self.assertIsInstance(evs[0], ztreamy.events.JSONEvent)
+        self.assertIsInstance(evs[1], rawevents.RawBodyEvent)
+        self.assertEqual(evs[1].as_json(), self.evs[1].as_json())
+        self.assertIsInstance(evs[2], ztreamy.events.Command)
+        deserializer = rawevents.DeferredBodyDeserializer( \
+                                    (), max_body_size=1000)
+        evs = deserializer.deserialize(self.data, complete=True)
+        self.assertIsInstance(evs[1], ztreamy.events.JSONEvent)
@@ -0,0 +1,220 @@
+from __future__ import unicode_literals
+
+import random
+import unittest
+
+import tornado.ioloop
+import tornado.testing
+
+import semserver.feedback as feedback
+import semserver.locations as locations
+import semserver.restserver as restserver
+import semserver.utils as utils
+
+
+class TestUserSessions(unittest.TestCase):
+
+    def setUp(self):
+        self.ioloop = tornado.ioloop.IOLoop()
+        self.sessions = restserver.UserSessions(10.0, 300.0, self.ioloop)
+
+    def tearDown(self):
+        self.ioloop.close(all_fds=True)
+
+    def test_check(self):
+        check = self.sessions.check
+        self.assertEqual(check('user-1', _north(0), 3),
+                         (True, True, _north(0)))
+        self.assertEqual(check('user-1', _north(5), 3),
+                         (False, False, _north(0)))
+        self.assertEqual(check('user-1', _north(100), 3),
+                         (True, False, _north(0)))
+        self.assertEqual(check('user-1', _north(250), 3),
+                         (True, False, _north(0)))
+        # Back near the long anchor: the bound is above the long distance,
+        # but not the actual distance
+        self.assertEqual(check('user-1', _north(20), 3),
+                         (True, False, _north(0)))
+        self.assertEqual(check('user-1', _north(350), 4),
+                         (True, True, _north(0)))
+        self.assertEqual(self.sessions['user-1'].long_bound, 0.0)
+        self.assertEqual(self.sessions['user-1'].score, 4)
+        self.assertEqual(check('user-1', _north(400), 4),
+                         (True, False, _north(350)))
+
+    def test_advance(self):
+        self.sessions.check('user-1', _north(0), 3)
+        self.assertTrue(self.sessions.advance('user-1', _north(100), 3))
+        self.assertFalse(self.sessions.advance('user-1', _north(105), 3))
+        self.assertTrue(self.sessions.advance('user-1', _north(200), 3))
+        session = self.sessions['user-1']
+        self.assertEqual(session.short_anchor, _north(200))
+        self.assertEqual(session.long_anchor, _north(0))
+        self.assertEqual(self.sessions.check('user-1', _north(250), 3),
+                         (True, False, _north(0)))
+        self.assertEqual(self.sessions.check('user-1', _north(310), 3),
+                         (True, True, _north(0)))
+
+    def test_advance_new_session(self):
+        self.assertTrue(self.sessions.advance('user-1', _north(0), 3))
+        self.assertFalse(self.sessions.advance('user-1', _north(5), 3))
+        # No scores have been looked up for the user yet
+        self.assertEqual(self.sessions.check('user-1', _north(8), 3),
+                         (True, True, _north(8)))
+        self.assertEqual(self.sessions.check('user-1', _north(30), 3),
+                         (True, False, _north(8)))
+
+    def test_roll(self):
+        self.sessions.check('user-1', _north(0), 3)
+        self.sessions.roll()
+        self.sessions.check('user-2', _north(0), 3)
+        self.sessions.roll()
+        self.assertNotIn('user-1', self.sessions)
+        self.assertIn('user-2', self.sessions)
+        self.assertEqual(len(self.sessions), 1)
+
+    def test_same_as_location_buffers(self):
+        # Compare with the former pair of short / long location buffers
+        rand = random.Random(1)
+        short = _LocationBuffer(10.0)
+        long_ = _LocationBuffer(300.0)
+        positions = {}
+        for _ in range(20000):
+            user_id = 'user-{}'.format(rand.randint(1, 20))
+            meters = positions.get(user_id, rand.uniform(0, 1000)) \
+                     + rand.uniform(-40.0, 60.0)
+            positions[user_id] = meters
+            location = _north(meters)
+            moved, previous = short.check(user_id, location)
+            if moved:
+                moved_long, previous = long_.check(user_id, location)
+            else:
+                moved_long = False
+                long_.refresh(user_id)
+            result = self.sessions.check(user_id, location, 3)
+            self.assertEqual(result[:2], (moved, moved_long))
+            if moved:
+                self.assertEqual(result[2], previous)
+            if rand.random() < 0.001:
+                short.roll()
+                long_.roll()
+                self.sessions.roll()
+                self.assertEqual(set(self.sessions.sessions), set(long_))
+
+
+class TestDriverScoresHandler(tornado.testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.index = restserver.ScoreIndex(self.io_loop,
+                                           ordered_lookup=False)
+        sessions = restserver.UserSessions(10.0, 300.0, self.io_loop)
+        stats = restserver.StatsTracker(self.index, sessions, self.io_loop)
+        return tornado.web.Application([ \
+                    ('/driver_scores', restserver.DriverScoresHandler,
+                     {'index': self.index,
+                      'sessions': sessions,
+                      'stats': stats})])
+
+    def test_get(self):
+        reply = self._request('user-2', _north(0), 4)
+        self.assertEqual(reply.reply_type, feedback.ScoresReply.SCORES)
+        self.assertEqual(reply.scores, [])
+        reply = self._request('user-1', _north(50), 3)
+        self.assertEqual(reply.reply_type, feedback.ScoresReply.SCORES)
+        self.assertEqual(_meters(reply.previous.lat), 50)
+        self.assertEqual([(_meters(s.latitude), s.score) \
+                          for s in reply.scores], [(0, 4)])
+        reply = self._request('user-1', _north(52), 3)
+        self.assertEqual(reply.reply_type, feedback.ScoresReply.NOT_MOVED)
+        reply = self._request('user-1', _north(100), 3)
+        self.assertEqual(reply.reply_type,
+                         feedback.ScoresReply.PREVIOUS_LOCATION)
+        self.assertEqual(_meters(reply.previous.lat), 50)
+
+    def test_post(self):
+        body = feedback.serialize_locations([(_north(0), 2), (_north(5), 2),
+                                             (_north(40), 3)])
+        reply = self._request('user-1', _north(45), 3, body=body)
+        # A new driver gets scores, even if the newest location
+        # is close to the older ones
+        self.assertEqual(reply.reply_type, feedback.ScoresReply.SCORES)
+        self.assertEqual(_meters(reply.previous.lat), 45)
+        # The second location is too close to the first one
+        self.assertEqual(len(self.index), 3)
+        response = self.fetch('/driver_scores?user=user-1&latitude=40.0'
+                              '&longitude=-3.0&score=3',
+                              method='POST', body=b'40.0,-3.0\r\n')
+        self.assertEqual(response.code, 422)
+
+    def test_binary(self):
+        self._request('user-2', _north(0), 4)
+        headers = {'Accept': feedback.SCORES_BINARY_MEDIA_TYPE}
+        response = self.fetch(_url('user-1', _north(50), 3),
+                              headers=headers)
+        self.assertEqual(response.headers['Content-Type'],
+                         feedback.SCORES_BINARY_MEDIA_TYPE)
+        self.assertEqual(len(response.body), 1 + 16 + 20)
+        reply = feedback.ScoresReply.parse_binary(response.body)
+        self.assertEqual([(s.score, s.user_hash) for s in reply.scores],
+                         [(4, None)])
+        response = self.fetch(_url('user-3', _north(50), 3) + '&hashes=1',
+                              headers=headers)
+        self.assertEqual(response.headers['Content-Type'],
+                         feedback.SCORES_BINARY_HASHES_MEDIA_TYPE)
+        reply = feedback.ScoresReply.parse( \
+                        response.body,
+                        media_type=feedback.SCORES_BINARY_HASHES_MEDIA_TYPE)
+        self.assertEqual(sorted((s.score, s.user_hash) \
+                                for s in reply.scores),
+                         [(3, feedback.user_hash('user-1')),
+                          (4, feedback.user_hash('user-2'))])
+
+    def test_text_hashes(self):
+        self._request('user-2', _north(0), 4)
+        response = self.fetch(_url('user-1', _north(50), 3))
+        self.assertEqual(response.body.split(b'\r\n')[1].count(b','), 2)
+        response = self.fetch(_url('user-3', _north(50), 3) + '&hashes=1')
+        reply = feedback.ScoresReply.parse(response.body)
+        self.assertIn(feedback.user_hash('user-2'),
+                      [s.user_hash for s in reply.scores])
+
+    def _request(self, user_id, location, score, body=None):
+        if body is None:
+            response = self.fetch(_url(user_id, location, score))
+        else:
+            response = self.fetch(_url(user_id, location, score),
+                                  method='POST', body=body)
+        self.assertEqual(response.code, 200)
+        return feedback.ScoresReply.parse(response.body)
+
+
+class _LocationBuffer(utils.LatestValueBuffer):
+    """The location buffer that `UserSessions` replaced."""
+    def __init__(self, threshold_distance):
+        super(_LocationBuffer, self).__init__()
+        self.threshold_distance = threshold_distance
+
+    def check(self, user_id, location):
+        try:
+            previous = self[user_id]
+        except KeyError:
+            answer = True
+            previous = location
+        else:
+            answer = location.distance(previous) >= self.threshold_distance
+        if answer:
+            self[user_id] = location
+        else:
+            self.refresh(user_id)
+        return answer, previous
+
+
+def _north(meters):
+    return locations.Location(40.0 + meters / 111195.0, -3.0)
+
+def _meters(latitude):
+    return int(round((latitude - 40.0) * 111195.0))
+
+def _url(user_id, location, score):
+    return '/driver_scores?user={}&latitude={!r}&longitude={!r}&score={}'\
+           .format(user_id, location.lat, location.long, score)
@@ -0,0 +1,74 @@
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import ztreamy.events
+
+import semserver.spill as spill
+
+
+class TestSpillBuffer(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.evs = [ztreamy.events.Event('source', 'text/plain',
+                                         'body {}'.format(i),
+                                         application_id='SmartDriver')
+                    for i in range(20)]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_spill_in_order(self):
+        buffer_ = spill.SpillBuffer(self.directory, max_events=5,
+                                    segment_size=100)
+        buffer_.append(self.evs[:8])
+        self.assertEqual(len(buffer_), 5)
+        self.assertTrue(buffer_.has_spilled())
+        buffer_.append(self.evs[8:12])
+        self.assertEqual(_event_ids(buffer_.pop(3)), _event_ids(self.evs[:3]))
+        buffer_.append(self.evs[12:])
+        self.assertEqual(_event_ids(_pop_all(buffer_)),
+                         _event_ids(self.evs[3:]))
+        self.assertFalse(buffer_.has_spilled())
+        self.assertEqual(buffer_.disk_bytes, 0)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_replay_after_close(self):
+        buffer_ = spill.SpillBuffer(self.directory, max_events=5)
+        buffer_.append(self.evs[2:10])
+        self.assertEqual(_event_ids(buffer_.pop(6)), _event_ids(self.evs[2:7]))
+        self.assertEqual(_event_ids(buffer_.pop(1)), _event_ids(self.evs[7:8]))
+        buffer_.append(self.evs[10:])
+        buffer_.close(head_events=self.evs[:2])
+        buffer_ = spill.SpillBuffer(self.directory, max_events=5)
+        self.assertEqual(_event_ids(_pop_all(buffer_)),
+                         _event_ids(self.evs[:2] + self.evs[8:]))
+
+    def test_truncated_segment(self):
+        buffer_ = spill.SpillBuffer(self.directory, max_events=0)
+        buffer_.append(self.evs[:5])
+        buffer_.append(self.evs[5:])
+        buffer_.close()
+        path = os.path.join(self.directory, os.listdir(self.directory)[0])
+        with open(path, 'r+b') as file_:
+            file_.truncate(os.path.getsize(path) - 10)
+        buffer_ = spill.SpillBuffer(self.directory)
+        self.assertEqual(_event_ids(_pop_all(buffer_)),
+                         _event_ids(self.evs[:5]))
+        self.assertEqual(buffer_.disk_bytes, 0)
+
+
+def _pop_all(buffer_):
+    evs = []
+    while True:
+        popped = buffer_.pop(4)
+        if not popped:
+            return evs
+        evs.extend(popped)
+
+def _event_ids(evs):
+    return [e.event_id for e in evs]
@@ -0,0 +1,142 @@
+from __future__ import unicode_literals
+
+import unittest
+
+import tornado.httputil
+import tornado.ioloop
+import tornado.web
+import ztreamy
+import ztreamy.events
+import ztreamy.server
+import ztreamy.dispatchers
+
+import semserver.subscriptions as subscriptions
+
+
+class TestSubscriptionFilter(unittest.TestCase):
+
+    def test_parse(self):
+        subscription_filter = subscriptions.SubscriptionFilter.parse({
+            'include': ['SmartDriver', 'Hermes-Citizen-Fitbit-Steps'],
+            'exclude': ['SmartDriver/Vehicle Location'],
+        })
+        self.assertEqual(subscription_filter.include,
+                         set([('SmartDriver', None),
+                              ('Hermes-Citizen-Fitbit-Steps', None)]))
+        self.assertEqual(subscription_filter.exclude,
+                         set([('SmartDriver', 'Vehicle Location')]))
+        self.assertIsNone(subscriptions.SubscriptionFilter.parse({}))
+        self.assertRaises(ValueError, subscriptions.SubscriptionFilter.parse,
+                          {'exclude': ['/Vehicle Location']})
+
+    def test_filter_events(self):
+        evs = [_event('SmartDriver', 'Vehicle Location'),
+               _event('SmartDriver', 'High Speed'),
+               _event('Other', 'Vehicle Location')]
+        subscription_filter = subscriptions.SubscriptionFilter( \
+                                exclude=[('SmartDriver', 'Vehicle Location')])
+        self.assertEqual(subscription_filter.filter_events(evs), evs[1:])
+        subscription_filter = subscriptions.SubscriptionFilter( \
+                                include=[('SmartDriver', None)],
+                                exclude=[('SmartDriver', 'Vehicle Location')])
+        self.assertEqual(subscription_filter.filter_events(evs), evs[1:2])
+
+    def test_key(self):
+        filter_1 = subscriptions.SubscriptionFilter( \
+                                    exclude=[('B', None), ('A', 'Type X')])
+        filter_2 = subscriptions.SubscriptionFilter( \
+                                    exclude=[('A', 'Type X'), ('B', None)])
+        self.assertEqual(filter_1.key, filter_2.key)
+        self.assertEqual(filter_1.key, 'exclude=A%2FType+X&exclude=B')
+
+    def test_last_seen_after_query(self):
+        # The ztreamy client appends '?last-seen=' to URLs with a query
+        url = subscriptions.subscription_url( \
+                                    'http://localhost/backend/compressed',
+                                    exclude=[('SmartDriver', 'Vehicle Location')])
+        request = tornado.httputil.HTTPServerRequest( \
+                                    uri=url[len('http://localhost'):]
+                                        + '?last-seen=1234')
+        arguments = subscriptions._query_arguments(request.query_arguments)
+        self.assertEqual(arguments, {'exclude': ['SmartDriver/Vehicle Location'],
+                                     'last-seen': ['1234']})
+
+
+class TestFilteringDispatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.stream = ztreamy.Stream('test', ioloop=tornado.ioloop.IOLoop())
+        self.stream.dispatcher = subscriptions.FilteringDispatcher( \
+                                            self.stream.dispatcher, self.stream,
+                                            max_views=1)
+
+    def tearDown(self):
+        self.stream.stop()
+
+    def test_dispatch(self):
+        all_events = []
+        filtered_events = []
+        self.stream.create_local_client(all_events.append)
+        self.stream.dispatcher.register_client( \
+                    _client(filtered_events.append,
+                            exclude=['SmartDriver/Vehicle Location']))
+        evs = [_event('SmartDriver', 'Vehicle Location'),
+               _event('SmartDriver', 'High Speed')]
+        self.stream.dispatch_events(evs)
+        self.assertEqual(all_events, evs)
+        self.assertEqual(filtered_events, evs[1:])
+        self.assertEqual(len(self.stream.dispatcher.views), 1)
+        self.assertEqual(self.stream.dispatcher.num_clients, 2)
+
+    def test_recent_events(self):
+        evs = [_event('SmartDriver', 'Vehicle Location'),
+               _event('SmartDriver', 'High Speed')]
+        self.stream.dispatch_events(evs)
+        view = self.stream.dispatcher._view( \
+                        subscriptions.SubscriptionFilter( \
+                                include=[('SmartDriver', 'High Speed')]))
+        self.assertEqual(view.dispatcher.recent_events.most_recent(10),
+                         evs[1:])
+
+    def test_bad_filters(self):
+        with self.assertRaises(tornado.web.HTTPError) as context:
+            self.stream.dispatcher.register_client( \
+                                        _client(lambda e: None, exclude=['']))
+        self.assertEqual(context.exception.status_code, 400)
+        self.stream.dispatcher.register_client( \
+                                        _client(lambda e: None, exclude=['A']))
+        with self.assertRaises(tornado.web.HTTPError) as context:
+            self.stream.dispatcher.register_client( \
+                                        _client(lambda e: None, exclude=['B']))
+        self.assertEqual(context.exception.status_code, 503)
+
+    def test_remove_idle_views(self):
+        client = _client(lambda e: None, exclude=['A'])
+        self.stream.dispatcher.register_client(client)
+        self.stream.dispatcher.deregister_client(client)
+        self.stream.dispatcher._remove_idle_views()
+        self.assertEqual(len(self.stream.dispatcher.views), 1)
+        self.stream.dispatcher._remove_idle_views()
+        self.assertEqual(len(self.stream.dispatcher.views), 0)
+
+
+class _Handler(object):
+    def __init__(self, query_arguments):
+        self.request = tornado.httputil.HTTPServerRequest(uri='/test')
+        self.request.query_arguments = query_arguments
+
+
+def _client(callback, **query_arguments):
+    client = ztreamy.server._LocalClient( \
+                    callback,
+                    ztreamy.dispatchers.ClientPropertiesFactory\
+                                                    .create_local_client())
+    client.handler = _Handler({name: [value.encode('utf-8') \
+                                      for value in values] \
+                               for name, values in query_arguments.items()})
+    return client
+
+def _event(application_id, event_type):
+    return ztreamy.events.Event('source', 'text/plain', 'body',
+                                application_id=application_id,
+                                event_type=event_type)
@@ -0,0 +1,103 @@
+import unittest
+
+import tornado.ioloop
+import ztreamy.events
+
+import semserver.utils as utils
+
+
+class TestLatestValueBuffer(unittest.TestCase):
+
+    def test_roll(self):
+        buffer_ = utils.LatestValueBuffer()
+        buffer_['a'] = 1
+        buffer_.roll()
+        buffer_['b'] = 2
+        self.assertEqual(buffer_['a'], 1)
+        self.assertEqual(len(buffer_), 2)
+        buffer_.roll()
+        self.assertFalse('a' in buffer_)
+        self.assertEqual(buffer_['b'], 2)
+        buffer_.roll()
+        self.assertEqual(len(buffer_), 0)
+
+    def test_exact_length(self):
+        buffer_ = utils.LatestValueBuffer()
+        buffer_['a'] = 1
+        buffer_.roll()
+        buffer_['a'] = 2
+        buffer_.refresh('a')
+        self.assertEqual(len(buffer_), 1)
+        self.assertEqual(list(buffer_), ['a'])
+        self.assertEqual(buffer_['a'], 2)
+
+    def test_refresh(self):
+        buffer_ = utils.LatestValueBuffer(generations=3)
+        buffer_['a'] = 1
+        buffer_['b'] = 2
+        buffer_.roll()
+        buffer_.roll()
+        buffer_.refresh('a')
+        buffer_.roll()
+        self.assertEqual(buffer_['a'], 1)
+        self.assertFalse('b' in buffer_)
+        self.assertRaises(KeyError, buffer_.refresh, 'b')
+
+    def test_delete(self):
+        buffer_ = utils.LatestValueBuffer()
+        buffer_['a'] = 1
+        buffer_.roll()
+        del buffer_['a']
+        self.assertEqual(len(buffer_), 0)
+        self.assertRaises(KeyError, buffer_.__getitem__, 'a')
+
+    def test_max_entries(self):
+        buffer_ = utils.LatestValueBuffer(max_entries=3)
+        buffer_['a'] = 1
+        buffer_['b'] = 2
+        buffer_.roll()
+        buffer_['c'] = 3
+        buffer_.refresh('a')
+        buffer_['d'] = 4
+        self.assertEqual(len(buffer_), 3)
+        self.assertFalse('b' in buffer_)
+        buffer_['c'] = 5
+        buffer_['e'] = 6
+        self.assertEqual(sorted(buffer_), ['c', 'd', 'e'])
+        self.assertEqual(buffer_.num_evictions, 2)
+
+    def test_generation_stats(self):
+        buffer_ = utils.LatestValueBuffer(generations=3)
+        buffer_['a'] = 1
+        buffer_.roll()
+        buffer_['b'] = 2
+        buffer_['c'] = 3
+        stats = buffer_.generation_stats()
+        self.assertEqual([s.entries for s in stats], [2, 1])
+        self.assertEqual([s.age for s in stats], [0, 1])
+        self.assertTrue(all(s.size > 0 for s in stats))
+
+
+class TestDuplicateFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.evs = [ztreamy.events.Event('source', 'text/plain', 'body')
+                    for i in range(10)]
+
+    def test_filter_events(self):
+        filter_ = utils.DuplicateFilter(ioloop=tornado.ioloop.IOLoop())
+        self.assertEqual(filter_.filter_events(self.evs[:5]), self.evs[:5])
+        self.assertEqual(filter_.filter_events(self.evs[3:] + self.evs[8:]),
+                         self.evs[5:])
+        self.assertEqual(filter_.num_duplicates, 4)
+        filter_.event_ids.roll()
+        filter_.event_ids.roll()
+        self.assertEqual(filter_.filter_events(self.evs[:1]), self.evs[:1])
+
+    def test_max_events(self):
+        filter_ = utils.DuplicateFilter(max_events=4,
+                                        ioloop=tornado.ioloop.IOLoop())
+        filter_.filter_events(self.evs)
+        self.assertEqual(len(filter_.event_ids), 4)
+        self.assertEqual(filter_.num_early_rolls, 4)
+        self.assertEqual(filter_.filter_events(self.evs[-4:]), [])